@@ -19,7 +19,6 @@
 
 from imgcreate.live import *
 from imgcreate.creator import *
-from imgcreate.yuminst import *
 from imgcreate.kickstart import *
 from imgcreate.fs import *
 from imgcreate.debug import *
@@ -30,7 +30,6 @@ from imgcreate.errors import *
 from imgcreate.fs import *
 from imgcreate.creator import *
 from appcreate.partitionedfs import *
-import urlgrabber.progress as progress
 
 class ApplianceImageCreator(ImageCreator):
     """Installs a system into a file containing a partitioned disk image.
@@ -109,6 +108,17 @@ class ApplianceImageCreator(ImageCreator):
         cfg.close()
                        
     
+    def _get_build_footprint(self):
+        # the raw disks, plus their converted copies
+        size = 0L
+        for part in kickstart.get_partitions(self.ks):
+            size += part.size * 1024L * 1024L
+        return size * 2
+
+    def _checkpoint_intact(self):
+        # mount() partitions and formats the disks afresh
+        return False
+
     #
     # Actual implementation
     #
@@ -452,6 +462,7 @@ class ApplianceImageCreator(ImageCreator):
                 diskpath = "%s/%s-%s.%s" % (self._outdir,self.name,name, self.__disk_format)
                 disk_size = os.path.getsize(diskpath)
                 meter_ct = 0
+                import urlgrabber.progress as progress
                 meter = progress.TextMeter()
                 meter.start(size=disk_size, text="Generating disk signature for %s-%s.%s" % (self.name,name,self.__disk_format))
                 xml += "    <disk file='%s-%s.%s' use='system' format='%s'>\n" % (self.name,name, self.__disk_format, self.__disk_format)
@@ -212,6 +212,26 @@ class PartitionedMount(Mount):
                 except:
                     pass
                 p['mount'] = None
+                self.__report_usage(p)
+
+    def __report_usage(self, p):
+        if p['device'] is None:
+            return
+        try:
+            sb = read_ext_superblock(p['device'])
+        except (IOError, OSError), e:
+            logging.debug("Unable to read superblock of %s: %s" %
+                          (p['device'], e))
+            return
+        if sb is None:
+            return
+
+        logging.info("Partition %s: %d of %d MB used" %
+                     (p['mountpoint'], sb.used / (1024 * 1024),
+                      sb.size / (1024 * 1024)))
+        get_timing_report().note("%s used" % p['mountpoint'],
+                                 "%d of %d MB" % (sb.used / (1024 * 1024),
+                                                  sb.size / (1024 * 1024)))
 
     def mount(self):
         for dev in self.disks.keys():
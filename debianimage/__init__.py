@@ -21,6 +21,7 @@ from debianimage.appliance import *
 from debianimage.installer import *
 from debianimage.aptinst import *
 from debianimage.kickstart import *
+from debianimage.closure import *
 #from debianimage.fs import *
 #from debianimage.debug import *
 
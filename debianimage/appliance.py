@@ -30,7 +30,6 @@ from imgcreate.errors import *
 from imgcreate.fs import *
 from appcreate.appliance import *
 from appcreate.partitionedfs import *
-import urlgrabber.progress as progress
 
 from debianimage.aptinst import *
 from debianimage import kickstart
@@ -83,10 +82,10 @@ class DebApplianceImageCreator(ApplianceImageCreator):
         base_on -- a previous install on which to base this install; defaults
                    to None, causing a new image to be created
 
-        cachedir -- a directory in which to store the Yum cache; defaults to
-                    None, causing a new cache to be created; by setting this
-                    to another directory, the same cache can be reused across
-                    multiple installs.
+        cachedir -- a directory in which to share downloaded packages;
+                    defaults to None, causing nothing to be shared; by
+                    setting this to another directory, the same packages
+                    can be reused across multiple installs.
 
         """
 
@@ -102,6 +101,9 @@ class DebApplianceImageCreator(ApplianceImageCreator):
 
 #        cachesrc = cachedir or (self.__builddir + "/yum-cache")
 #        makedirs(cachesrc)
+        if cachedir:
+            self.apt_archives_cache = os.path.join(os.path.abspath(cachedir),
+                                                   "archives")
 
         # bind mount system directories into _instroot
         for (f, dest) in [("/sys", None), ("/proc", None),
@@ -117,10 +119,13 @@ class DebApplianceImageCreator(ApplianceImageCreator):
 
         self._ImageCreator__create_minimal_dev()
 
-        os.symlink("/proc/self/mounts", self._instroot + "/etc/mtab")
+        if not os.path.lexists(self._instroot + "/etc/mtab"):
+            os.symlink("/proc/self/mounts", self._instroot + "/etc/mtab")
 
         self._ImageCreator__write_fstab()
 
+        self._ImageCreator__setup_install_io()
+
     def __create_selinuxfs(self):
         pass
 
@@ -134,10 +139,15 @@ class DebApplianceImageCreator(ApplianceImageCreator):
     
     def install(self, repo_urls = {}):
         aApt = Apt()
+        aApt.unsafe_io = self.unsafe_io
+        aApt.mirror_selector = self.mirror_selector
+        aApt.depsolve_cache = self.depsolve_cache
+        aApt.lists_cache = self.apt_lists_cache
+        aApt.archives_cache = self.apt_archives_cache
         aApt.setup( self._instroot, self.arch )
         for repo in kickstart.get_repos(self.ks, repo_urls):
             (name, baseurl, mirrorlist, proxy, inc, exc) = repo
-            aApt.addRepository( baseurl )
+            aApt.addRepository( baseurl, mirrorlist )
 
         for pkg in kickstart.get_packages(self.ks,
                                           self._get_required_packages()):
@@ -145,33 +155,10 @@ class DebApplianceImageCreator(ApplianceImageCreator):
 
         aApt.runInstall()
 
-    def configure(self):
-        """Configure the system image according to the kickstart.
-
-        This method applies the (e.g. keyboard or network) configuration
-        specified in the kickstart and executes the kickstart %post scripts.
-
-        If neccessary, it also prepares the image to be bootable by e.g.
-        creating an initrd and bootloader configuration.
-
-        """
-        ksh = self.ks.handler
-
-        kickstart.LanguageConfig(self._instroot).apply(ksh.lang)
-        kickstart.KeyboardConfig(self._instroot).apply(ksh.keyboard)
-        kickstart.TimezoneConfig(self._instroot).apply(ksh.timezone)
-        kickstart.AuthConfig(self._instroot).apply(ksh.authconfig)
-        kickstart.FirewallConfig(self._instroot).apply(ksh.firewall)
-        kickstart.RootPasswordConfig(self._instroot).apply(ksh.rootpw)
-        kickstart.ServicesConfig(self._instroot).apply(ksh.services)
-        kickstart.XConfig(self._instroot).apply(ksh.xconfig)
-        kickstart.NetworkConfig(self._instroot).apply(ksh.network)
-#        kickstart.RPMMacroConfig(self._instroot).apply(self.ks)
-
-        self._create_bootconfig()
-
-        self._ImageCreator__run_post_scripts()
-#        kickstart.SelinuxConfig(self._instroot).apply(ksh.selinux)
+    def _get_configure_tasks(self):
+        # there are no rpm macros or SELinux labels in a Debian image
+        return [t for t in ApplianceImageCreator._get_configure_tasks(self)
+                if not t[0] in ("rpm macros", "selinux")]
 
 
     def _get_required_packages(self):
@@ -19,14 +19,23 @@
 import glob
 import os
 import sys
+import time
 import logging
-import apt
 import errno
+import fcntl
+import shutil
+import hashlib
+import threading
 import subprocess
+import Queue
 
 import pykickstart.parser
 
 #from imgcreate.errors import *
+from imgcreate.errors import CreatorError
+from imgcreate.mirrors import *
+from imgcreate.timing import get_timing_report
+from imgcreate.depcache import get_depsolve_key, get_file_digest
 
 def makedirs(dirname):
     """A version of os.makedirs() that doesn't throw an
@@ -39,6 +48,91 @@ def makedirs(dirname):
             raise
 
 
+UNSAFE_IO_CONF = "/etc/dpkg/dpkg.cfg.d/imgcreate-unsafe-io"
+"""The dpkg configuration which stops dpkg from syncing while installing."""
+
+DEB_DOWNLOAD_JOBS = 4
+"""The number of packages downloaded at the same time while bootstrapping;
+packages are unpacked as they arrive, while the rest are downloading."""
+
+DEB_FETCH_TRIES = 5
+"""The number of times downloading a package is tried before giving up."""
+
+WARM_DIR_ENV = "IMGCREATE_WARM_DIR"
+"""Set by a build daemon to the directory in which builds record the package
+lists they fetched, for the daemon to keep open for later builds."""
+
+_warm_caches = {}
+"""Opened apt caches by the apt configuration they were opened for, as
+(cache, rootdir, time loaded) tuples. A build daemon fills this before forking
+builds, which then skip fetching and parsing those package lists."""
+
+def _read_file(path):
+    try:
+        f = open(path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except IOError:
+        return ""
+
+def _get_apt_config(rootdir):
+    """Return the configuration determining the package lists of rootdir."""
+    return _read_file(rootdir + "/etc/apt/sources.list") + "\0" + \
+           _read_file(rootdir + "/etc/apt/apt.conf")
+
+def _copy_lists(src, dest, link = False):
+    makedirs(dest + "/var/lib/apt/lists/")
+    if link:
+        # apt replaces lists by renaming new ones over them, so the lists
+        # of different roots can share their files
+        rc = subprocess.call(["/bin/cp", "-al", src + "/var/lib/apt/lists/.",
+                              dest + "/var/lib/apt/lists/"],
+                             stderr = open(os.devnull, "w"))
+        if rc == 0:
+            return True
+    rc = subprocess.call(["/bin/cp", "-a", src + "/var/lib/apt/lists/.",
+                          dest + "/var/lib/apt/lists/"])
+    return rc == 0
+
+def _get_list_inodes(rootdir):
+    inodes = {}
+    for path in glob.glob(rootdir + "/var/lib/apt/lists/*"):
+        if os.path.isfile(path):
+            inodes[os.path.basename(path)] = os.stat(path).st_ino
+    return inodes
+
+def load_warm_caches(warmdir, refresh = None):
+    """Open the package lists recorded in warmdir by earlier builds.
+
+    warmdir -- the directory builds recorded their package lists in.
+    refresh -- the age in seconds after which lists are fetched again, or
+               None to never fetch them.
+
+    """
+    import apt
+    for rootdir in glob.glob(warmdir + "/*"):
+        if rootdir.endswith(".tmp") or \
+           not os.path.exists(rootdir + "/etc/apt/sources.list"):
+            continue
+        key = _get_apt_config(rootdir)
+        if key in _warm_caches:
+            loaded = _warm_caches[key][2]
+            if refresh is None or time.time() - loaded < refresh:
+                continue
+        try:
+            cache = apt.Cache(None, rootdir)
+            if key in _warm_caches:
+                cache.update()
+            cache.open()
+        except Exception, e:
+            logging.warn("Failed to load package lists in %s : %s" %
+                         (rootdir, e))
+            continue
+        _warm_caches[key] = (cache, rootdir, time.time())
+        logging.info("Loaded package lists in %s" % rootdir)
+
 class TextProgress(object):
     logger = logging.getLogger()
     def emit(self, lvl, msg):
@@ -56,15 +150,177 @@ class TextProgress(object):
     def end(self, *args):
         self.emit(logging.INFO, "...OK\n")
 
+def get_release_path(dist):
+    """Return the path of the Release file of dist in its repository.
+
+    dist -- the suite and components of a sources.list entry, e.g.
+            "squeeze main".
+
+    """
+    suite = dist.split()[0]
+    if suite.endswith("/"):
+        # a flat repository
+        return suite + "Release"
+    return "dists/%s/Release" % suite
+
+def get_release_url(fullurl):
+    """Return the location of the Release file of a sources.list entry.
+
+    fullurl -- the entry without its "deb" type, e.g.
+               "http://ftp.debian.org/debian squeeze main".
+
+    """
+    parts = fullurl.split(None, 1)
+    if len(parts) < 2:
+        return None
+    return parts[0].rstrip("/") + "/" + get_release_path(parts[1])
+
+class DownloadPipeline(object):
+    """Downloads packages in the background, in the order given.
+
+    fetch -- called with the name of a package to download it, from as many
+             threads as jobs.
+
+    """
+    def __init__(self, fetch, pkglist, jobs = DEB_DOWNLOAD_JOBS):
+        self.__fetch = fetch
+        self.__queue = Queue.Queue()
+        self.__cond = threading.Condition()
+        self.__fetched = set()
+        self.__errors = {}
+        self.__started = time.time()
+        self.__finished = None
+        self.__threads = []
+        self.pkglist = list(pkglist)
+        for pkg in self.pkglist:
+            self.__queue.put(pkg)
+        for i in range(min(jobs, len(self.pkglist))):
+            self.__queue.put(None)
+            t = threading.Thread(target = self.__work)
+            t.setDaemon(True)
+            t.start()
+            self.__threads.append(t)
+
+    def __work(self):
+        while True:
+            pkg = self.__queue.get()
+            if pkg is None:
+                return
+            error = None
+            try:
+                self.__fetch(pkg)
+            except Exception, e:
+                error = e
+            with self.__cond:
+                if error is None:
+                    self.__fetched.add(pkg)
+                else:
+                    self.__errors[pkg] = error
+                if len(self.__fetched) + len(self.__errors) == \
+                   len(self.pkglist):
+                    self.__finished = time.time()
+                self.__cond.notifyAll()
+
+    def arrived(self, pkgs):
+        """Yield the packages of pkgs in batches, as they are downloaded.
+
+        CreatorError is raised if one of them fails to download.
+
+        """
+        pending = list(pkgs)
+        unknown = [p for p in pending if not p in self.pkglist]
+        if unknown:
+            raise CreatorError("%s is not being downloaded" % unknown[0])
+        while pending:
+            with self.__cond:
+                while True:
+                    failed = [p for p in pending if p in self.__errors]
+                    if failed:
+                        raise CreatorError("Failed to download %s : %s" %
+                                           (failed[0],
+                                            self.__errors[failed[0]]))
+                    ready = [p for p in pending if p in self.__fetched]
+                    if ready:
+                        break
+                    # time out now and then so that ^C gets through
+                    self.__cond.wait(1)
+            for p in ready:
+                pending.remove(p)
+            yield ready
+
+    def wait(self, pkgs):
+        """Wait for all of pkgs to be downloaded."""
+        for ready in self.arrived(pkgs):
+            pass
+
+    def close(self):
+        """Stop downloading, and note how long downloading took."""
+        try:
+            while True:
+                self.__queue.get_nowait()
+        except Queue.Empty:
+            pass
+        for t in self.__threads:
+            self.__queue.put(None)
+        if self.__finished:
+            get_timing_report().note("debootstrap download",
+                                     "%d packages in %.1fs, %d jobs" %
+                                     (len(self.pkglist),
+                                      self.__finished - self.__started,
+                                      len(self.__threads)))
+
 class Debootstrap(object):
     """class for debootstrap"""
     def __init__(self, rootdir, opts=None):
         self.rootdir = rootdir
         self.repos = []
+        self.mirrors = {}
         self.opts = opts
+        self.unsafe_io = False
+        self.depsolve_cache = None
+        self.lists_cache = None
+        self.archives_cache = None
+        """The host directory downloaded packages are shared in, or None."""
+        self.unresolved = []
+        """The dependencies findPackages() couldn't resolve, e.g. on a
+        virtual package several packages provide."""
+        self.__fetchLock = threading.Lock()
+        self.__cachedArchives = []
+
+    def addRepo(self, fullurl, mirrors = None):
+        """Add a sources.list entry, e.g. "http://host/debian squeeze main".
+
+        mirrors -- the mirrors of the repository, best first, if it has
+                   any; fullurl should be on the first of them. Packages
+                   are then downloaded from all of them.
 
-    def addRepo(self, fullurl):
+        """
         self.repos.append("deb " + fullurl)
+        if mirrors:
+            self.mirrors[mirrors[0].rstrip("/") + "/"] = MirrorSet(mirrors)
+
+    def _getMirrorSet(self, uri):
+        for (base, mirrorset) in self.mirrors.items():
+            if uri.startswith(base):
+                return mirrorset
+        return None
+
+    def _fetchFromMirrors(self, mirrorset, candidate, archives):
+        dest = archives + candidate.filename.split('/')[-1]
+        mirrorset.fetch(candidate.filename, dest, candidate.size)
+        expected = getattr(candidate, "sha256", None)
+        if expected:
+            f = open(dest, "rb")
+            try:
+                digest = hashlib.sha256()
+                for data in iter(lambda: f.read(65536), ""):
+                    digest.update(data)
+            finally:
+                f.close()
+            if digest.hexdigest() != expected:
+                os.unlink(dest)
+                raise CreatorError("Checksum mismatch for %s" %
+                                   candidate.filename)
 
     def _writeSourcesList(self):
         makedirs("%s/etc/apt/" % self.rootdir)
@@ -77,13 +333,102 @@ class Debootstrap(object):
 
         os.chmod(sourcesListPath, 0644)
 
+    def _writeUnsafeIoConf(self):
+        # dpkg reads this for every unpack, including the ones apt-get does;
+        # the image is synced once before it is unmounted
+        makedirs("%s/etc/dpkg/dpkg.cfg.d/" % self.rootdir)
+        f = file(self.rootdir + UNSAFE_IO_CONF, "w+")
+        f.write("force-unsafe-io\n")
+        f.close()
+
     def setup(self):
         makedirs( self.rootdir + '/var/log/')
         self.logfile = open( self.rootdir + '/var/log/bootstrap.log', 'w')
         self._writeSourcesList()
-        self.repocache = apt.Cache( None, self.rootdir )
-        self.repocache.update()
+        if self.unsafe_io:
+            self._writeUnsafeIoConf()
+        key = _get_apt_config(self.rootdir)
+        if key in _warm_caches:
+            (cache, warmroot, loaded) = _warm_caches[key]
+            if _copy_lists(warmroot, self.rootdir):
+                logging.info("Using package lists loaded %ds ago" %
+                             (time.time() - loaded))
+                self.repocache = cache
+                return
+        import apt
+        if self.lists_cache:
+            self.repocache = self._updateSharedLists(key)
+        else:
+            self.repocache = apt.Cache( None, self.rootdir )
+            self.repocache.update()
         self.repocache.open()
+        if os.environ.get(WARM_DIR_ENV):
+            self._recordLists(os.environ[WARM_DIR_ENV], key)
+
+    def _updateSharedLists(self, key):
+        """Update the package lists shared in lists_cache, and use them.
+
+        The lists last fetched for the same sources are linked into the
+        install root, so that apt only revalidates them: an unchanged
+        repository costs a conditional request for its InRelease file, and
+        a changed one the pdiffs or by-hash indexes of what changed. The
+        updated lists then replace the shared ones. Builds sharing the
+        lists take turns.
+
+        """
+        import apt
+        import apt_pkg
+        makedirs(self.lists_cache)
+        shared = os.path.join(self.lists_cache, hashlib.sha1(key).hexdigest())
+        fd = os.open(shared + ".lock", os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            old = {}
+            if os.path.isdir(shared) and _copy_lists(shared, self.rootdir,
+                                                     link = True):
+                old = _get_list_inodes(self.rootdir)
+            apt_pkg.config.set("Acquire::PDiffs", "true")
+            apt_pkg.config.set("Acquire::By-Hash", "yes")
+            cache = apt.Cache( None, self.rootdir )
+            cache.update()
+
+            new = _get_list_inodes(self.rootdir)
+            changed = [n for n in new if old.get(n) != new[n]]
+            get_timing_report().note("apt lists", "%d of %d updated" %
+                                     (len(changed), len(new)))
+            if changed or len(old) != len(new):
+                tmp = shared + ".%d.tmp" % os.getpid()
+                if _copy_lists(self.rootdir, tmp, link = True):
+                    subprocess.call(["/bin/rm", "-rf", shared + ".old"])
+                    if os.path.exists(shared):
+                        os.rename(shared, shared + ".old")
+                    os.rename(tmp, shared)
+                    subprocess.call(["/bin/rm", "-rf", shared + ".old"])
+                else:
+                    subprocess.call(["/bin/rm", "-rf", tmp])
+        finally:
+            os.close(fd)
+        return cache
+
+    def _recordLists(self, warmdir, key):
+        # the daemon which set WARM_DIR_ENV opens these once this build is
+        # done; write them under a temporary name, so it never sees a part
+        warmroot = os.path.join(warmdir, hashlib.sha1(key).hexdigest())
+        if os.path.exists(warmroot):
+            return
+        tmproot = warmroot + ".%d.tmp" % os.getpid()
+        makedirs(tmproot + "/etc/apt/")
+        for f in ("/etc/apt/sources.list", "/etc/apt/apt.conf"):
+            if os.path.exists(self.rootdir + f):
+                subprocess.call(["/bin/cp", "-p", self.rootdir + f,
+                                 tmproot + f])
+        if _copy_lists(self.rootdir, tmproot):
+            try:
+                os.rename(tmproot, warmroot)
+                return
+            except OSError:
+                pass
+        subprocess.call(["/bin/rm", "-rf", tmproot])
 
     def depends(self, pkglist):
         for name in pkglist:
@@ -93,18 +438,132 @@ class Debootstrap(object):
             if before_num != after_num:
                 self.depends( pkglist )
 
-    def addDepends(self, pkglist, deps):
+    def addDepends(self, pkglist, deps, required = True):
         for dep in deps:
             for basedep in dep.or_dependencies:
                 if self.repocache.has_key(basedep.name):
                     if basedep.name not in pkglist:
                         pkglist.append( basedep.name )
                     break 
+            else:
+                # only virtual packages satisfy it, e.g. mail-transport-agent
+                for basedep in dep.or_dependencies:
+                    provider = self.getProvider(basedep.name, pkglist)
+                    if provider:
+                        if provider not in pkglist:
+                            pkglist.append( provider )
+                        break
+                else:
+                    # left to apt-get -f install; recommends may be missing
+                    name = " | ".join([d.name for d in dep.or_dependencies])
+                    if required and name not in self.unresolved:
+                        self.unresolved.append( name )
+
+    def getProvider(self, name, pkglist = ()):
+        """Return the package to install for the virtual package name.
+
+        This is a provider of it already in pkglist, or else its only
+        provider; None if there are several, as apt-get would not choose
+        between them on the command line either, or none.
 
-    def findPackages(self):
+        """
+        if not self.repocache.is_virtual_package(name):
+            return None
+        providers = [p.name for p in self.repocache.get_providing_packages(name)]
+        for p in providers:
+            if p in pkglist:
+                return p
+        if len(providers) == 1:
+            return providers[0]
+        return None
+
+    def addRecommends(self, pkglist, installed):
+        """Add what apt-get would install along with pkglist to it: the
+        recommends of each package in it but not in installed, and their
+        dependencies, in turn."""
+        i = 0
+        while i < len(pkglist):
+            name = pkglist[i]
+            i += 1
+            if name in installed:
+                continue
+            candidate = self.repocache[name].candidate
+            self.addDepends( pkglist, candidate.dependencies)
+            self.addDepends( pkglist, candidate.recommends, False)
+
+    def _followsRecommends(self):
+        # as apt-get in the install root would; apt reads the root's apt.conf
+        # when the cache is opened, and installs recommends by default
+        import apt_pkg
+        return apt_pkg.config.find_b("APT::Install-Recommends", True)
+
+    def _getDepsolveKey(self, extras):
+        # the Release files hold the checksums of the package lists
+        releases = glob.glob(self.rootdir + "/var/lib/apt/lists/*Release")
+        if not releases:
+            return None
+        return get_depsolve_key([get_file_digest(r) for r in releases],
+                                { "config" : _get_apt_config(self.rootdir),
+                                  "priority" : ["required", "important"],
+                                  "extras" : extras,
+                                  "recommends" : self._followsRecommends() })
+
+    def isResolvable(self, name):
+        """Return whether name is a package the host can resolve."""
+        return self.repocache.has_key(name) and \
+               self.repocache[name].candidate is not None
+
+    def findPackages(self, extras = ()):
+        """Return the required and base packages, and both of them.
+
+        extras -- further packages to install, which are resolved along with
+                  the base packages and returned with them; they should be
+                  isResolvable(). If APT::Install-Recommends is on, as it is
+                  by default, the packages they recommend are added too,
+                  like apt-get would; the base packages' recommends are
+                  not followed, like debootstrap.
+
+        If depsolve_cache is set, the packages found for the same package
+        lists before are used instead of walking all of them again.
+
+        Dependencies only virtual packages satisfy are resolved to a
+        provider with getProvider(); those it can't resolve are left in
+        unresolved.
+
+        """
+        key = None
+        if self.depsolve_cache:
+            key = self._getDepsolveKey(extras)
+        if key:
+            result = self.depsolve_cache.get(key)
+            if result and not [p for p in result["required"] + result["base"]
+                               if not self.repocache.has_key(p)]:
+                self.requiredpkg = [str(p) for p in result["required"]]
+                self.basepkg = [str(p) for p in result["base"]]
+                self.unresolved = [str(p) for p in result.get("unresolved", [])]
+                get_timing_report().record_saved("depsolve",
+                                                 result["seconds"])
+                get_timing_report().note("depsolve",
+                                         "%d packages from cache" %
+                                         len(self.requiredpkg + self.basepkg))
+                return (self.requiredpkg, self.basepkg,
+                        self.requiredpkg + self.basepkg)
+
+        start = time.time()
+        with get_timing_report().timed("depsolve"):
+            found = self._resolvePackages(extras)
+        if key:
+            self.depsolve_cache.put(key, { "required" : self.requiredpkg,
+                                           "base" : self.basepkg,
+                                           "unresolved" : self.unresolved,
+                                           "seconds" : time.time() - start })
+        return found
+
+    def _resolvePackages(self, extras = ()):
         self.requiredpkg = []
         self.basepkg = []
         self.pkglist = []
+        self.unresolved = []
         for i in self.repocache:
             pkg = i.candidate
             if pkg.priority == "required":
@@ -115,36 +574,125 @@ class Debootstrap(object):
 #                self.pkglist.append( pkg.package.name )
         self.depends( self.requiredpkg )
         self.depends( self.basepkg )
+        extrapkg = list(extras)
+        self.depends( extrapkg )
+        if extrapkg and self._followsRecommends():
+            self.addRecommends( extrapkg, set(self.requiredpkg + self.basepkg) )
+        for p in extrapkg:
+            if p not in self.basepkg:
+                self.basepkg.append( p )
         ubase = [ a for a in self.basepkg if a not in self.requiredpkg]
         self.basepkg = ubase
         return (self.requiredpkg, self.basepkg, self.requiredpkg + self.basepkg)
 
     def downloadPackages(self, pkglist):
         for k in pkglist:
-            for i in range( 1, 5 ):
+            self.downloadPackage(k)
+
+    def _linkCachedArchive(self, name, size):
+        """Link the package file name from archives_cache into the install
+        root, if it is there with size bytes; return whether it was."""
+        if not self.archives_cache:
+            return False
+        src = os.path.join(self.archives_cache, name)
+        dest = self.rootdir + '/var/cache/apt/archives/' + name
+        try:
+            if os.path.getsize(src) != size:
+                return False
+            if os.path.lexists(dest):
+                os.unlink(dest)
+            try:
+                os.link(src, dest)
+            except OSError:
+                shutil.copyfile(src, dest)
+        except (OSError, IOError):
+            return False
+        self.__cachedArchives.append(name)
+        return True
+
+    def _storeCachedArchive(self, name):
+        # linked in under a name of its own and renamed, so that other
+        # builds never see part of a file; downloads are never written in
+        # place, so the install root and the cache may share the file
+        dest = os.path.join(self.archives_cache, name)
+        if os.path.exists(dest):
+            return
+        src = self.rootdir + '/var/cache/apt/archives/' + name
+        tmp = "%s.%d.%d.tmp" % (dest, os.getpid(), threading.currentThread().ident)
+        try:
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+            os.rename(tmp, dest)
+        except (OSError, IOError), e:
+            logging.warn("Failed to share %s in %s : %s" %
+                         (name, self.archives_cache, e))
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+
+    def _linkCachedArchives(self, args):
+        """Link the packages apt-get args would download from
+        archives_cache into the install root."""
+        if not self.archives_cache:
+            return
+        env = os.environ.copy()
+        env['LANG'] = 'C'
+        # lines of 'URI' FILENAME SIZE HASH
+        out = subprocess.Popen(['apt-get', '-y', '--force-yes', '-qq',
+                                '--print-uris'] + list(args),
+                               env = env, stdout = subprocess.PIPE,
+                               stderr = self.logfile,
+                               preexec_fn = self._chroot).communicate()[0]
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) >= 3 and fields[2].isdigit():
+                self._linkCachedArchive(fields[1], int(fields[2]))
+
+    def downloadPackage(self, k):
+        import apt
+        candidate = self.repocache[k].candidate
+        name = candidate.filename.split('/')[-1]
+        if self._linkCachedArchive(name, candidate.size):
+            return
+        mirrorset = self._getMirrorSet(candidate.uri)
+        if mirrorset:
+            self._fetchFromMirrors(mirrorset, candidate,
+                                   self.rootdir + '/var/cache/apt/archives/')
+            if self.archives_cache:
+                self._storeCachedArchive(name)
+            return
+        # python-apt isn't known to be safe to fetch with from several
+        # threads, so other packages are downloaded one at a time
+        with self.__fetchLock:
+            for i in range( DEB_FETCH_TRIES ):
                 try:
-                    self.repocache[k].candidate.fetch_binary( self.rootdir + '/var/cache/apt/archives/')
-                except apt.package.FetchError,e :
-                    if i > 5:
-                        print "Can't donwload %s in 5 times, please check network" % k
-                        raise apt.package.FetchError
-                    else:
-                        continue
+                    candidate.fetch_binary( self.rootdir + '/var/cache/apt/archives/')
+                except apt.package.FetchError, e:
+                    logging.debug("Failed to download %s : %s" % (k, e))
                 else:
                     break
-
-    def _debExtract(self, reqpkg):
-        for p in reqpkg:
-            os.system('dpkg -x %s %s'%( self.getDebPath(self.rootdir, p), self.rootdir) )
+            else:
+                # raised to the pipeline, which reports it from arrived()
+                raise CreatorError("gave up after %d tries : %s" %
+                                   (DEB_FETCH_TRIES, e))
+        if self.archives_cache:
+            self._storeCachedArchive(name)
+
+    def _debExtract(self, reqpkg, pipeline = None):
+        batches = pipeline and pipeline.arrived(reqpkg) or [reqpkg]
+        for batch in batches:
+            for p in batch:
+                os.system('dpkg -x %s %s'%( self.getDebPath(self.rootdir, p), self.rootdir) )
 
     def _setup_devices( self, rootdir ):
         pass
 
-    def preInstall(self, req):
+    def preInstall(self, req, pipeline = None):
         dpkgdir = self.rootdir + '/var/lib/dpkg/'
         dpkgrecord = self.repocache['dpkg'].candidate.record
 
-        self._debExtract( req )
+        self._debExtract( req, pipeline )
 
         makedirs('%sinfo' % dpkgdir)
 
@@ -212,20 +760,30 @@ class Debootstrap(object):
                      os.symlink('/usr/share/zoneinfo/UTC','%s/etc/localtime' % self.rootdir )
         
 
-    def installBase(self, pkglist):
+    def installBase(self, pkglist, pipeline = None):
 
-        debfiles = [self.getDebPath( '', p ) for p in pkglist ]
-        cmd = ['dpkg', '--force-overwrite', '--force-confold', '--skip-same-version', '--unpack']
-        cmd.extend(debfiles)
-        self.chrootCall( cmd, 'y')
+        # unpack what has arrived while the rest is downloading; nothing is
+        # configured until all of it is unpacked
+        batches = pipeline and pipeline.arrived(pkglist) or [pkglist]
+        for batch in batches:
+            debfiles = [self.getDebPath( '', p ) for p in batch ]
+            cmd = ['dpkg', '--force-overwrite', '--force-confold', '--skip-same-version', '--unpack']
+            cmd.extend(debfiles)
+            self.chrootCall( cmd, 'y')
 
         cmd = ('dpkg', '--force-confold', '--skip-same-version', '--configure', '-a')
         self.chrootCall( cmd, 'y')
         os.rename('%s/sbin/start-stop-daemon.REAL' % self.rootdir, '%s/sbin/start-stop-daemon' % self.rootdir )
 
     def cleanup(self):
+        if self.archives_cache:
+            # e.g. what apt-get downloaded for the extra packages
+            for path in glob.glob(self.rootdir + '/var/cache/apt/archives/*.deb'):
+                self._storeCachedArchive(os.path.basename(path))
         cmd = ('apt-get','clean')
         self.chrootCall( cmd )
+        if os.path.exists(self.rootdir + UNSAFE_IO_CONF):
+            os.unlink(self.rootdir + UNSAFE_IO_CONF)
         self.logfile.close()
 
     def installRequired(self, req):
@@ -253,16 +811,58 @@ class Debootstrap(object):
         cmd = ('dpkg',  '--configure', '--pending', '--force-configure-any', '--force-depends')
         self.chrootCall( cmd, 'y' )
 
-    def debootstrap(self):
-        ( req, base, alls ) = self.findPackages()
-        self.downloadPackages( alls )
-        self.preInstall( req )
-        c = [ 'base-passwd','base-files', 'dpkg', 'libc6', 'perl-base',  'mawk', 'debconf' ]
-        self.installCore(c)
-        self.installRequired( req )
-        self.installBase(base)
+    def _getUnconfigured(self):
+        # the packages dpkg left unpacked or half configured
+        unconfigured = []
+        name = None
+        for line in _read_file(self.rootdir + '/var/lib/dpkg/status').splitlines():
+            if line.startswith('Package:'):
+                name = line.split(':', 1)[1].strip()
+            elif line.startswith('Status:') and \
+                 not line.split(':', 1)[1].split()[-1] in ('installed', 'not-installed', 'config-files'):
+                unconfigured.append(name)
+        return unconfigured
+
+    def debootstrap(self, extras = ()):
+        """Install the required and base packages, along with extras.
+
+        The extras the host can resolve are downloaded, unpacked and
+        configured with the base packages; the rest, e.g. virtual packages,
+        are returned for installExtraPackage() to install.
+
+        """
+        resolvable = [p for p in extras if self.isResolvable(p)]
+        ( req, base, alls ) = self.findPackages(resolvable)
+        if self.archives_cache:
+            makedirs(self.archives_cache)
+            makedirs(self.rootdir + '/var/cache/apt/archives/partial/')
+        # the required packages are downloaded first, and extracted as they
+        # arrive; the base packages download while those are installed
+        pipeline = DownloadPipeline(self.downloadPackage, alls)
+        try:
+            self.preInstall( req, pipeline )
+            c = [ 'base-passwd','base-files', 'dpkg', 'libc6', 'perl-base',  'mawk', 'debconf' ]
+            pipeline.wait([p for p in c if p in alls])
+            self.installCore(c)
+            self.installRequired( req )
+            self.installBase(base, pipeline)
+        finally:
+            pipeline.close()
+        if self.archives_cache:
+            get_timing_report().note("apt archives",
+                                     "%d of %d packages shared" %
+                                     (len(self.__cachedArchives), len(alls)))
+
+        unconfigured = self._getUnconfigured()
+        if unconfigured:
+            # e.g. a dependency on a virtual package the host couldn't follow
+            logging.warn("Letting apt-get fix up %s" % ", ".join(unconfigured))
+            self._linkCachedArchives(('-f', 'install'))
+            self.chrootCall(('apt-get', '-y', '--force-yes', '-f', 'install'))
+        return [p for p in extras if not p in resolvable]
 
     def installExtraPackage( self, pkgs):
+        self._linkCachedArchives(['install'] + pkgs)
         cmd = ['apt-get', '-y', '--force-yes', 'install']
         cmd = cmd + pkgs
         self.chrootCall ( cmd )
@@ -275,6 +875,11 @@ class Apt(object):
         """
         self.releasever = releasever
         self.extrapkgs = []
+        self.unsafe_io = False
+        self.mirror_selector = None
+        self.depsolve_cache = None
+        self.lists_cache = None
+        self.archives_cache = None
 
     def doFileLogSetup(self, uid, logfile):
         # don't do the file log for the livecd as it can lead to open fds
@@ -320,13 +925,40 @@ class Apt(object):
     def selectGroup(self, grp, include = pykickstart.parser.GROUP_DEFAULT):
         pass
 
-    def addRepository(self, fullurl):
-        self.installer.addRepo(fullurl)
+    def addRepository(self, fullurl, mirrorlist = None):
+        """Add a repository, given as a sources.list entry.
+
+        mirrorlist -- the location of a list of mirrors followed by the
+                      suite and components, e.g.
+                      "http://host/mirrors.txt squeeze main"; used instead
+                      of fullurl if given.
+
+        """
+        if not mirrorlist:
+            self.installer.addRepo(fullurl)
+            return
+
+        (listurl, dist) = mirrorlist.split(None, 1)
+        mirrors = read_mirrorlist(listurl)
+        if not mirrors:
+            raise CreatorError("No mirrors listed in %s" % listurl)
+        if self.mirror_selector:
+            mirrors = self.mirror_selector.select(mirrors,
+                                                  get_release_path(dist))
+        else:
+            mirrors = mirrors[:MIRROR_TOP]
+        self.installer.addRepo(mirrors[0] + " " + dist, mirrors)
             
     def runInstall(self):
         os.environ["HOME"] = "/"
+        self.installer.unsafe_io = self.unsafe_io
+        self.installer.depsolve_cache = self.depsolve_cache
+        self.installer.lists_cache = self.lists_cache
+        self.installer.archives_cache = self.archives_cache
         self.installer.setup()
-        self.installer.debootstrap()
-        if len(self.extrapkgs):
-            self.installer.installExtraPackage( self.extrapkgs )
+        # the extra packages are resolved and installed with the base
+        # packages, bar those only apt-get in the install root can resolve
+        extrapkgs = self.installer.debootstrap( self.extrapkgs )
+        if len(extrapkgs):
+            self.installer.installExtraPackage( extrapkgs )
         self.installer.cleanup()
@@ -0,0 +1,232 @@
+#
+# closure.py : Local mirrors of the packages a kickstart installs
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import re
+import gzip
+import time
+import shutil
+import hashlib
+import logging
+
+from imgcreate.errors import CreatorError
+from imgcreate.timing import get_timing_report
+from debianimage.aptinst import *
+from debianimage import kickstart
+
+CLOSURE_POOL = "pool"
+"""The directory of a closure mirror the packages are kept in."""
+
+CLOSURE_DIST = "./"
+"""The suite of the flat repository a closure mirror is."""
+
+def _get_digests(path):
+    digests = [hashlib.md5(), hashlib.sha1(), hashlib.sha256()]
+    f = open(path, "rb")
+    try:
+        for data in iter(lambda: f.read(65536), ""):
+            for d in digests:
+                d.update(data)
+    finally:
+        f.close()
+    return [d.hexdigest() for d in digests]
+
+def _write_file(path, data):
+    f = open(path + ".tmp", "w")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(path + ".tmp", path)
+
+def rewrite_repos(kscfg, url):
+    """Return the kickstart kscfg with its repos replaced by one at url."""
+    f = open(kscfg)
+    try:
+        lines = f.read().splitlines()
+    finally:
+        f.close()
+    out = []
+    replaced = False
+    for line in lines:
+        if re.match(r"\s*repo\s", line):
+            if not replaced:
+                out.append('repo --name=closure --baseurl="%s %s"' %
+                           (url, CLOSURE_DIST))
+                replaced = True
+            continue
+        out.append(line)
+    return "\n".join(out) + "\n"
+
+class ClosureMirror(object):
+    """A flat repository holding exactly the packages a kickstart installs.
+
+    The packages are resolved the way Apt.runInstall() resolves them, from
+    the repositories of the kickstart, with the packages they recommend
+    if APT::Install-Recommends is on. Virtual packages are resolved to
+    their provider; if one can't be chosen, e.g. between several, the
+    update fails rather than leave a package the build would fetch out of
+    the mirror. Updating the mirror again only downloads the packages
+    which changed, and removes those no longer needed.
+
+    """
+    def __init__(self, destdir, workdir, arch = None):
+        self.destdir = os.path.abspath(destdir)
+        """The directory the repository is written to."""
+        self.workdir = workdir
+        """A scratch directory the package lists are fetched into."""
+        self.arch = arch
+        self.lists_cache = None
+        """The host directory package lists are shared in, or None."""
+        self.mirror_selector = None
+
+        self.__apt = Apt()
+        self.__apt.setup(self.workdir, self.arch)
+
+    def addKickstart(self, ks, repo_urls = {}, required = []):
+        """Add the repositories and packages of the kickstart ks."""
+        self.__apt.mirror_selector = self.mirror_selector
+        for repo in kickstart.get_repos(ks, repo_urls):
+            (name, baseurl, mirrorlist, proxy, inc, exc) = repo
+            self.__apt.addRepository(baseurl, mirrorlist)
+        for pkg in kickstart.get_packages(ks, required):
+            self.__apt.selectPackage(pkg)
+
+    def __resolve(self):
+        installer = self.__apt.installer
+        installer.lists_cache = self.lists_cache
+        installer.setup()
+        resolvable = []
+        unresolved = []
+        for p in self.__apt.extrapkgs:
+            if installer.isResolvable(p):
+                resolvable.append(p)
+            elif installer.getProvider(p):
+                # as apt-get install in the install root would
+                resolvable.append(installer.getProvider(p))
+            else:
+                unresolved.append(p)
+        (req, base, alls) = installer.findPackages(resolvable)
+        unresolved += installer.unresolved
+        if unresolved:
+            raise CreatorError("Can't resolve %s; add the packages that "
+                               "should provide them to the kickstart, or "
+                               "with --package" % ", ".join(unresolved))
+        return alls
+
+    def __get_pool_path(self, candidate):
+        return os.path.join(CLOSURE_POOL,
+                            os.path.basename(candidate.filename))
+
+    def __is_current(self, candidate):
+        path = os.path.join(self.destdir, self.__get_pool_path(candidate))
+        if not os.path.exists(path) or \
+           os.path.getsize(path) != candidate.size:
+            return False
+        expected = getattr(candidate, "sha256", None)
+        return not expected or _get_digests(path)[2] == expected
+
+    def update(self):
+        """Bring the repository up to date with the upstream indexes.
+
+        Returns the number of packages downloaded.
+
+        """
+        installer = self.__apt.installer
+        alls = self.__resolve()
+        repocache = installer.repocache
+        candidates = dict([(p, repocache[p].candidate) for p in alls])
+
+        pooldir = os.path.join(self.destdir, CLOSURE_POOL)
+        makedirs(pooldir)
+        missing = [p for p in alls if not self.__is_current(candidates[p])]
+        logging.info("Mirroring %d packages, %d of them new" %
+                     (len(alls), len(missing)))
+
+        archives = self.workdir + "/var/cache/apt/archives/"
+        makedirs(archives)
+        pipeline = DownloadPipeline(installer.downloadPackage, missing)
+        try:
+            for batch in pipeline.arrived(missing):
+                for p in batch:
+                    name = os.path.basename(candidates[p].filename)
+                    shutil.move(archives + name, os.path.join(pooldir, name))
+        finally:
+            pipeline.close()
+
+        # prune what the closure no longer needs
+        wanted = set([os.path.basename(c.filename)
+                      for c in candidates.values()])
+        for name in os.listdir(pooldir):
+            if not name in wanted:
+                logging.info("Removing %s" % name)
+                os.unlink(os.path.join(pooldir, name))
+
+        self.__write_metadata(alls, candidates)
+        get_timing_report().note("closure mirror",
+                                 "%d packages, %d downloaded" %
+                                 (len(alls), len(missing)))
+        return len(missing)
+
+    def __write_metadata(self, alls, candidates):
+        stanzas = []
+        for p in sorted(alls):
+            candidate = candidates[p]
+            record = candidate.record
+            lines = []
+            for key in record.keys():
+                value = record[key]
+                if key == "Filename":
+                    value = self.__get_pool_path(candidate)
+                lines.append("%s: %s" % (key, value))
+            stanzas.append("\n".join(lines) + "\n")
+        packages = "\n".join(stanzas)
+
+        path = os.path.join(self.destdir, "Packages")
+        _write_file(path, packages)
+        f = gzip.open(path + ".gz.tmp", "wb")
+        try:
+            f.write(packages)
+        finally:
+            f.close()
+        os.rename(path + ".gz.tmp", path + ".gz")
+
+        sums = ([], [], [])
+        for name in ("Packages", "Packages.gz"):
+            size = os.path.getsize(os.path.join(self.destdir, name))
+            digests = _get_digests(os.path.join(self.destdir, name))
+            for (i, digest) in enumerate(digests):
+                sums[i].append(" %s %d %s" % (digest, size, name))
+        release = "Origin: imgcreate\n"
+        release += "Label: closure\n"
+        release += "Date: %s\n" % time.strftime("%a, %d %b %Y %H:%M:%S UTC",
+                                                time.gmtime())
+        if self.arch:
+            release += "Architectures: %s\n" % self.arch
+        for (field, lines) in zip(("MD5Sum", "SHA1", "SHA256"), sums):
+            release += "%s:\n%s\n" % (field, "\n".join(lines))
+        _write_file(os.path.join(self.destdir, "Release"), release)
+
+    def get_url(self):
+        """Return the URL builds install from the repository with."""
+        return "file://" + self.destdir
+
+    def cleanup(self):
+        logfile = getattr(self.__apt.installer, "logfile", None)
+        if logfile:
+            logfile.close()
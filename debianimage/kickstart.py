@@ -22,7 +22,6 @@ import shutil
 import subprocess
 import time
 import logging
-import urlgrabber
 #import selinux
 
 #try:
@@ -52,7 +51,11 @@ def read_kickstart(path):
     version = ksversion.makeVersion()
     ks = ksparser.KickstartParser(version)
     try:
-        ksfile = urlgrabber.urlgrab(path)
+        if "://" in path:
+            import urlgrabber
+            ksfile = urlgrabber.urlgrab(path)
+        else:
+            ksfile = path
         ks.readKickstart(ksfile)
 # Fallback to e.args[0] is a workaround for bugs in urlgragger and pykickstart.
     except IOError, e:
@@ -416,6 +419,7 @@ class SelinuxConfig(KickstartConfig):
         if not os.path.exists(self.path("/sbin/setfiles")):
             return
 
+        import selinux
         self.call(["/sbin/setfiles", "-p", "-e", "/proc", "-e", "/sys", "-e", "/dev", selinux.selinux_file_context_path(), "/"])
 
     def apply(self, ksselinux):
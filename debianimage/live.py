@@ -27,6 +27,7 @@ import re
 from imgcreate.errors import *
 from imgcreate.fs import *
 from imgcreate.live import *
+from imgcreate.taskgraph import *
 from debianimage.aptinst import *
 from debianimage import kickstart
 
@@ -84,6 +85,9 @@ class DebLiveImageCreatorBase(LiveImageCreatorBase):
 
         """
 
+        self.iso_digests = ISO_DIGESTS
+        """The digests written next to the ISO, e.g. NAME.iso.sha256."""
+
         self._timeout = kickstart.get_timeout(self.ks, 10)
         """The bootloader timeout from kickstart."""
 
@@ -126,6 +130,15 @@ class DebLiveImageCreatorBase(LiveImageCreatorBase):
     def setArch( self, arch=None ):
         self.arch = arch
 
+    def _get_repo_metadata_url(self, baseurl):
+        return get_release_url(baseurl)
+
+    def _get_phase_inputs(self, phase):
+        inputs = LiveImageCreatorBase._get_phase_inputs(self, phase)
+        if phase == "install" and inputs is not None:
+            inputs["arch"] = self.arch
+        return inputs
+
     def mount(self, base_on = None, cachedir = None):
         """Setup the target filesystem in preparation for an install.
 
@@ -138,10 +151,10 @@ class DebLiveImageCreatorBase(LiveImageCreatorBase):
         base_on -- a previous install on which to base this install; defaults
                    to None, causing a new image to be created
 
-        cachedir -- a directory in which to store the Yum cache; defaults to
-                    None, causing a new cache to be created; by setting this
-                    to another directory, the same cache can be reused across
-                    multiple installs.
+        cachedir -- a directory in which to share downloaded packages;
+                    defaults to None, causing nothing to be shared; by
+                    setting this to another directory, the same packages
+                    can be reused across multiple installs.
 
         """
 
@@ -150,6 +163,8 @@ class DebLiveImageCreatorBase(LiveImageCreatorBase):
         makedirs(self._instroot)
         makedirs(self._outdir)
 
+        if self.phase_done("install"):
+            base_on = None
         self._mount_instroot(base_on)
 
         for d in ("/dev/pts", "/etc", "/boot", "/var/log", "/sys", "/proc"):
@@ -157,6 +172,9 @@ class DebLiveImageCreatorBase(LiveImageCreatorBase):
 
 #        cachesrc = cachedir or (self.__builddir + "/yum-cache")
 #        makedirs(cachesrc)
+        if cachedir:
+            self.apt_archives_cache = os.path.join(os.path.abspath(cachedir),
+                                                   "archives")
 
         # bind mount system directories into _instroot
         for (f, dest) in [("/sys", None), ("/proc", None),
@@ -172,10 +190,13 @@ class DebLiveImageCreatorBase(LiveImageCreatorBase):
 
         self._ImageCreator__create_minimal_dev()
 
-        os.symlink("/proc/self/mounts", self._instroot + "/etc/mtab")
+        if not os.path.lexists(self._instroot + "/etc/mtab"):
+            os.symlink("/proc/self/mounts", self._instroot + "/etc/mtab")
 
         self._ImageCreator__write_fstab()
 
+        self._ImageCreator__setup_install_io()
+
     def __create_selinuxfs(self):
         pass
 
@@ -184,10 +205,15 @@ class DebLiveImageCreatorBase(LiveImageCreatorBase):
 
     def install(self, repo_urls = {}):
         aApt = Apt()
+        aApt.unsafe_io = self.unsafe_io
+        aApt.mirror_selector = self.mirror_selector
+        aApt.depsolve_cache = self.depsolve_cache
+        aApt.lists_cache = self.apt_lists_cache
+        aApt.archives_cache = self.apt_archives_cache
         aApt.setup( self._instroot, self.arch )
         for repo in kickstart.get_repos(self.ks, repo_urls):
             (name, baseurl, mirrorlist, proxy, inc, exc) = repo
-            aApt.addRepository( baseurl )
+            aApt.addRepository( baseurl, mirrorlist )
         
         for pkg in kickstart.get_packages(self.ks,
                                           self._get_required_packages()):
@@ -195,38 +221,23 @@ class DebLiveImageCreatorBase(LiveImageCreatorBase):
 
         aApt.runInstall()
 
-    def configure(self):
-        """Configure the system image according to the kickstart.
-
-        This method applies the (e.g. keyboard or network) configuration
-        specified in the kickstart and executes the kickstart %post scripts.
-
-        If neccessary, it also prepares the image to be bootable by e.g.
-        creating an initrd and bootloader configuration.
-
-        """
-        ksh = self.ks.handler
-
-        kickstart.LanguageConfig(self._instroot).apply(ksh.lang)
-        kickstart.KeyboardConfig(self._instroot).apply(ksh.keyboard)
-        kickstart.TimezoneConfig(self._instroot).apply(ksh.timezone)
-        kickstart.AuthConfig(self._instroot).apply(ksh.authconfig)
-        kickstart.FirewallConfig(self._instroot).apply(ksh.firewall)
-        kickstart.RootPasswordConfig(self._instroot).apply(ksh.rootpw)
-        kickstart.ServicesConfig(self._instroot).apply(ksh.services)
-        kickstart.XConfig(self._instroot).apply(ksh.xconfig)
-        kickstart.NetworkConfig(self._instroot).apply(ksh.network)
-#        kickstart.RPMMacroConfig(self._instroot).apply(self.ks)
-
-        self._create_bootconfig()
-
-        self._ImageCreator__run_post_scripts()
-#        kickstart.SelinuxConfig(self._instroot).apply(ksh.selinux)
+    def _get_configure_tasks(self):
+        # there are no rpm macros or SELinux labels in a Debian image
+        return [t for t in LiveImageCreatorBase._get_configure_tasks(self)
+                if not t[0] in ("rpm macros", "selinux")]
 
     def _create_bootconfig(self):
         """Configure the image so that it's bootable."""
         self._configure_bootloader(self.__ensure_isodir())
 
+    def _instroot_at_mastering(self):
+        # the ISO is mastered while the image is mounted to compress it
+        return self.loopless or not self.skip_compression
+
+    def _get_bootconfig_io(self):
+        # e.g. the mips creator builds the initramfs in the chroot
+        return (["instroot", "isodir"], ["instroot", "isodir"])
+
     def _mount_instroot(self, base_on = None):
 #        pass
         self.base_on = True
@@ -239,36 +250,78 @@ class DebLiveImageCreatorBase(LiveImageCreatorBase):
     def __ensure_isodir(self):
         if self.__isodir is None:
             self.__isodir = self._mkdtemp("iso-")
+            if not self.phase_done("configure"):
+                # configure writes the ISO tree from scratch; a resumed
+                # build may find what a failed configure left of it
+                clear_dir(self.__isodir)
         return self.__isodir
 
     def _stage_final_image(self):
+        image = None
+        done = False
+        mounts = []
         try:
             makedirs(self.__ensure_isodir() + "/live")
 
-            self._resparse()
-
-            if not self.skip_minimize:
-                pass
-
+            live = self.__isodir + "/live"
             if self.skip_compression:
-                shutil.move(self._image, self.__isodir + "/live/filesystem.ext3")
-                if os.stat(self.__isodir + "/live/filesystem.ext3").st_size >= 4*1024*1024*1024:
-                    self._isofstype = "udf"
-                    logging.warn("Switching to UDF due to size of live/filesystem.ext3")
+                image = live + "/filesystem.ext3"
+                staged = image
             else:
-                instloop = DiskMount( LoopbackDisk(self._image,0), self._instroot)
+                staged = live + "/filesystem.squashfs"
+
+            def move_image():
+                shutil.move(self._image, image)
+
+            def mount_image():
+                instloop = DiskMount(LoopbackDisk(self._image, 0),
+                                     self._instroot)
+                mounts.append(instloop)
                 instloop.mount()
-                mksquashfs(self._instroot,
-                           self.__isodir + "/live/filesystem.squashfs",
-                           self.compress_type)
-                if os.stat(self.__isodir + "/live/filesystem.squashfs").st_size >= 4*1024*1024*1024:
-                    self._isofstype = "udf"
-                    logging.warn("Switching to UDF due to size of live/filesystem.squashfs")
-                instloop.cleanup()
 
-            self.__create_iso(self.__isodir)
+            def compress():
+                mksquashfs(self._instroot, staged, self.compress_type)
+
+            def create_iso():
+                if os.stat(staged).st_size >= 4*1024*1024*1024:
+                    self._isofstype = "udf"
+                    logging.warn("Switching to UDF due to size of live/%s" %
+                                 os.path.basename(staged))
+                self.__create_iso(self.__isodir)
+
+            graph = TaskGraph("stage")
+            # a loopless install root can be compressed as it is, the
+            # filesystem image is only needed if it is shipped uncompressed
+            if self.skip_compression or not self.loopless:
+                graph.add("resparse", self._resparse,
+                          inputs = [self._image], outputs = [self._image])
+            if self.skip_compression:
+                graph.add("move image", move_image,
+                          inputs = [self._image],
+                          outputs = [self._image, image])
+            else:
+                if not self.loopless:
+                    graph.add("mount image", mount_image,
+                              inputs = [self._image], outputs = ["instroot"])
+                graph.add("mksquashfs", compress,
+                          inputs = ["instroot"], outputs = [staged],
+                          cpu = graph.cpu_budget, io = 1)
+            # the boot files are grafted from the install root, so the ISO
+            # is mastered before it is unmounted
+            graph.add("iso", create_iso,
+                      inputs = [staged, "isodir", "instroot"],
+                      outputs = [self._outdir])
+            try:
+                graph.run()
+            finally:
+                for instloop in mounts:
+                    instloop.cleanup()
+            done = True
         finally:
-            shutil.rmtree(self.__isodir, ignore_errors = True)
+            if not done and self.phase_done("configure"):
+                self._unstage_image(image, self.__isodir + "/live")
+            else:
+                shutil.rmtree(self.__isodir, ignore_errors = True)
             self.__isodir = None
 
     def __create_iso(self, isodir):
@@ -284,15 +337,12 @@ class DebLiveImageCreatorBase(LiveImageCreatorBase):
         if self._isofstype == "udf":
             args.append("-allow-limited-size")
 
-        args.append(isodir)
+        args.extend(self._get_iso_pathspecs(isodir))
 
         if subprocess.call(args) != 0:
             raise CreatorError("ISO creation failed!")
 
-        if os.path.exists("/usr/bin/isohybrid"):
-            subprocess.call(["/usr/bin/isohybrid", iso])
-
-#        self.__implant_md5sum(iso)
+        finalise_iso(iso, implant = False, digests = self.iso_digests)
 
 
 class x86DebLiveImageCreator(DebLiveImageCreatorBase):
@@ -341,9 +391,13 @@ class x86DebLiveImageCreator(DebLiveImageCreatorBase):
                 raise CreatorError("syslinux not installed : "
                                    "%s not found" % path)
 
-            shutil.copy(path, isodir + "/isolinux/")
+            if f == "isolinux.bin":
+                # genisoimage writes the boot info table into it
+                shutil.copy(path, isodir + "/isolinux/")
+            else:
+                self._graft(isodir, path, "isolinux/" + f)
 
-    def __copy_syslinux_background(self, isodest):
+    def __copy_syslinux_background(self, isodir, isopath):
         background_path = self._instroot + \
                           "/usr/share/anaconda/boot/syslinux-vesa-splash.jpg"
 
@@ -355,31 +409,31 @@ class x86DebLiveImageCreator(DebLiveImageCreatorBase):
             if not os.path.exists(background_path):
                 return False
 
-        shutil.copyfile(background_path, isodest)
+        self._graft(isodir, background_path, isopath)
 
         return True
 
     def __copy_kernel_and_initramfs(self, isodir, version, index):
         bootdir = self._instroot + "/boot"
 
-        shutil.copyfile(bootdir + "/vmlinuz-" + version,
-                        isodir + "/isolinux/vmlinuz" + index)
+        self._graft(isodir, bootdir + "/vmlinuz-" + version,
+                    "isolinux/vmlinuz" + index)
 
         isDracut = False
         if os.path.exists(bootdir + "/initramfs.img-" + version):
-            shutil.copyfile(bootdir + "/initramfs.img-" + version,
-                            isodir + "/isolinux/initrd" + index + ".img")
+            self._graft(isodir, bootdir + "/initramfs.img-" + version,
+                        "isolinux/initrd" + index + ".img")
             isDracut = True
         elif os.path.exists(bootdir + "/initrd.img-" + version):
-            shutil.copyfile(bootdir + "/initrd.img-" + version ,
-                            isodir + "/isolinux/initrd" + index + ".img")
+            self._graft(isodir, bootdir + "/initrd.img-" + version,
+                        "isolinux/initrd" + index + ".img")
         elif not self.base_on:
             logging.error("No initrd or initramfs found for %s" % (version,))
 
         is_xen = False
         if os.path.exists(bootdir + "/xen.gz-" + version[:-3]):
-            shutil.copyfile(bootdir + "/xen.gz-" + version[:-3],
-                            isodir + "/isolinux/xen" + index + ".gz")
+            self._graft(isodir, bootdir + "/xen.gz-" + version[:-3],
+                        "isolinux/xen" + index + ".gz")
             is_xen = True
 
         return (is_xen, isDracut)
@@ -537,7 +591,7 @@ menu separator
         if not memtest:
             return ""
 
-        shutil.copyfile(memtest[0], isodir + "/isolinux/memtest")
+        self._graft(isodir, memtest[0], "isolinux/memtest")
 
         return """label memtest
   menu label Run a ^memory test.
@@ -565,7 +619,7 @@ menu separator
                                    self.__find_syslinux_mboot())
 
         background = ""
-        if self.__copy_syslinux_background(isodir + "/isolinux/splash.jpg"):
+        if self.__copy_syslinux_background(isodir, "isolinux/splash.jpg"):
             background = "splash.jpg"
 
         cfg = self.__get_basic_syslinux_config(menu = menu,
@@ -647,7 +701,7 @@ hiddenmenu
 
         for index in range(0, 9):
             # we don't support xen kernels
-            if os.path.exists("%s/EFI/boot/xen%d.gz" %(isodir, index)):
+            if self._iso_exists(isodir, "EFI/boot/xen%d.gz" % index):
                 continue
             cfg += self.__get_efi_image_stanza(fslabel = self.fslabel,
                                                isofstype = "auto",
@@ -676,6 +730,7 @@ hiddenmenu
         for f in os.listdir(isodir + "/isolinux"):
             os.link("%s/isolinux/%s" %(isodir, f),
                     "%s/EFI/boot/%s" %(isodir, f))
+        self._link_grafts(isodir, "isolinux", "EFI/boot")
 
 
         cfg = self.__get_basic_efi_config(name = self.name,
@@ -687,13 +742,13 @@ hiddenmenu
         cfgf.close()
 
         # first gen mactel machines get the bootloader name wrong apparently
-        if rpmUtils.arch.getBaseArch() == "i386":
+        if get_base_arch() == "i386":
             os.link(isodir + "/EFI/boot/grub.efi", isodir + "/EFI/boot/boot.efi")
             os.link(isodir + "/EFI/boot/grub.conf", isodir + "/EFI/boot/boot.conf")
 
         # for most things, we want them named boot$efiarch
         efiarch = {"i386": "ia32", "x86_64": "x64"}
-        efiname = efiarch[rpmUtils.arch.getBaseArch()]
+        efiname = efiarch[get_base_arch()]
         os.rename(isodir + "/EFI/boot/grub.efi", isodir + "/EFI/boot/boot%s.efi" %(efiname,))
         os.link(isodir + "/EFI/boot/grub.conf", isodir + "/EFI/boot/boot%s.conf" %(efiname,))
 
@@ -702,6 +757,10 @@ hiddenmenu
         self._configure_syslinux_bootloader(isodir)
         self._configure_efi_bootloader(isodir)
 
+    def _get_bootconfig_io(self):
+        # the kernels and bootloader files go into the ISO tree
+        return (["instroot:/boot", "instroot:/usr"], ["isodir"])
+
 class mipsDebLiveImageCreator(DebLiveImageCreatorBase):
 
     def __init__(self, ks, name, fslabel=None, releasever=None, tmpdir="/tmp",
@@ -831,6 +890,10 @@ title  %(long)s
         except MountError, e:
             raise CreatorError("Failed to loopback mount '%s' : %s" %
                                (liveimg, e))
+        if self.resume_id and not self.phase_done("configure"):
+            # as for a plain ISO tree, see DebLiveImageCreatorBase; a new
+            # filesystem is left alone, with its lost+found
+            clear_dir(self.__isodir)
 
 
     def _unmount_instroot(self):
@@ -842,33 +905,63 @@ title  %(long)s
             self.__liveloop.cleanup()
 
     def _stage_final_image(self):
+        mounts = []
         try:
             makedirs(self.__ensure_isodir() + "/live")
 
-            self._resparse()
-
-            if not self.skip_minimize:
-                pass
-
+            live = self.__isodir + "/live"
             if self.skip_compression:
-                shutil.move(self._image, self.__isodir + "/live/filesystem.ext3")
-                if os.stat(self.__isodir + "/live/filesystem.ext3").st_size >= 4*1024*1024*1024:
-                    self._isofstype = "udf"
-                    logging.warn("Switching to UDF due to size of live/filesystem.ext3")
+                staged = live + "/filesystem.ext3"
             else:
-                instloop = DiskMount( LoopbackDisk(self._image,0), self._instroot)
+                staged = live + "/filesystem.squashfs"
+
+            def move_image():
+                shutil.move(self._image, staged)
+
+            def mount_image():
+                instloop = DiskMount(LoopbackDisk(self._image, 0),
+                                     self._instroot)
+                mounts.append(instloop)
                 instloop.mount()
-                mksquashfs(self._instroot,
-                           self.__isodir + "/live/filesystem.squashfs",
-                           self.compress_type)
-                if os.stat(self.__isodir + "/live/filesystem.squashfs").st_size >= 4*1024*1024*1024:
+
+            def compress():
+                try:
+                    mksquashfs(self._instroot, staged, self.compress_type)
+                finally:
+                    for instloop in mounts:
+                        instloop.cleanup()
+
+            def unmount_isoroot():
+                if os.stat(staged).st_size >= 4*1024*1024*1024:
                     self._isofstype = "udf"
-                    logging.warn("Switching to UDF due to size of live/filesystem.squashfs")
-                instloop.cleanup()
-            
-            self.__unmount_isoroot()
+                    logging.warn("Switching to UDF due to size of live/%s" %
+                                 os.path.basename(staged))
+                self.__unmount_isoroot()
+
+            graph = TaskGraph("stage")
+            # a loopless install root can be compressed as it is, the
+            # filesystem image is only needed if it is shipped uncompressed
+            if self.skip_compression or not self.loopless:
+                graph.add("resparse", self._resparse,
+                          inputs = [self._image], outputs = [self._image])
+            if self.skip_compression:
+                graph.add("move image", move_image,
+                          inputs = [self._image],
+                          outputs = [self._image, staged])
+            else:
+                if not self.loopless:
+                    graph.add("mount image", mount_image,
+                              inputs = [self._image], outputs = ["instroot"])
+                graph.add("mksquashfs", compress,
+                          inputs = ["instroot"], outputs = [staged],
+                          cpu = graph.cpu_budget, io = 1)
+            graph.add("unmount isoroot", unmount_isoroot,
+                      inputs = [staged, "isodir"], outputs = ["isodir"])
+            graph.run()
 
         finally:
+            for instloop in mounts:
+                instloop.cleanup()
             shutil.rmtree(self.__isodir, ignore_errors = True)
             self.__isodir = None
 
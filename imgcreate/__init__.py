@@ -18,10 +18,21 @@
 
 from imgcreate.live import *
 from imgcreate.creator import *
-from imgcreate.yuminst import *
 from imgcreate.kickstart import *
 from imgcreate.fs import *
 from imgcreate.debug import *
+from imgcreate.timing import *
+from imgcreate.loop import *
+from imgcreate.batch import *
+from imgcreate.taskgraph import *
+from imgcreate.daemon import *
+from imgcreate.checkpoint import *
+from imgcreate.phasecache import *
+from imgcreate.postscript import *
+from imgcreate.relabel import *
+from imgcreate.mirrors import *
+from imgcreate.depcache import *
+from imgcreate.iso import *
 
 """A set of classes for building Fedora system images.
 
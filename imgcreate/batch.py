@@ -0,0 +1,400 @@
+#
+# batch.py : Scheduling many image builds at once
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import os.path
+import re
+import glob
+import time
+import shlex
+import shutil
+import logging
+import subprocess
+
+from imgcreate.errors import *
+from imgcreate.fs import makedirs, get_mem_available
+
+BATCH_TOOLS = { "livecd"    : "livecd-creator",
+                "appliance" : "appliance-creator",
+                "installer" : "installer-creator" }
+"""The tool building each type of image."""
+
+BATCH_LOOP_DEVICES = { "livecd"    : 3,
+                       "appliance" : 2,
+                       "installer" : 3 + 1 }
+"""The loop devices a build of each type uses at most at once; an installer
+build runs a live CD build, and mounts its image to add the installed tree."""
+
+BATCH_INSTALLER_KS = "/usr/share/image-creator/config/install-livecd.ks"
+"""The kickstart of the live CD installer-creator puts the installed tree
+on."""
+
+def _get_ks_size(kscfg, default):
+    """Return the total size of the partitions in kscfg in bytes."""
+    size = 0L
+    try:
+        f = open(kscfg)
+        try:
+            for line in f:
+                m = re.match(r"\s*part\s.*--size[= ](\d+)", line)
+                if m:
+                    size += long(m.group(1)) * 1024 * 1024
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return size or default
+
+class BatchBuild(object):
+    """A single image build in a batch.
+
+    Each build runs its image type's tool in a process of its own, with its
+    own working directory, HOME and tmpdir, so builds can't see each other's
+    global state, e.g. rpm macros.
+
+    """
+    def __init__(self, name, image_type, kscfg, args = []):
+        if image_type not in BATCH_TOOLS:
+            raise CreatorError("Unknown image type '%s'" % image_type)
+
+        self.name = name
+        """A name for the build, unique within the batch."""
+        self.image_type = image_type
+        """The type of image built, one of the keys of BATCH_TOOLS."""
+        self.kscfg = os.path.abspath(kscfg)
+        """The kickstart the image is built from."""
+        self.args = list(args)
+        """Extra arguments for the tool."""
+
+        self.loop_devices = BATCH_LOOP_DEVICES[image_type]
+        """The loop devices the build needs."""
+        self.space = self.__estimate_space()
+        """The space in bytes the build needs in the tmpdir."""
+        self.memory = 1024L * 1024 * 1024
+        """The memory in bytes the build needs."""
+
+        self.queued = None
+        self.started = None
+        self.finished = None
+        self.returncode = None
+        self.process = None
+        self.tmpdir = None
+        self.outdir = None
+        self.logfile = None
+
+    def __estimate_space(self):
+        if self.image_type == "installer":
+            # the installed tree is cleaned up before the live CD is built
+            live = _get_ks_size(BATCH_INSTALLER_KS, 4096L * 1024 * 1024)
+            return max(4096L * 1024 * 1024, live * 3 / 2)
+        size = _get_ks_size(self.kscfg, 4096L * 1024 * 1024)
+        if self.image_type == "appliance":
+            # the raw disks, plus their converted copies
+            return size * 2
+        # the filesystem image, plus the packaged copy
+        return size * 3 / 2
+
+    def get_state(self):
+        if self.returncode is not None:
+            if self.returncode == 0:
+                return "done"
+            return "failed"
+        if self.process is not None:
+            return "running"
+        return "queued"
+    state = property(get_state)
+
+    def start(self, tool, tmpdir, outdir, cachedir):
+        """Start the build in a child process.
+
+        tool -- the path to the tool building the image.
+        tmpdir -- the directory below which the build keeps its build
+                  directory and HOME.
+        outdir -- the directory the image, and the build's log, ends up in.
+        cachedir -- the package cache shared by all builds; the Debian
+                    package lists and depsolve results are shared below it.
+
+        """
+        self.tmpdir = tmpdir
+        self.outdir = outdir
+        home = os.path.join(tmpdir, "home")
+        makedirs(home)
+        makedirs(outdir)
+
+        env = os.environ.copy()
+        env["HOME"] = home
+        env["TMPDIR"] = tmpdir
+
+        args = [tool, "--config", self.kscfg, "--tmpdir", tmpdir]
+        if cachedir:
+            args.extend(["--cache", cachedir,
+                         "--apt-lists-cache", os.path.join(cachedir, "apt-lists"),
+                         "--depsolve-cache", os.path.join(cachedir, "depsolve")])
+        args.extend(self.args)
+
+        logging.info("Starting build %s: %s" % (self.name, " ".join(args)))
+        self.logfile = open(os.path.join(outdir, self.name + ".log"), "w")
+        self.process = subprocess.Popen(args, cwd = outdir, env = env,
+                                        stdin = open("/dev/null"),
+                                        stdout = self.logfile,
+                                        stderr = subprocess.STDOUT,
+                                        close_fds = True)
+        self.started = time.time()
+
+    def poll(self):
+        """Return whether the build has finished."""
+        if self.process is None:
+            return self.returncode is not None
+        rc = self.process.poll()
+        if rc is None:
+            return False
+        self.finished = time.time()
+        self.returncode = rc
+        self.process = None
+        self.logfile.close()
+
+        # the tool removes its build directory itself; anything else left
+        # behind, e.g. mounts of a crashed build, is left for inspection
+        shutil.rmtree(os.path.join(self.tmpdir, "home"), ignore_errors = True)
+        try:
+            os.rmdir(self.tmpdir)
+        except OSError:
+            pass
+        logging.info("Build %s %s after %.1fs" %
+                     (self.name, self.state, self.finished - self.started))
+        return True
+
+class BatchScheduler(object):
+    """Runs a batch of builds concurrently, within resource limits.
+
+    A queued build is started once there are enough loop devices, space in
+    the tmpdir and memory left for it, and the load average is low enough.
+    Builds are started in the order they were added, one per poll, so the
+    load average has a chance to catch up with each new build.
+
+    """
+    def __init__(self, tmpdir, outdir, cachedir = None, tooldir = None):
+        self.tmpdir = os.path.abspath(tmpdir)
+        """The directory holding the build directories of all builds."""
+        self.outdir = os.path.abspath(outdir)
+        """The directory the images are placed in, one subdirectory per
+        build."""
+        self.cachedir = cachedir
+        """The package cache shared by all builds, or None for a private
+        cache per build."""
+        self.tooldir = tooldir
+        """The directory containing the tools, or None to search $PATH."""
+
+        self.max_jobs = None
+        """The maximum number of builds running at once, or None."""
+        self.max_loop_devices = None
+        """The number of loop devices the batch may use; defaults to the
+        devices free on the host when the batch starts."""
+        self.max_load = None
+        """The load average above which no builds are started; defaults to
+        the number of CPUs."""
+        self.min_free_space = 1024L * 1024 * 1024
+        """The space in bytes kept free in tmpdir."""
+        self.min_free_memory = 512L * 1024 * 1024
+        """The memory in bytes kept free."""
+        self.poll_interval = 5.0
+        """The seconds between checks for finished builds."""
+
+        self.__builds = []
+        self.__names = set()
+        self.__started = None
+        self.__finished = None
+        self.__peak = 0
+
+    def add(self, image_type, kscfg, args = []):
+        """Queue a build of kscfg as an image of image_type."""
+        base = "%s-%s" % (image_type,
+                          os.path.splitext(os.path.basename(kscfg))[0])
+        name = base
+        i = 1
+        while name in self.__names:
+            i += 1
+            name = "%s-%d" % (base, i)
+        self.__names.add(name)
+
+        build = BatchBuild(name, image_type, kscfg, args)
+        build.queued = time.time()
+        self.__builds.append(build)
+        return build
+
+    def __get_tool(self, build):
+        tool = BATCH_TOOLS[build.image_type]
+        if self.tooldir:
+            return os.path.join(self.tooldir, tool)
+        return tool
+
+    def __get_free_loop_devices(self):
+        used = len(glob.glob("/sys/block/loop*/loop/backing_file"))
+        try:
+            f = open("/sys/module/loop/parameters/max_loop")
+            try:
+                max_loop = int(f.read())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            max_loop = 0
+        if max_loop <= 0:
+            # devices are created on demand, up to the minor number limit
+            max_loop = max(len(glob.glob("/sys/block/loop*")), 256)
+        return max_loop - used
+
+    def __can_start(self, build, running):
+        """Return None if build can be started, or the reason it can't."""
+        if self.max_jobs and len(running) >= self.max_jobs:
+            return "%d builds running" % len(running)
+
+        loops = sum([b.loop_devices for b in running]) + build.loop_devices
+        if loops > self.max_loop_devices:
+            return "%d of %d loop devices needed" % (loops,
+                                                     self.max_loop_devices)
+
+        # running builds may not have grown to their full size yet
+        st = os.statvfs(self.tmpdir)
+        free = st.f_bavail * st.f_frsize
+        for b in running:
+            free -= b.space / 2
+        if free - build.space < self.min_free_space:
+            return "%d MB free in %s" % (free / (1024 * 1024), self.tmpdir)
+
+        if get_mem_available() - build.memory < self.min_free_memory:
+            return "not enough memory"
+
+        load = os.getloadavg()[0]
+        if running and load > self.max_load:
+            return "load average %.1f" % load
+
+        return None
+
+    def run(self):
+        """Run all queued builds and return whether they all succeeded."""
+        makedirs(self.tmpdir)
+        makedirs(self.outdir)
+        if self.cachedir:
+            makedirs(self.cachedir)
+        if self.max_loop_devices is None:
+            self.max_loop_devices = self.__get_free_loop_devices()
+        if self.max_load is None:
+            self.max_load = float(os.sysconf("SC_NPROCESSORS_ONLN"))
+
+        self.__started = time.time()
+        queued = list(self.__builds)
+        running = []
+        blocked = None
+        try:
+            while queued or running:
+                for build in running[:]:
+                    if build.poll():
+                        running.remove(build)
+
+                if queued:
+                    build = queued[0]
+                    reason = self.__can_start(build, running)
+                    if reason is None:
+                        queued.pop(0)
+                        build.start(self.__get_tool(build),
+                                    os.path.join(self.tmpdir, build.name),
+                                    os.path.join(self.outdir, build.name),
+                                    self.cachedir)
+                        running.append(build)
+                        self.__peak = max(self.__peak, len(running))
+                        blocked = None
+                    elif not running:
+                        # nothing will free up resources for it
+                        raise CreatorError("Can't start build %s: %s" %
+                                           (build.name, reason))
+                    elif reason != blocked:
+                        logging.info("Build %s waiting: %s" %
+                                     (build.name, reason))
+                        blocked = reason
+
+                if running:
+                    time.sleep(self.poll_interval)
+        finally:
+            for build in running:
+                if build.process is not None:
+                    logging.warn("Terminating build %s" % build.name)
+                    build.process.terminate()
+                    build.process.wait()
+                    build.poll()
+            self.__finished = time.time()
+
+        return not [b for b in self.__builds if b.returncode != 0]
+
+    def format_timeline(self, width = 60):
+        """Return the per-build and aggregate timeline as a string."""
+        start = self.__started or time.time()
+        end = self.__finished or time.time()
+        wall = max(end - start, 0.01)
+
+        lines = ["Batch timeline:"]
+        busy = 0.0
+        for b in self.__builds:
+            if b.started is None:
+                lines.append("  %-30s %-8s" % (b.name, b.state))
+                continue
+            finished = b.finished or end
+            busy += finished - b.started
+            first = int((b.started - start) / wall * width)
+            last = max(int((finished - start) / wall * width), first + 1)
+            bar = " " * first + "#" * (last - first)
+            lines.append("  %-30s %-8s |%-*s| waited %6.1fs, ran %7.1fs" %
+                         (b.name, b.state, width, bar,
+                          b.started - b.queued, finished - b.started))
+
+        failed = len([b for b in self.__builds if b.state == "failed"])
+        lines.append("  %d builds, %d failed, %.1fs wall clock, %.1fs build "
+                     "time, %.1fx concurrency, at most %d at once" %
+                     (len(self.__builds), failed, wall, busy, busy / wall,
+                      self.__peak))
+        return "\n".join(lines)
+
+def read_batch_list(path):
+    """Read a batch list file.
+
+    Each line lists an image type, a kickstart and optionally extra arguments
+    for the tool, e.g.
+
+      livecd  desktop.ks  --fslabel=Desktop
+      appliance  server.ks  --format=qcow2
+
+    Blank lines and lines starting with a # are ignored. A list of (type,
+    kickstart, args) tuples is returned; relative kickstart paths are
+    relative to the list file.
+
+    """
+    builds = []
+    f = open(path)
+    try:
+        for line in f:
+            fields = shlex.split(line, comments = True)
+            if not fields:
+                continue
+            if len(fields) < 2:
+                raise CreatorError("Invalid line in %s: %s" %
+                                   (path, line.strip()))
+            kscfg = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                 fields[1])
+            builds.append((fields[0], kscfg, fields[2:]))
+    finally:
+        f.close()
+    return builds
@@ -0,0 +1,189 @@
+#
+# checkpoint.py : Keeping the build directory of failed builds for resuming
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import glob
+import json
+import time
+import shutil
+import logging
+
+from imgcreate.errors import *
+from imgcreate.loop import BUILD_DIR_PREFIX, lock_build_dir, unlock_build_dir
+
+CHECKPOINT_JOURNAL = "checkpoint.json"
+"""The file in a build directory recording the phases the build completed."""
+
+CHECKPOINT_MAX_AGE = 7 * 24 * 60 * 60
+"""The age in seconds after which a checkpoint is removed by default."""
+
+CHECKPOINT_MAX_SIZE = 50L * 1024 * 1024 * 1024
+"""The space in bytes all checkpoints in a tmpdir may use by default."""
+
+def get_checkpoint_dir(tmpdir, build_id):
+    """Return the build directory of the build with build_id."""
+    return os.path.join(os.path.abspath(tmpdir), BUILD_DIR_PREFIX + build_id)
+
+def get_build_id(builddir):
+    """Return the id under which the build in builddir may be resumed."""
+    return os.path.basename(builddir)[len(BUILD_DIR_PREFIX):]
+
+class CheckpointJournal(object):
+    """The phases a build completed, and the directories it created.
+
+    The journal is kept in the build directory and rewritten after every
+    phase, so a build which failed can be resumed after the last phase it
+    completed, in the directories it used before.
+
+    """
+    def __init__(self, builddir, name = None):
+        self.builddir = builddir
+        """The build directory the journal is kept in."""
+        self.name = name
+        """The name of the image built."""
+        self.phases = []
+        """The phases completed, in order."""
+        self.dirs = {}
+        """The directories created by ImageCreator._mkdtemp(), by prefix."""
+        self.created = time.time()
+        self.updated = self.created
+
+    def __get_path(self):
+        return os.path.join(self.builddir, CHECKPOINT_JOURNAL)
+    path = property(__get_path)
+
+    def load(self):
+        try:
+            f = open(self.path)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            raise CreatorError("No checkpoint in %s : %s" % (self.builddir, e))
+
+        self.name = data["name"]
+        self.phases = data["phases"]
+        self.dirs = data["dirs"]
+        self.created = data["created"]
+        self.updated = data["updated"]
+
+    def save(self):
+        self.updated = time.time()
+        data = { "name" : self.name, "phases" : self.phases,
+                 "dirs" : self.dirs, "created" : self.created,
+                 "updated" : self.updated }
+
+        # never leave a half written journal behind
+        tmp = self.path + ".tmp"
+        f = open(tmp, "w")
+        try:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+    def add_phase(self, phase):
+        if not phase in self.phases:
+            self.phases.append(phase)
+        self.save()
+
+    def add_dir(self, prefix, path):
+        self.dirs.setdefault(prefix, []).append(path)
+        self.save()
+
+def _get_size(path):
+    size = 0L
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                # the images are sparse; count what they really use
+                size += os.lstat(os.path.join(dirpath, name)).st_blocks * 512L
+            except OSError:
+                pass
+    return size
+
+def _has_mounts(path):
+    f = open("/proc/self/mounts")
+    try:
+        for line in f:
+            mountpoint = line.split()[1].decode("string_escape")
+            if mountpoint.startswith(path + "/"):
+                return True
+    finally:
+        f.close()
+    return False
+
+def list_checkpoints(tmpdir):
+    """Return the checkpoints in tmpdir as (build id, journal, size) tuples.
+
+    Checkpoints of builds which are running, e.g. being resumed, are left
+    out.
+
+    """
+    checkpoints = []
+    for builddir in glob.glob(get_checkpoint_dir(tmpdir, "*")):
+        journal = CheckpointJournal(builddir)
+        try:
+            journal.load()
+        except CreatorError:
+            continue
+        try:
+            unlock_build_dir(lock_build_dir(builddir))
+        except CreatorError:
+            continue
+        checkpoints.append((get_build_id(builddir), journal,
+                            _get_size(builddir)))
+    return checkpoints
+
+def gc_checkpoints(tmpdir, max_age = CHECKPOINT_MAX_AGE,
+                   max_size = CHECKPOINT_MAX_SIZE):
+    """Remove stale checkpoints from tmpdir.
+
+    Checkpoints not updated for max_age seconds are removed, and then the
+    oldest ones until the rest use no more than max_size bytes.
+
+    """
+    checkpoints = list_checkpoints(tmpdir)
+    checkpoints.sort(key = lambda c: c[1].updated, reverse = True)
+    total = 0L
+    for (build_id, journal, size) in checkpoints:
+        total += size
+        if time.time() - journal.updated <= max_age and total <= max_size:
+            continue
+
+        # a build which died before unmounting everything
+        if _has_mounts(journal.builddir):
+            logging.warn("Not removing checkpoint %s, there are filesystems "
+                         "mounted in %s" % (build_id, journal.builddir))
+            continue
+
+        try:
+            # keep it from being resumed while it is removed
+            lock = lock_build_dir(journal.builddir)
+        except CreatorError:
+            continue
+        try:
+            logging.info("Removing checkpoint %s of %s, %d MB" %
+                         (build_id, journal.name, size / (1024 * 1024)))
+            shutil.rmtree(journal.builddir, ignore_errors = True)
+        finally:
+            unlock_build_dir(lock)
+        total -= size
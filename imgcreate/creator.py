@@ -21,22 +21,26 @@ import os.path
 import stat
 import sys
 import tempfile
+import time
 import shutil
 import logging
 import subprocess
 
-import selinux
-import yum
-import rpm
-
 from imgcreate.errors import *
 from imgcreate.fs import *
-from imgcreate.yuminst import *
+from imgcreate.taskgraph import *
+from imgcreate.checkpoint import *
+from imgcreate.phasecache import *
+from imgcreate.postscript import *
+from imgcreate.relabel import *
 from imgcreate import kickstart
 
 FSLABEL_MAXLEN = 32
 """The maximum string length supported for LoopImageCreator.fslabel."""
 
+RAM_BUILD_RESERVE = 1024L * 1024 * 1024
+"""The memory left to the build's processes when building in RAM."""
+
 class ImageCreator(object):
     """Installs a system to a chroot directory.
 
@@ -79,7 +83,137 @@ class ImageCreator(object):
             makedirs(self.tmpdir)
 
         self.__builddir = None
+        self.__builddir_lock = None
+        self.__builddir_tmpfs = None
+        self.__journal = None
+        self.__mkdtemp_counts = {}
+        self.__fingerprints = None
+        self.__relabel_manifest = None
         self.__bindmounts = []
+        self.__needs_sync = False
+
+        self.unsafe_io = False
+        """Controls whether packages are installed without syncing.
+
+        If set, dpkg doesn't fsync the files it installs; the install root is
+        synced once instead, before it is unmounted. The image is thrown away
+        if the build fails, so nothing is lost by this. rpm doesn't fsync the
+        files it installs anyway.
+
+        How much this saves depends on how expensive fsync is on the build
+        host; dpkg batches its syncs, so it may be next to nothing.
+        test/unsafe-io.py measures it.
+
+        """
+
+        self.ram_build = False
+        """Controls whether the build directory is kept in memory.
+
+        If set, and the memory available is enough for the footprint estimated
+        by _get_build_footprint(), a private tmpfs is mounted on the build
+        directory; otherwise the build falls back to tmpdir. The peak usage
+        of the tmpfs is noted in the timing report.
+
+        Note, this attribute may only be set before calling mount().
+
+        """
+
+        self.checkpoint = False
+        """Controls whether a failed build can be resumed.
+
+        If set, a journal of the phases completed with complete_phase() is
+        kept in the build directory, and the build directory is kept by
+        cleanup() if the build failed after completing a phase. The build can
+        then be resumed, by setting resume_id to its build_id, after the last
+        phase it completed. Checkpoints older than checkpoint_max_age, or
+        beyond checkpoint_max_size, are removed when a build is started.
+
+        Note, this attribute may only be set before calling mount().
+
+        """
+
+        self.resume_id = None
+        """The build_id of a checkpointed build to resume, or None.
+
+        The checkpoint is looked for in tmpdir; phase_done() tells which
+        phases it completed already.
+
+        Note, this attribute may only be set before calling mount().
+
+        """
+
+        self.checkpoint_max_age = CHECKPOINT_MAX_AGE
+        """The age in seconds after which checkpoints are removed."""
+
+        self.checkpoint_max_size = CHECKPOINT_MAX_SIZE
+        """The space in bytes the checkpoints in tmpdir may use."""
+
+        self.post_timeout = None
+        """The seconds after which a %post script is killed, or None.
+
+        A script may set a timeout of its own with a POST_DIRECTIVE line.
+
+        """
+
+        self.post_log_dir = None
+        """The directory the output of each %post script is logged to.
+
+        If None, the logs are kept in the build directory, and the end of
+        the log of a failed script is quoted in the error. The output is
+        logged at INFO as well, so it is shown on the console with
+        --verbose whether or not the logs are kept.
+
+        """
+
+        self.mirror_selector = None
+        """A MirrorSelector choosing the mirrors of mirrorlist repos, or None.
+
+        If set, the mirrors of a repo given by a mirrorlist are probed, and
+        the best of them are used in turn; otherwise the mirrors are used in
+        the order listed.
+
+        """
+
+        self.depsolve_cache = None
+        """A DepsolveCache the resolved package set is kept in, or None.
+
+        If set, a build selecting the same packages from the same repository
+        metadata into the same install root installs the packages resolved
+        before, without resolving their dependencies again.
+
+        """
+
+        self.apt_lists_cache = None
+        """The host directory Debian package lists are shared in, or None.
+
+        If set, builds from the same sources start from the lists fetched
+        before and only revalidate them, instead of fetching them afresh.
+
+        """
+
+        self.apt_archives_cache = None
+        """The host directory downloaded Debian packages are shared in, or None.
+
+        The Debian creators set it to the archives directory of the cachedir
+        passed to mount(). Packages are linked into the install root from it
+        rather than bind mounted, so that concurrent builds neither wait on
+        each other's apt locks nor lose the packages to apt-get clean.
+
+        """
+
+        self.phase_cache = None
+        """The directory in which phase outputs are cached, or None.
+
+        If set, the build directory is copied into this directory after each
+        of PHASE_CACHE_PHASES completes, under a fingerprint of the inputs
+        returned by _get_phase_inputs(). A later build starts from the
+        newest phase output whose fingerprint still matches, skipping the
+        phases up to it like a resumed build; the timing report notes which
+        phases were skipped, or why they ran.
+
+        Note, this attribute may only be set before calling mount().
+
+        """
 
         self.__sanity_check()
 
@@ -131,6 +265,17 @@ class ImageCreator(object):
 
     """
 
+    def __get_build_id(self):
+        if self.__builddir is None:
+            raise CreatorError("build_id is not valid before calling mount()")
+        return get_build_id(self.__builddir)
+    build_id = property(__get_build_id)
+    """The id with which a checkpoint of the build can be resumed.
+
+    Note, this is a read-only attribute.
+
+    """
+
     #
     # Hooks for subclasses
     #
@@ -170,13 +315,28 @@ class ImageCreator(object):
 
         This hook is called while the install root is still mounted, after the
         packages have been installed and the kickstart configuration has been
-        applied, but before the %post scripts have been executed.
+        applied, but before the %post scripts have been executed; unless it
+        only writes outside of the install root, see _get_configure_tasks().
 
         There is no default implementation.
 
         """
         pass
 
+    def _get_bootconfig_io(self):
+        """Return what _create_bootconfig() reads and writes.
+
+        This is the hook where subclasses may declare the resources, e.g.
+        "instroot:/boot" or "isodir", which their _create_bootconfig() reads
+        and writes, as an (inputs, outputs) tuple. This allows it to run at
+        the same time as the kickstart configuration is applied to
+        "instroot:/etc".
+
+        By default, it is assumed to read and write all of the install root.
+
+        """
+        return (["instroot"], ["instroot"])
+
     def _stage_final_image(self):
         """Stage the final system image in _outdir.
 
@@ -188,6 +348,91 @@ class ImageCreator(object):
         """
         shutil.move(self._instroot, self._outdir + "/" + self.name)
 
+    def _get_build_footprint(self):
+        """Return the peak size of the build directory in bytes.
+
+        This is the hook where subclasses may estimate how much space they
+        need in the build directory, so that a RAM backed build directory can
+        be sized accordingly.
+
+        This returns 4GiB by default.
+
+        """
+        return 4096L * 1024 * 1024
+
+    def _checkpoint_intact(self):
+        """Return whether the build can still be resumed.
+
+        This is the hook where subclasses may check that what the completed
+        phases produced, e.g. the filesystem image, was not consumed by a
+        phase which failed later on. A checkpoint is only kept if this
+        returns True.
+
+        By default, this checks that the install root is still there.
+
+        """
+        return os.path.isdir(self._instroot)
+
+    def _get_phase_inputs(self, phase):
+        """Return the inputs of phase, or None if they can't be told.
+
+        This is the hook where subclasses may add to what determines the
+        output of phase, e.g. the target architecture. The inputs are
+        returned as a dict of JSON serializable values; the output of a
+        phase is only reused for the same inputs.
+
+        By default, the package selection and the repository metadata are
+        the inputs of "install", and the kickstart configuration, bootloader
+        and %post scripts those of "configure".
+
+        Note, subclasses should usually chain up to the base class
+        implementation of this hook.
+
+        """
+        if phase == "install":
+            repos = []
+            for (name, baseurl, mirrorlist, proxy, inc, exc) in \
+                    kickstart.get_repos(self.ks):
+                url = baseurl and self._get_repo_metadata_url(baseurl)
+                digest = url and get_url_digest(url)
+                if not digest:
+                    logging.info("Can't fingerprint the metadata of repo "
+                                 "%s" % name)
+                    return None
+                repos.append([name, baseurl, inc, exc, digest])
+            return { "packages" : sorted(kickstart.get_packages(self.ks,
+                                             self._get_required_packages())),
+                     "groups" : sorted([str(g) for g in
+                                        kickstart.get_groups(self.ks)]),
+                     "excluded" : sorted(kickstart.get_excluded(self.ks,
+                                             self._get_excluded_packages())),
+                     "repos" : repos }
+
+        if phase == "configure":
+            ksh = self.ks.handler
+            inputs = {}
+            for command in ("lang", "keyboard", "timezone", "authconfig",
+                            "firewall", "rootpw", "services", "xconfig",
+                            "network", "selinux", "device", "bootloader"):
+                inputs[command] = str(getattr(ksh, command))
+            inputs["post"] = [str(s) for s in
+                              kickstart.get_post_scripts(self.ks)]
+            return inputs
+
+        return None
+
+    def _get_repo_metadata_url(self, baseurl):
+        """Return the location of the metadata of the repo at baseurl.
+
+        This is the hook where subclasses installing from other kinds of
+        repositories may tell where their metadata is found, so that a
+        change to a repository is noticed by _get_phase_inputs().
+
+        By default, the repomd.xml of a yum repository is returned.
+
+        """
+        return baseurl.rstrip("/") + "/repodata/repomd.xml"
+
     def _get_required_packages(self):
         """Return a list of required packages.
 
@@ -274,6 +519,7 @@ class ImageCreator(object):
                     version = f[14:]
             return version
 
+        import rpm
         ts = rpm.TransactionSet(self._instroot)
 
         ret = {}
@@ -348,7 +594,30 @@ class ImageCreator(object):
 
         """
         self.__ensure_builddir()
-        return tempfile.mkdtemp(dir = self.__builddir, prefix = prefix)
+
+        # a resumed build gets the directories it had before, in order
+        index = self.__mkdtemp_counts.get(prefix, 0)
+        self.__mkdtemp_counts[prefix] = index + 1
+        if self.__journal:
+            dirs = self.__journal.dirs.get(prefix, [])
+            if index < len(dirs) and os.path.isdir(dirs[index]):
+                return dirs[index]
+
+        path = tempfile.mkdtemp(dir = self.__builddir, prefix = prefix)
+        if self.__journal:
+            self.__journal.add_dir(prefix, path)
+        return path
+
+    def _get_checkpoint_dirs(self, prefix = "tmp-"):
+        """Return the directories _mkdtemp() created with prefix.
+
+        This is only known for builds which are checkpointed; an empty list
+        is returned otherwise.
+
+        """
+        if not self.__journal:
+            return []
+        return self.__journal.dirs.get(prefix, [])
 
     def _mkstemp(self, prefix = "tmp-"):
         """Create a temporary file.
@@ -398,13 +667,180 @@ class ImageCreator(object):
         if not self.__builddir is None:
             return
 
+        if self.resume_id:
+            self.__resume_builddir()
+        else:
+            self.__create_builddir()
+
+        if self.__journal:
+            gc_checkpoints(self.tmpdir, self.checkpoint_max_age,
+                           self.checkpoint_max_size)
+        get_loop_manager().reclaim_orphans()
+
+        if self.phase_cache and not self.resume_id:
+            self.__restore_phases()
+
+    def __create_builddir(self):
         try:
             self.__builddir = tempfile.mkdtemp(dir =  os.path.abspath(self.tmpdir),
-                                               prefix = "imgcreate-")
+                                               prefix = BUILD_DIR_PREFIX)
         except OSError, e:
             raise CreatorError("Failed create build directory in %s: %s" %
                                (self.tmpdir, e.strerror))
 
+        if self.ram_build and self.checkpoint:
+            logging.warn("A checkpoint can't be kept in RAM, using %s" %
+                         self.tmpdir)
+        elif self.ram_build:
+            self.__mount_ram_builddir()
+
+        # the lock tells other builds that our loop devices aren't orphans
+        self.__builddir_lock = lock_build_dir(self.__builddir)
+
+        if self.checkpoint or self.phase_cache:
+            self.__journal = CheckpointJournal(self.__builddir, self.name)
+            self.__journal.save()
+        if self.checkpoint:
+            logging.info("Checkpointing build as %s" % self.build_id)
+
+    def __resume_builddir(self):
+        builddir = get_checkpoint_dir(self.tmpdir, self.resume_id)
+        journal = CheckpointJournal(builddir)
+        journal.load()
+        if journal.name != self.name:
+            raise CreatorError("Checkpoint %s is of image %s, not of %s" %
+                               (self.resume_id, journal.name, self.name))
+
+        # fails if the checkpoint is being resumed already
+        self.__builddir_lock = lock_build_dir(builddir)
+        self.__builddir = builddir
+        self.__journal = journal
+        logging.info("Resuming build %s after %s" %
+                     (self.resume_id, ", ".join(journal.phases) or "nothing"))
+        get_timing_report().note("resumed after",
+                                 ", ".join(journal.phases) or "nothing")
+
+    def __get_fingerprints(self):
+        # (fingerprint, inputs) by phase; a phase whose inputs can't be
+        # told, or follows one, has no fingerprint
+        if self.__fingerprints is None:
+            self.__fingerprints = {}
+            parent = None
+            for phase in PHASE_CACHE_PHASES:
+                inputs = None
+                if parent is not None or phase == PHASE_CACHE_PHASES[0]:
+                    inputs = self._get_phase_inputs(phase)
+                if inputs is None:
+                    parent = None
+                    self.__fingerprints[phase] = (None, None)
+                    continue
+                parent = get_fingerprint(inputs, parent)
+                self.__fingerprints[phase] = (parent, inputs)
+        return self.__fingerprints
+
+    def __restore_phases(self):
+        cache = PhaseCache(self.phase_cache)
+        with get_timing_report().timed("fingerprint"):
+            fingerprints = self.__get_fingerprints()
+
+        restored = None
+        for phase in reversed(PHASE_CACHE_PHASES):
+            (fingerprint, inputs) = fingerprints[phase]
+            meta = fingerprint and cache.lookup(phase, fingerprint)
+            if meta and cache.restore(meta, self.__builddir, self.__journal):
+                restored = meta
+                break
+
+        parent = None
+        for phase in PHASE_CACHE_PHASES:
+            (fingerprint, inputs) = fingerprints[phase]
+            if restored and phase in restored["phases"]:
+                get_timing_report().record_saved(phase, restored["seconds"]
+                                                 if phase == restored["phase"]
+                                                 else None)
+                reason = "skipped, inputs unchanged since %s" % \
+                         time.ctime(restored["created"])
+            elif fingerprint is None:
+                reason = "run, inputs unknown"
+            else:
+                changes = cache.get_changes(phase, inputs, parent)
+                if changes is None:
+                    reason = "run, not cached before"
+                else:
+                    reason = "run, %s changed" % (", ".join(changes) or
+                                                  "nothing")
+            get_timing_report().note(phase, reason)
+            parent = fingerprint
+
+        if restored:
+            logging.info("Starting from the cached output of %s" %
+                         restored["phase"])
+
+    def __store_phase(self, phase):
+        (fingerprint, inputs) = self.__get_fingerprints()[phase]
+        if fingerprint is None:
+            return
+        cache = PhaseCache(self.phase_cache)
+        if cache.lookup(phase, fingerprint):
+            return
+
+        index = list(PHASE_CACHE_PHASES).index(phase)
+        parent = None
+        parent_phase = None
+        if index > 0:
+            parent_phase = PHASE_CACHE_PHASES[index - 1]
+            parent = self.__get_fingerprints()[parent_phase][0]
+
+        # a mounted filesystem image is only consistent while frozen
+        syncfs(self._instroot)
+        frozen = os.path.ismount(self._instroot) and \
+                 subprocess.call(["/sbin/fsfreeze", "--freeze",
+                                  self._instroot]) == 0
+        try:
+            with get_timing_report().timed("cache " + phase):
+                cache.store(self.__builddir, self.__journal, phase,
+                            fingerprint, inputs, parent, parent_phase,
+                            get_timing_report().get_total(phase),
+                            (BUILD_DIR_LOCK, CHECKPOINT_JOURNAL,
+                             "yum-cache", "out"))
+        except CreatorError, e:
+            logging.warn("Not caching the output of %s : %s" % (phase, e))
+        finally:
+            if frozen:
+                subprocess.call(["/sbin/fsfreeze", "--unfreeze",
+                                 self._instroot])
+
+    def __mount_ram_builddir(self):
+        size = self._get_build_footprint()
+        available = get_mem_available()
+        if available < size + RAM_BUILD_RESERVE:
+            logging.warn("Not enough memory to build in RAM (%d MB needed, "
+                         "%d MB available), using %s" %
+                         ((size + RAM_BUILD_RESERVE) / (1024 * 1024),
+                          available / (1024 * 1024), self.tmpdir))
+            get_timing_report().note("build dir", "disk, %d MB available" %
+                                     (available / (1024 * 1024)))
+            return
+
+        tmpfs = TmpfsMount(self.__builddir, size)
+        try:
+            tmpfs.mount()
+        except MountError, e:
+            logging.warn("%s, using %s" % (e, self.tmpdir))
+            return
+        self.__builddir_tmpfs = tmpfs
+
+    def __unmount_ram_builddir(self):
+        tmpfs = self.__builddir_tmpfs
+        tmpfs.unmount()
+        logging.info("Peak build directory usage: %d of %d MB" %
+                     (tmpfs.peak / (1024 * 1024), tmpfs.size / (1024 * 1024)))
+        get_timing_report().note("build dir",
+                                 "tmpfs, peak %d MB of %d MB estimated" %
+                                 (tmpfs.peak / (1024 * 1024),
+                                  tmpfs.size / (1024 * 1024)))
+        self.__builddir_tmpfs = None
+
     def __sanity_check(self):
         """Ensure that the config we've been given is sane."""
         if not (kickstart.get_packages(self.ks) or
@@ -445,13 +881,18 @@ class ImageCreator(object):
         os.umask(origumask)
 
     def __create_selinuxfs(self):
+        import selinux
         arglist = ["/bin/mount", "--bind", "/dev/null", self._instroot + self.__selinux_mountpoint + "/load"]
         subprocess.call(arglist, close_fds = True)
 
         if kickstart.selinux_enabled(self.ks):
-            # label the fs like it is a root before the bind mounting
-            arglist = ["/sbin/setfiles", "-F", "-r", self._instroot, selinux.selinux_file_context_path(), self._instroot]
-            subprocess.call(arglist, close_fds = True)
+            # label the fs like it is a root, with its own policy if it
+            # has one already, e.g. when based on another image
+            file_contexts = selinux.selinux_file_context_path()
+            if os.path.exists(self._instroot + file_contexts):
+                file_contexts = self._instroot + file_contexts
+            Relabeler(self._instroot, file_contexts,
+                      self.__get_relabel_manifest()).relabel()
             # these dumb things don't get magically fixed, so make the user generic
         # if selinux exists on the host we need to lie to the chroot
         if selinux.is_selinux_enabled():
@@ -459,6 +900,13 @@ class ImageCreator(object):
                 arglist = ["/usr/bin/chcon", "-u", "system_u", self._instroot + f]
                 subprocess.call(arglist, close_fds = True)
 
+    def __get_relabel_manifest(self):
+        # kept with the build, so that a resumed or cached build knows what
+        # it labeled before
+        if self.__relabel_manifest is None:
+            self.__relabel_manifest = self._mkdtemp("relabel-") + "/manifest"
+        return self.__relabel_manifest
+
     def __destroy_selinuxfs(self):
         # if the system was running selinux clean up our lies
         arglist = ["/bin/umount", self._instroot + self.__selinux_mountpoint + "/load"]
@@ -487,6 +935,9 @@ class ImageCreator(object):
         makedirs(self._instroot)
         makedirs(self._outdir)
 
+        if self.phase_done("install"):
+            # the image to base on was copied when the build started
+            base_on = None
         self._mount_instroot(base_on)
 
         for d in ("/dev/pts", "/etc", "/boot", "/var/log", "/var/cache/yum", "/sys", "/proc"):
@@ -511,10 +962,19 @@ class ImageCreator(object):
 
         self.__create_minimal_dev()
 
-        os.symlink("/proc/self/mounts", self._instroot + "/etc/mtab")
+        if not os.path.lexists(self._instroot + "/etc/mtab"):
+            os.symlink("/proc/self/mounts", self._instroot + "/etc/mtab")
 
         self.__write_fstab()
 
+        self.__setup_install_io()
+
+    def __setup_install_io(self):
+        # called by every mount(), once the install root is mounted
+        self.__needs_sync = self.unsafe_io
+        if self.unsafe_io:
+            get_timing_report().note("install I/O", "unsafe, synced once")
+
     def unmount(self):
         """Unmounts the target filesystem.
 
@@ -527,6 +987,11 @@ class ImageCreator(object):
 
         self._undo_bindmounts()
 
+        if self.__needs_sync:
+            with get_timing_report().timed("syncfs"):
+                syncfs(self._instroot)
+            self.__needs_sync = False
+
         self._unmount_instroot()
 
     def cleanup(self):
@@ -551,26 +1016,81 @@ class ImageCreator(object):
 
         self.unmount()
 
-        shutil.rmtree(self.__builddir, ignore_errors = True)
+        stats = get_loop_manager().get_stats()
+        if stats["attaches"]:
+            get_timing_report().note("loop devices",
+                                     "%(attaches)d attached, %(peak)d at once, "
+                                     "%(races)d races, %(orphans)d reclaimed, "
+                                     "%(host_in_use)d of %(host_devices)d in "
+                                     "use on host" % stats)
+
+        keep = self.__keep_checkpoint()
+
+        unlock_build_dir(self.__builddir_lock)
+        if self.__builddir_tmpfs:
+            self.__unmount_ram_builddir()
+        if not keep:
+            shutil.rmtree(self.__builddir, ignore_errors = True)
         self.__builddir = None
+        self.__builddir_lock = None
+        self.__journal = None
+        self.__fingerprints = None
+        self.__relabel_manifest = None
+
+    def __keep_checkpoint(self):
+        journal = self.__journal
+        if not self.checkpoint:
+            return False
+        if not journal or not journal.phases or "package" in journal.phases:
+            return False
+        if not self._checkpoint_intact():
+            logging.warn("Not keeping checkpoint %s, the build was partly "
+                         "packaged" % self.build_id)
+            return False
+        logging.warn("Kept checkpoint %s of the build after %s" %
+                     (self.build_id, ", ".join(journal.phases)))
+        return True
+
+    def phase_done(self, phase):
+        """Return whether the build completed phase before.
+
+        This is True for the phases a resumed build completed before it was
+        checkpointed, e.g. "install" or "configure", which needn't be run
+        again.
+
+        """
+        return self.__journal is not None and phase in self.__journal.phases
+
+    def complete_phase(self, phase):
+        """Record that the build completed phase.
+
+        If the build is checkpointed, this is recorded in its journal; a
+        build resumed later on continues after the phases recorded. Once
+        "package" is completed, the checkpoint is no longer kept.
+
+        If phase_cache is set, the output of the phase is cached.
+
+        """
+        if self.__journal:
+            self.__journal.add_phase(phase)
+        if self.phase_cache and phase in PHASE_CACHE_PHASES:
+            self.__store_phase(phase)
 
     def __select_packages(self, ayum):
         skipped_pkgs = []
-        for pkg in kickstart.get_packages(self.ks,
-                                          self._get_required_packages()):
-            try:
-                ayum.selectPackage(pkg)
-            except yum.Errors.InstallError, e:
-                if kickstart.ignore_missing(self.ks):
-                    skipped_pkgs.append(pkg)
-                else:
-                    raise CreatorError("Failed to find package '%s' : %s" %
-                                       (pkg, e))
+        for (pkg, e) in ayum.selectPackages(kickstart.get_packages(self.ks,
+                                             self._get_required_packages())):
+            if kickstart.ignore_missing(self.ks):
+                skipped_pkgs.append(pkg)
+            else:
+                raise CreatorError("Failed to find package '%s' : %s" %
+                                   (pkg, e))
 
         for pkg in skipped_pkgs:
             logging.warn("Skipping missing package '%s'" % (pkg,))
 
     def __select_groups(self, ayum):
+        import yum
         skipped_groups = []
         for group in kickstart.get_groups(self.ks):
             try:
@@ -586,13 +1106,13 @@ class ImageCreator(object):
             logging.warn("Skipping missing group '%s'" % (group.name,))
 
     def __deselect_packages(self, ayum):
-        for pkg in kickstart.get_excluded(self.ks,
-                                          self._get_excluded_packages()):
-            ayum.deselectPackage(pkg)
+        ayum.deselectPackages(kickstart.get_excluded(self.ks,
+                                             self._get_excluded_packages()))
 
     # if the system is running selinux and the kickstart wants it disabled
     # we need /usr/sbin/lokkit
     def __can_handle_selinux(self, ayum):
+        import selinux
         file = "/usr/sbin/lokkit"
         if not kickstart.selinux_enabled(self.ks) and selinux.is_selinux_enabled() and not ayum.installHasFile(file):
             raise CreatorError("Unable to disable SELinux because the installed package set did not include the file %s" % (file))
@@ -609,9 +1129,16 @@ class ImageCreator(object):
                      the kickstart to be overridden.
 
         """
+        # yum and rpm are only needed, and only imported, for installing
+        import yum
+        import rpm
+        from imgcreate.yuminst import LiveCDYum
+
         yum_conf = self._mktemp(prefix = "yum.conf-")
 
         ayum = LiveCDYum(releasever=self.releasever)
+        ayum.mirror_selector = self.mirror_selector
+        ayum.depsolve_cache = self.depsolve_cache
         ayum.setup(yum_conf, self._instroot)
 
         for repo in kickstart.get_repos(self.ks, repo_urls):
@@ -625,6 +1152,11 @@ class ImageCreator(object):
             if proxy:
                 yr.proxy = proxy
 
+        try:
+            ayum.setupRepositories()
+        except yum.Errors.RepoError, e:
+            raise CreatorError("Unable to download from repo : %s" % (e,))
+
         if kickstart.exclude_docs(self.ks):
             rpm.addMacro("_excludedocs", "1")
         if not kickstart.selinux_enabled(self.ks):
@@ -659,37 +1191,41 @@ class ImageCreator(object):
                 pass
 
     def __run_post_scripts(self):
-        for s in kickstart.get_post_scripts(self.ks):
-            (fd, path) = tempfile.mkstemp(prefix = "ks-script-",
-                                          dir = self._instroot + "/tmp")
-
-            os.write(fd, s.script)
-            os.close(fd)
-            os.chmod(path, 0700)
+        logdir = self.post_log_dir or self._mkdtemp("post-logs-")
+        makedirs(logdir)
+        scripts = []
+        paths = []
+        try:
+            for (index, ks) in enumerate(kickstart.get_post_scripts(self.ks)):
+                (fd, path) = tempfile.mkstemp(prefix = "ks-script-",
+                                              dir = self._instroot + "/tmp")
 
-            env = self._get_post_scripts_env(s.inChroot)
+                paths.append(path)
+                os.write(fd, ks.script)
+                os.close(fd)
+                os.chmod(path, 0700)
 
-            if not s.inChroot:
-                env["INSTALL_ROOT"] = self._instroot
-                preexec = None
-                script = path
-            else:
-                preexec = self._chroot
-                script = "/tmp/" + os.path.basename(path)
-
-            try:
-                subprocess.check_call([s.interp, script],
-                                      preexec_fn = preexec, env = env)
-            except OSError, e:
-                raise CreatorError("Failed to execute %%post script "
-                                   "with '%s' : %s" % (s.interp, e.strerror))
-            except subprocess.CalledProcessError, err:
-                if s.errorOnFail:
-                    raise CreatorError("%%post script failed with code %d "
-                                       % err.returncode)
-                logging.warning("ignoring %%post failure (code %d)"
-                                % err.returncode)
-            finally:
+                if not ks.inChroot:
+                    script = path
+                else:
+                    script = "/tmp/" + os.path.basename(path)
+
+                (timeout, independent) = parse_post_directives(ks.script)
+                s = PostScript(index + 1, [ks.interp, script],
+                               "%s/post-%d.log" % (logdir, index + 1),
+                               ks.inChroot, ks.errorOnFail,
+                               timeout or self.post_timeout, independent)
+                scripts.append(s)
+
+            def get_env(s):
+                env = self._get_post_scripts_env(s.in_chroot)
+                if not s.in_chroot:
+                    env["INSTALL_ROOT"] = self._instroot
+                return env
+
+            PostScriptRunner(self._chroot).run(scripts, get_env)
+        finally:
+            for path in paths:
                 os.unlink(path)
 
     def configure(self):
@@ -702,6 +1238,47 @@ class ImageCreator(object):
         creating an initrd and bootloader configuration.
 
         """
+        graph = TaskGraph("configure")
+        for (name, func, inputs, outputs) in self._get_configure_tasks():
+            graph.add(name, func, inputs, outputs)
+        graph.run()
+
+    def _get_configure_tasks(self):
+        """Return the steps of configure().
+
+        This is the hook where subclasses may add or leave out steps of the
+        configuration. The steps are (name, func, inputs, outputs) tuples, in
+        the order they run one after the other; configure() runs them as a
+        TaskGraph, so that steps whose inputs and outputs don't overlap run at
+        the same time.
+
+        The boot configuration is always created before the %post scripts,
+        which may remove or regenerate what it is made from, e.g. the
+        initramfs. Without %post scripts, a boot configuration which only
+        writes outside of the install root is created at the same time as
+        the SELinux relabel.
+
+        """
+        (inputs, outputs) = self._get_bootconfig_io()
+        scripts = kickstart.get_post_scripts(self.ks)
+        tasks = [("kickstart config", self.__apply_kickstart_config,
+                  ["instroot"], ["instroot:/etc"]),
+                 ("rpm macros", self.__apply_rpm_macros,
+                  ["instroot"], ["instroot:/etc/rpm"]),
+                 ("bootconfig", self._create_bootconfig, inputs, outputs)]
+        if [s for s in scripts if not s.inChroot]:
+            # nochroot scripts may write anywhere, e.g. to the ISO tree
+            tasks.append(("post", self.__run_post_scripts,
+                          ["instroot", "isodir"], ["instroot", "isodir"]))
+        elif scripts:
+            tasks.append(("post", self.__run_post_scripts,
+                          ["instroot"], ["instroot"]))
+        # the relabel only changes the labels of the files it reads
+        tasks.append(("selinux", self.__apply_selinux_config,
+                      ["instroot"], ["instroot:/etc", "instroot-labels"]))
+        return tasks
+
+    def __apply_kickstart_config(self):
         ksh = self.ks.handler
 
         kickstart.LanguageConfig(self._instroot).apply(ksh.lang)
@@ -713,12 +1290,14 @@ class ImageCreator(object):
         kickstart.ServicesConfig(self._instroot).apply(ksh.services)
         kickstart.XConfig(self._instroot).apply(ksh.xconfig)
         kickstart.NetworkConfig(self._instroot).apply(ksh.network)
-        kickstart.RPMMacroConfig(self._instroot).apply(self.ks)
 
-        self._create_bootconfig()
+    def __apply_rpm_macros(self):
+        kickstart.RPMMacroConfig(self._instroot).apply(self.ks)
 
-        self.__run_post_scripts()
-        kickstart.SelinuxConfig(self._instroot).apply(ksh.selinux)
+    def __apply_selinux_config(self):
+        kickstart.SelinuxConfig(self._instroot,
+                                self.__get_relabel_manifest()).apply(
+                                    self.ks.handler.selinux)
 
     def launch_shell(self):
         """Launch a shell in the install root.
@@ -794,6 +1373,31 @@ class LoopImageCreator(ImageCreator):
         self.__image_size = kickstart.get_image_size(self.ks,
                                                      4096L * 1024 * 1024)
 
+        self.loopless = False
+        """Controls whether the system is installed into a plain directory.
+
+        In loopless mode, no loop device is attached and nothing is mounted
+        while building. Instead, the filesystem image is created from the
+        install root with mke2fs -d when the image is staged, sized to fit the
+        installed tree plus loopless_headroom.
+
+        Note, this attribute may only be set before calling mount().
+
+        """
+
+        self.loopless_headroom = 0.1
+        """The spare room given to a loopless image, as a fraction of the
+        space taken up by the installed tree."""
+
+        self.fast_build = False
+        """Controls whether the image is mounted with the fast I/O profile.
+
+        See ExtDiskMount.fast_build; the final image is the same either way.
+
+        Note, this attribute may only be set before calling mount().
+
+        """
+
     #
     # Properties
     #
@@ -893,11 +1497,37 @@ class LoopImageCreator(ImageCreator):
                 causing the original size specified by the kickstart file to
                 be used (or 4GiB if not specified in the kickstart).
 
+        In loopless mode, this is where the image is created from the install
+        root; it is then sized to fit the installed tree unless size is given.
+
         """
+        if self.loopless:
+            return ExtDirectoryImage(self._image, self._instroot,
+                                     self.__fstype, self.__blocksize,
+                                     self.fslabel,
+                                     self.loopless_headroom).create(size)
         return self.__instloop.resparse(size)
 
     def _base_on(self, base_on):
         shutil.copyfile(base_on, self._image)
+
+    def _get_build_footprint(self):
+        # the image may fill up, and its packaged form needs room as well
+        return self.__image_size * 3 / 2
+
+    def _checkpoint_intact(self):
+        if self.loopless:
+            return ImageCreator._checkpoint_intact(self)
+        return os.path.exists(self._image)
+
+    def _get_phase_inputs(self, phase):
+        inputs = ImageCreator._get_phase_inputs(self, phase)
+        if phase == "install" and inputs is not None:
+            # an image is only mounted again the way it was created
+            inputs["image"] = [self.__fstype, self.__blocksize,
+                               self.__image_size, self.fslabel,
+                               self.loopless, self.fast_build]
+        return inputs
         
     #
     # Actual implementation
@@ -905,8 +1535,17 @@ class LoopImageCreator(ImageCreator):
     def _mount_instroot(self, base_on = None):
         self.__imgdir = self._mkdtemp()
 
+        if self.loopless:
+            if not base_on is None:
+                raise CreatorError("Basing an image on another one is not "
+                                   "supported in loopless mode")
+            return
+
         if not base_on is None:
             self._base_on(base_on)
+        elif self.phase_done("install") and not os.path.exists(self._image):
+            raise CreatorError("The image of checkpoint %s is missing" %
+                               self.build_id)
 
         self.__instloop = ExtDiskMount(SparseLoopbackDisk(self._image,
                                                           self.__image_size),
@@ -915,6 +1554,9 @@ class LoopImageCreator(ImageCreator):
                                        self.__blocksize,
                                        self.fslabel,
                                        self.tmpdir)
+        self.__instloop.fast_build = self.fast_build
+        if self.fast_build:
+            get_timing_report().note("I/O profile", "fast build")
 
         try:
             self.__instloop.mount()
@@ -0,0 +1,496 @@
+#
+# daemon.py : A build daemon keeping caches warm between builds
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import imp
+import json
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import struct
+import logging
+import traceback
+
+from imgcreate.errors import *
+from imgcreate.batch import BATCH_TOOLS
+
+DAEMON_SOCKET = "/var/run/imgcreate.sock"
+"""The socket a build daemon listens on by default."""
+
+DAEMON_ENV = "IMGCREATE_NO_DAEMON"
+"""Set in the environment to stop the tools submitting to a build daemon;
+the daemon sets it for the builds it runs."""
+
+DAEMON_PRELOAD = ["yum", "rpm", "selinux", "apt", "apt_pkg",
+                  "pykickstart.parser", "pykickstart.version",
+                  "urlgrabber", "urlgrabber.progress"]
+"""The modules a build daemon imports before accepting builds."""
+
+_SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+def _send(sock, event, **fields):
+    fields["event"] = event
+    sock.sendall(json.dumps(fields) + "\n")
+
+def daemon_available(path = DAEMON_SOCKET):
+    """Return whether a build daemon is listening on path."""
+    if os.environ.get(DAEMON_ENV):
+        return False
+    if not os.path.exists(path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            return False
+    finally:
+        sock.close()
+    return True
+
+def submit_build(tool, args, path = DAEMON_SOCKET):
+    """Run a build with a build daemon and return its exit code.
+
+    The build's output is written to stdout and stderr as it arrives.
+    Interrupting the submission interrupts the build.
+
+    tool -- the name of the tool running the build, e.g. "livecd-creator".
+    args -- the arguments for the tool.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+            _send(sock, "build", tool = tool, args = args, cwd = os.getcwd(),
+                  env = dict(os.environ))
+        except socket.error, e:
+            raise CreatorError("Failed to submit build to %s : %s" %
+                               (path, e))
+
+        f = sock.makefile("r")
+        for line in f:
+            event = json.loads(line)
+            if event["event"] == "output":
+                if event["stream"] == "stdout":
+                    out = sys.stdout
+                else:
+                    out = sys.stderr
+                out.write(event["data"].encode("utf-8"))
+                out.flush()
+            elif event["event"] == "queued":
+                logging.info("Build queued behind %d others" %
+                             event["position"])
+            elif event["event"] == "started":
+                logging.debug("Build started as pid %d" % event["pid"])
+            elif event["event"] == "finished":
+                return event["returncode"]
+            elif event["event"] == "error":
+                raise CreatorError(event["message"])
+        raise CreatorError("Build daemon closed the connection")
+    finally:
+        sock.close()
+
+def get_daemon_status(path = DAEMON_SOCKET):
+    """Return the builds a build daemon is running and has queued."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+            _send(sock, "status")
+            line = sock.makefile("r").readline()
+        except socket.error, e:
+            raise CreatorError("Failed to query %s : %s" % (path, e))
+    finally:
+        sock.close()
+    if not line:
+        raise CreatorError("Build daemon closed the connection")
+    return json.loads(line)["builds"]
+
+class _Job(object):
+    def __init__(self, conn, request):
+        self.conn = conn
+        self.tool = request["tool"]
+        self.args = [str(a) for a in request.get("args", [])]
+        self.cwd = request.get("cwd", "/")
+        self.env = dict([(str(k), str(v))
+                         for (k, v) in request.get("env", {}).items()])
+        self.queued = time.time()
+        self.started = None
+        self.pid = None
+        self.pipes = {}
+        self.status = None
+        self.gone = False
+
+class BuildDaemon(object):
+    """Runs builds submitted over a Unix socket, keeping caches warm.
+
+    Importing yum, rpm, apt and pykickstart, and loading repository metadata,
+    is done once, in the daemon; each build runs in a child forked from it, so
+    it starts with all of that already in memory, and can't disturb the
+    daemon or other builds.
+
+    Clients send one JSON request per connection. {"event": "build", "tool":
+    ..., "args": [...], "cwd": ..., "env": {...}} runs a tool as if it were
+    run in cwd with env, and is answered with "queued", "started", "output"
+    and finally "finished" events, one JSON object per line. {"event":
+    "status"} is answered with the builds running and queued. Closing the
+    connection interrupts the build.
+
+    Only root may submit builds.
+
+    """
+    def __init__(self, path = DAEMON_SOCKET, tooldir = None):
+        self.path = path
+        """The socket to listen on."""
+        self.tooldir = tooldir
+        """The directory containing the tools."""
+
+        self.max_jobs = None
+        """The maximum number of builds running at once, or None."""
+        self.preload = list(DAEMON_PRELOAD)
+        """The modules to import before accepting builds."""
+        self.warmers = []
+        """Callables run at startup and whenever no build is running, to
+        load or refresh what builds inherit, e.g. package metadata."""
+        self.env = {}
+        """Variables added to the environment of every build."""
+
+        self.__sock = None
+        self.__clients = {}
+        self.__queue = []
+        self.__running = {}
+        self.__stop = False
+        self.__warm_due = False
+
+    def warm(self):
+        """Import the preloaded modules and run the warmers."""
+        start = time.time()
+        for name in self.preload:
+            try:
+                __import__(name)
+            except ImportError, e:
+                logging.debug("Not preloading %s : %s" % (name, e))
+        self.__run_warmers()
+        logging.info("Warmed up in %.1fs" % (time.time() - start))
+
+    def __run_warmers(self):
+        for warmer in self.warmers:
+            try:
+                warmer()
+            except Exception, e:
+                logging.warn("Failed to warm caches : %s" % e)
+
+    def __listen(self):
+        if os.path.exists(self.path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                try:
+                    sock.connect(self.path)
+                except socket.error:
+                    # left behind by a daemon which died
+                    os.unlink(self.path)
+                else:
+                    raise CreatorError("A build daemon is already "
+                                       "listening on %s" % self.path)
+            finally:
+                sock.close()
+
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        fcntl.fcntl(self.__sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        old = os.umask(0077)
+        try:
+            self.__sock.bind(self.path)
+        finally:
+            os.umask(old)
+        self.__sock.listen(16)
+
+    def stop(self, *args):
+        """Stop accepting builds; running builds are interrupted."""
+        self.__stop = True
+
+    def serve(self):
+        """Accept and run builds until stop() is called."""
+        self.__listen()
+        old_term = signal.signal(signal.SIGTERM, self.stop)
+        logging.info("Listening on %s" % self.path)
+        try:
+            try:
+                while not self.__stop:
+                    self.__poll()
+            except KeyboardInterrupt:
+                pass
+        finally:
+            signal.signal(signal.SIGTERM, old_term)
+            self.__shutdown()
+
+    def __shutdown(self):
+        for job in self.__running.values():
+            self.__interrupt(job)
+        while self.__running:
+            self.__poll(accept = False)
+        for job in self.__queue:
+            self.__close(job.conn)
+        for conn in self.__clients.keys():
+            self.__close(conn)
+        self.__sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def __poll(self, accept = True):
+        rlist = []
+        timeout = 1.0
+        if accept:
+            rlist.append(self.__sock)
+            rlist.extend(self.__clients.keys())
+        for job in self.__running.values():
+            rlist.extend(job.pipes.keys())
+            if not job.gone:
+                rlist.append(job.conn)
+            if not job.pipes:
+                # only waiting for it to exit
+                timeout = 0.1
+
+        try:
+            (ready, _, _) = select.select(rlist, [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+
+        for r in ready:
+            if r is self.__sock:
+                self.__accept()
+            elif r in self.__clients:
+                self.__read_request(r)
+            else:
+                self.__read_job(r)
+
+        self.__reap()
+        if accept:
+            self.__start_queued()
+
+    def __accept(self):
+        (conn, addr) = self.__sock.accept()
+        fcntl.fcntl(conn.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        creds = conn.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED,
+                                struct.calcsize("3i"))
+        (pid, uid, gid) = struct.unpack("3i", creds)
+        if uid != 0:
+            self.__error(conn, "Only root may submit builds")
+            return
+        self.__clients[conn] = ""
+
+    def __read_request(self, conn):
+        data = conn.recv(65536)
+        if not data:
+            self.__close(conn)
+            return
+        buf = self.__clients[conn] + data
+        if not "\n" in buf:
+            self.__clients[conn] = buf
+            return
+        del self.__clients[conn]
+
+        try:
+            request = json.loads(buf.split("\n", 1)[0])
+        except ValueError:
+            self.__error(conn, "Invalid request")
+            return
+
+        if request.get("event") == "status":
+            self.__send(conn, "status", builds = self.__get_status())
+            self.__close(conn)
+        elif request.get("event") == "build":
+            if request.get("tool") not in BATCH_TOOLS.values():
+                self.__error(conn, "Unknown tool '%s'" % request.get("tool"))
+                return
+            job = _Job(conn, request)
+            self.__queue.append(job)
+            if self.__queue[0] is not job or not self.__can_start():
+                self.__send(conn, "queued", position = len(self.__queue) - 1)
+        else:
+            self.__error(conn, "Unknown request '%s'" % request.get("event"))
+
+    def __get_status(self):
+        builds = []
+        for job in self.__running.values():
+            builds.append({ "tool" : job.tool, "args" : job.args,
+                            "state" : "running", "pid" : job.pid,
+                            "time" : time.time() - job.started })
+        for job in self.__queue:
+            builds.append({ "tool" : job.tool, "args" : job.args,
+                            "state" : "queued",
+                            "time" : time.time() - job.queued })
+        return builds
+
+    def __can_start(self):
+        return not self.max_jobs or len(self.__running) < self.max_jobs
+
+    def __start_queued(self):
+        while self.__queue and self.__can_start():
+            job = self.__queue.pop(0)
+            self.__start(job)
+
+        if not self.__running and not self.__queue and self.__warm_due:
+            self.__warm_due = False
+            self.__run_warmers()
+
+    def __start(self, job):
+        (out_r, out_w) = os.pipe()
+        (err_r, err_w) = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            self.__exec_job(job, out_w, err_w)
+        os.close(out_w)
+        os.close(err_w)
+
+        job.pid = pid
+        job.started = time.time()
+        job.pipes = { out_r : "stdout", err_r : "stderr" }
+        self.__running[pid] = job
+        logging.info("Started %s %s as pid %d" %
+                     (job.tool, " ".join(job.args), pid))
+        self.__send(job.conn, "started", pid = pid)
+
+    def __exec_job(self, job, stdout, stderr):
+        """Run a build in the forked child; never returns."""
+        rc = 1
+        try:
+            try:
+                null = os.open("/dev/null", os.O_RDONLY)
+                os.dup2(null, 0)
+                os.dup2(stdout, 1)
+                os.dup2(stderr, 2)
+                # don't hold on to the daemon's socket or other builds'
+                # connections, or their clients would never see EOF
+                os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+                os.chdir(job.cwd)
+                os.environ.clear()
+                os.environ.update(job.env)
+                os.environ.update(self.env)
+                os.environ[DAEMON_ENV] = "1"
+
+                logger = logging.getLogger()
+                for handler in logger.handlers[:]:
+                    logger.removeHandler(handler)
+
+                path = job.tool
+                if self.tooldir:
+                    path = os.path.join(self.tooldir, job.tool)
+                sys.argv = [path] + job.args
+                tool = imp.load_source("imgcreate_daemon_tool", path)
+                rc = tool.main()
+            except SystemExit, e:
+                rc = e.code
+            except:
+                traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                if rc is None:
+                    rc = 0
+                elif not isinstance(rc, int):
+                    rc = 1
+                os._exit(rc)
+
+    def __read_job(self, fd):
+        for job in self.__running.values():
+            if fd is job.conn:
+                # the client went away; anything else it sends is ignored
+                if not job.conn.recv(4096):
+                    self.__interrupt(job)
+                return
+            if fd in job.pipes:
+                data = os.read(fd, 65536)
+                if not data:
+                    os.close(fd)
+                    del job.pipes[fd]
+                    return
+                self.__send(job.conn, "output", stream = job.pipes[fd],
+                            data = data.decode("utf-8", "replace"))
+                return
+
+    def __interrupt(self, job):
+        if job.gone:
+            return
+        job.gone = True
+        logging.info("Interrupting build %d" % job.pid)
+        try:
+            os.kill(job.pid, signal.SIGINT)
+        except OSError:
+            pass
+
+    def __reap(self):
+        for job in self.__running.values():
+            if job.status is None:
+                try:
+                    (pid, status) = os.waitpid(job.pid, os.WNOHANG)
+                except OSError:
+                    (pid, status) = (job.pid, 1 << 8)
+                if pid == job.pid:
+                    job.status = status
+            if job.status is None or job.pipes:
+                continue
+
+            del self.__running[job.pid]
+            if os.WIFSIGNALED(job.status):
+                rc = -os.WTERMSIG(job.status)
+            else:
+                rc = os.WEXITSTATUS(job.status)
+            logging.info("Build %d finished with %d after %.1fs" %
+                         (job.pid, rc, time.time() - job.started))
+            if not job.gone:
+                self.__send(job.conn, "finished", returncode = rc)
+            self.__close(job.conn)
+            self.__warm_due = True
+
+    def __send(self, conn, event, **fields):
+        try:
+            _send(conn, event, **fields)
+        except socket.error:
+            for job in self.__running.values():
+                if job.conn is conn:
+                    self.__interrupt(job)
+
+    def __error(self, conn, message):
+        logging.warn(message)
+        self.__send(conn, "error", message = message)
+        self.__close(conn)
+
+    def __close(self, conn):
+        self.__clients.pop(conn, None)
+        try:
+            conn.close()
+        except socket.error:
+            pass
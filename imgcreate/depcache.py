@@ -0,0 +1,117 @@
+#
+# depcache.py : Caching dependency resolution results
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import json
+import time
+import glob
+import hashlib
+import tempfile
+
+from imgcreate.fs import makedirs
+
+DEPSOLVE_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+"""The seconds after which an unused depsolve result is removed."""
+
+def get_file_digest(path):
+    """Return a digest of the file at path, or None if it can't be read."""
+    try:
+        f = open(path, "rb")
+        try:
+            digest = hashlib.sha1()
+            for data in iter(lambda: f.read(65536), ""):
+                digest.update(data)
+            return digest.hexdigest()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+def get_depsolve_key(metadata, selection):
+    """Return the key of a depsolve result.
+
+    metadata -- the digests of the repository metadata resolved against.
+    selection -- what was asked for; lists and sets in it are compared as
+                 sets, tuples as records, whose order matters.
+
+    """
+    def normalise(value):
+        if isinstance(value, dict):
+            return dict([(k, normalise(v)) for (k, v) in value.items()])
+        if isinstance(value, tuple):
+            return [normalise(v) for v in value]
+        if isinstance(value, (list, set)):
+            return sorted([normalise(v) for v in value])
+        return value
+    return hashlib.sha1(json.dumps([sorted(metadata), normalise(selection)],
+                                   sort_keys = True)).hexdigest()
+
+class DepsolveCache(object):
+    """Results of dependency resolution, by get_depsolve_key().
+
+    A result is whatever the resolver needs to skip resolving again, e.g.
+    the packages of a transaction, as JSON. As the key covers everything
+    the resolution depended on, a result never needs to be invalidated;
+    results unused for max_age seconds are removed.
+
+    """
+    def __init__(self, cachedir, max_age = DEPSOLVE_CACHE_MAX_AGE):
+        self.cachedir = os.path.abspath(cachedir)
+        """The directory the results are kept in."""
+        self.max_age = max_age
+        """The seconds after which an unused result is removed."""
+        makedirs(self.cachedir)
+
+    def __get_path(self, key):
+        return os.path.join(self.cachedir, key + ".json")
+
+    def get(self, key):
+        """Return the result stored under key, or None."""
+        path = self.__get_path(key)
+        try:
+            f = open(path)
+            try:
+                result = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+        # keep results which are used from being expired
+        os.utime(path, None)
+        return result
+
+    def put(self, key, result):
+        """Store result under key."""
+        (fd, tmp) = tempfile.mkstemp(dir = self.cachedir, prefix = ".tmp-")
+        f = os.fdopen(fd, "w")
+        try:
+            json.dump(result, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.__get_path(key))
+        self.expire()
+
+    def expire(self):
+        """Remove the results not used for max_age seconds."""
+        now = time.time()
+        for path in glob.glob(os.path.join(self.cachedir, "*.json")):
+            try:
+                if now - os.stat(path).st_mtime > self.max_age:
+                    os.unlink(path)
+            except OSError:
+                pass
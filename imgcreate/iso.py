@@ -0,0 +1,98 @@
+#
+# iso.py : Finalising ISO images
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import hashlib
+import logging
+import subprocess
+
+from imgcreate.errors import *
+from imgcreate.timing import *
+
+ISO_DIGESTS = ("sha256", "sha512")
+"""The digests of a finished ISO written next to it, as NAME.iso.DIGEST files
+in the format sha256sum and friends check."""
+
+ISO_READ_SIZE = 4 * 1024 * 1024
+"""The size of the reads computing the digests of an ISO."""
+
+_IMPLANTISOMD5 = ("/usr/bin/implantisomd5",
+                  "/usr/lib/anaconda-runtime/implantisomd5")
+
+def make_iso_hybrid(iso):
+    """Make iso bootable from a disk as well, if isohybrid is available.
+
+    Only the system area at the start of the ISO is written, and padding at
+    its end.
+
+    """
+    if not os.path.exists("/usr/bin/isohybrid"):
+        return
+    with get_timing_report().timed("isohybrid"):
+        subprocess.call(["/usr/bin/isohybrid", iso])
+
+def implant_iso_md5(iso):
+    """Implant the MD5 checkisomd5 verifies into iso, reading it once."""
+    for implantisomd5 in _IMPLANTISOMD5:
+        if os.path.exists(implantisomd5):
+            break
+    else:
+        logging.warn("isomd5sum not installed; not setting up mediacheck")
+        return
+    with get_timing_report().timed("implantisomd5", iso):
+        subprocess.call([implantisomd5, iso])
+
+def write_iso_digests(iso, digests = ISO_DIGESTS):
+    """Write the digests of iso next to it, all from a single read."""
+    if not digests:
+        return []
+    hashes = [hashlib.new(d) for d in digests]
+    with get_timing_report().timed("iso digests"):
+        f = open(iso, "rb")
+        try:
+            for data in iter(lambda: f.read(ISO_READ_SIZE), ""):
+                for h in hashes:
+                    h.update(data)
+        finally:
+            f.close()
+
+    sidecars = []
+    for (name, h) in zip(digests, hashes):
+        path = "%s.%s" % (iso, name)
+        f = open(path, "w")
+        try:
+            f.write("%s  %s\n" % (h.hexdigest(), os.path.basename(iso)))
+        finally:
+            f.close()
+        sidecars.append(path)
+    return sidecars
+
+def finalise_iso(iso, implant = True, digests = ISO_DIGESTS):
+    """Make iso hybrid, implant its MD5 and write its digests.
+
+    The hybrid MBR and the implanted MD5 are written in place, as the
+    digests cover them. The MD5 is embedded in the volume descriptor at
+    the start of the ISO, so the digests of the finished ISO can only be
+    computed once it is implanted: the ISO is read once for the MD5, and
+    once for all of the digests.
+
+    """
+    make_iso_hybrid(iso)
+    if implant:
+        implant_iso_md5(iso)
+    write_iso_digests(iso, digests)
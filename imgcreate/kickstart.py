@@ -22,8 +22,6 @@ import shutil
 import subprocess
 import time
 import logging
-import urlgrabber
-import selinux
 
 try:
     import system_config_keyboard.keyboard as keyboard
@@ -39,6 +37,7 @@ import pykickstart.version as ksversion
 
 import imgcreate.errors as errors
 import imgcreate.fs as fs
+import imgcreate.relabel as relabel
 
 def read_kickstart(path):
     """Parse a kickstart file and return a KickstartParser instance.
@@ -53,7 +52,11 @@ def read_kickstart(path):
     version = ksversion.makeVersion()
     ks = ksparser.KickstartParser(version)
     try:
-        ksfile = urlgrabber.urlgrab(path)
+        if "://" in path:
+            import urlgrabber
+            ksfile = urlgrabber.urlgrab(path)
+        else:
+            ksfile = path
         ks.readKickstart(ksfile)
 # Fallback to e.args[0] is a workaround for bugs in urlgragger and pykickstart.
     except IOError, e:
@@ -408,6 +411,10 @@ class NetworkConfig(KickstartConfig):
 
 class SelinuxConfig(KickstartConfig):
     """A class to apply a kickstart selinux configuration to a system."""
+    def __init__(self, instroot, manifest = None):
+        KickstartConfig.__init__(self, instroot)
+        self.manifest = manifest
+
     def relabel(self, ksselinux):
         # touch some files which get unhappy if they're not labeled correctly
         for fn in ("/etc/resolv.conf",):
@@ -419,10 +426,14 @@ class SelinuxConfig(KickstartConfig):
         if ksselinux.selinux == ksconstants.SELINUX_DISABLED:
             return
 
-        if not os.path.exists(self.path("/sbin/setfiles")):
+        import selinux
+        file_contexts = self.path(selinux.selinux_file_context_path())
+        if not os.path.exists(file_contexts):
             return
 
-        self.call(["/sbin/setfiles", "-p", "-e", "/proc", "-e", "/sys", "-e", "/dev", selinux.selinux_file_context_path(), "/"])
+        # only what changed since the install root was labeled on mount
+        relabel.Relabeler(self.instroot, file_contexts,
+                          self.manifest).relabel()
 
     def apply(self, ksselinux):
         if os.path.exists(self.path("/usr/sbin/lokkit")):
@@ -27,6 +27,16 @@ import re
 from imgcreate.errors import *
 from imgcreate.fs import *
 from imgcreate.creator import *
+from imgcreate.iso import *
+from imgcreate.util import get_base_arch
+
+ISO_GRAFTS = ".imgcreate-grafts"
+"""The file in an ISO tree listing the files of the install root which are
+put on the ISO where they are, rather than copied into the tree; it is left
+off the ISO itself."""
+
+def _escape_pathspec(path):
+    return path.replace("\\", "\\\\").replace("=", "\\=")
 
 class LiveImageCreatorBase(LoopImageCreator):
     """A base class for LiveCD image creators.
@@ -67,6 +77,9 @@ class LiveImageCreatorBase(LoopImageCreator):
 
         """
 
+        self.iso_digests = ISO_DIGESTS
+        """The digests written next to the ISO, e.g. NAME.iso.sha256."""
+
         self._timeout = kickstart.get_timeout(self.ks, 10)
         """The bootloader timeout from kickstart."""
 
@@ -142,6 +155,104 @@ class LiveImageCreatorBase(LoopImageCreator):
 
         return False
 
+    def _can_graft(self):
+        """Return whether files of the install root may be grafted.
+
+        Grafted files are read from the install root when the ISO is
+        mastered, so it must still be readable then; nor may a script see
+        the ISO tree without them, as a %post --nochroot script does.
+
+        """
+        if [s for s in kickstart.get_post_scripts(self.ks) if not s.inChroot]:
+            return False
+        return self._instroot_at_mastering()
+
+    def _instroot_at_mastering(self):
+        """Return whether the install root is readable when mastering.
+
+        This is the hook where subclasses which master the ISO while the
+        install root is mounted say so. A loopless install root stays
+        readable until the build is cleaned up.
+
+        """
+        return self.loopless
+
+    def _graft(self, isodir, source, isopath):
+        """Put the file source at isopath on the ISO.
+
+        If _can_graft(), the ISO is mastered with source read from where it
+        is; otherwise it is copied into isodir. Either replaces what was put
+        at isopath before, e.g. by a configure run again.
+
+        A symlink is always copied, as the file it points to: mkisofs would
+        put a graft of it on the ISO as a symlink, which isolinux can't
+        read.
+
+        """
+        if not self._can_graft() or os.path.islink(source) or \
+           not source.startswith(self._instroot + "/"):
+            makedirs(os.path.dirname(os.path.join(isodir, isopath)))
+            shutil.copyfile(source, os.path.join(isodir, isopath))
+            return
+        if os.path.exists(os.path.join(isodir, isopath)):
+            # e.g. an initrd kept from the ISO the image is based on
+            os.unlink(os.path.join(isodir, isopath))
+        grafts = [(i, s) for (i, s) in self._get_grafts(isodir) if i != isopath]
+        grafts.append((isopath, source))
+        # the manifest is rewritten whole, one entry per isopath
+        path = os.path.join(isodir, ISO_GRAFTS)
+        f = open(path + ".tmp", "w")
+        try:
+            for (i, s) in grafts:
+                f.write("%s\t%s\n" % (i, s[len(self._instroot):]))
+        finally:
+            f.close()
+        os.rename(path + ".tmp", path)
+
+    def _get_grafts(self, isodir):
+        """Return the (isopath, source) grafts of isodir."""
+        grafts = []
+        try:
+            f = open(os.path.join(isodir, ISO_GRAFTS))
+        except IOError:
+            return grafts
+        try:
+            for line in f.read().splitlines():
+                (isopath, path) = line.split("\t", 1)
+                # the install root moves when a build is resumed
+                grafts.append((isopath, self._instroot + path))
+        finally:
+            f.close()
+        return grafts
+
+    def _iso_exists(self, isodir, isopath):
+        """Return whether isopath is on the ISO, grafted or not."""
+        if os.path.exists(os.path.join(isodir, isopath)):
+            return True
+        return isopath in [g[0] for g in self._get_grafts(isodir)]
+
+    def _link_grafts(self, isodir, src, dest):
+        """Graft the files grafted in the directory src into dest too."""
+        for (isopath, source) in self._get_grafts(isodir):
+            if os.path.dirname(isopath) == src:
+                self._graft(isodir, source,
+                            os.path.join(dest, os.path.basename(isopath)))
+
+    def _get_iso_pathspecs(self, isodir):
+        """Return the mkisofs arguments giving the contents of the ISO."""
+        grafts = [(i, s) for (i, s) in self._get_grafts(isodir)
+                  if not os.path.exists(os.path.join(isodir, i))]
+        if not grafts:
+            return ["-m", ISO_GRAFTS, isodir]
+        get_timing_report().note("iso grafts", "%d files read in place" %
+                                 len(grafts))
+        args = ["-m", ISO_GRAFTS, "-graft-points"]
+        for (isopath, source) in grafts:
+            args.append("%s=%s" % (_escape_pathspec(isopath),
+                                   _escape_pathspec(source)))
+        args.append("/=" + _escape_pathspec(isodir))
+        return args
+
     #
     # Actual implementation
     #
@@ -225,12 +336,45 @@ class LiveImageCreatorBase(LoopImageCreator):
     def __ensure_isodir(self):
         if self.__isodir is None:
             self.__isodir = self._mkdtemp("iso-")
+            if not self.phase_done("configure"):
+                # configure writes the ISO tree from scratch; a resumed
+                # build may find what a failed configure left of it
+                clear_dir(self.__isodir)
         return self.__isodir
 
     def _create_bootconfig(self):
         """Configure the image so that it's bootable."""
         self._configure_bootloader(self.__ensure_isodir())
 
+    def _checkpoint_intact(self):
+        # the bootloader configuration is only written to the ISO tree
+        for isodir in self._get_checkpoint_dirs("iso-"):
+            if not os.path.isdir(isodir):
+                return False
+        return LoopImageCreator._checkpoint_intact(self)
+
+    def _unstage_image(self, image, staged):
+        """Undo staging after it failed, so the build may be resumed.
+
+        The image is moved back from image, if it was moved there, and the
+        staged directory removed from the ISO tree; the rest of the ISO tree
+        is left as configure() left it.
+
+        """
+        if image and os.path.exists(image) and not os.path.exists(self._image):
+            shutil.move(image, self._image)
+            try:
+                os.rmdir(os.path.dirname(image))
+            except OSError:
+                pass
+        shutil.rmtree(staged, ignore_errors = True)
+
+    def _get_bootconfig_io(self):
+        # kernels, bootloader files and the rpmdb go into the ISO tree
+        return (["instroot:/boot", "instroot:/usr", "instroot:/lib",
+                 "instroot:/var"],
+                ["isodir"])
+
     def _get_post_scripts_env(self, in_chroot):
         env = LoopImageCreator._get_post_scripts_env(self, in_chroot)
 
@@ -298,60 +442,76 @@ class LiveImageCreatorBase(LoopImageCreator):
         if self._isofstype == "udf":
             args.append("-allow-limited-size")
 
-        args.append(isodir)
+        args.extend(self._get_iso_pathspecs(isodir))
 
         if subprocess.call(args) != 0:
             raise CreatorError("ISO creation failed!")
 
-        if os.path.exists("/usr/bin/isohybrid"):
-            subprocess.call(["/usr/bin/isohybrid", iso])
-
-        self.__implant_md5sum(iso)
-
-    def __implant_md5sum(self, iso):
-        """Implant an isomd5sum."""
-        if os.path.exists("/usr/bin/implantisomd5"):
-            implantisomd5 = "/usr/bin/implantisomd5"
-        elif os.path.exists("/usr/lib/anaconda-runtime/implantisomd5"):
-            implantisomd5 = "/usr/lib/anaconda-runtime/implantisomd5"
-        else:
-            logging.warn("isomd5sum not installed; not setting up mediacheck")
-            return
-            
-        subprocess.call([implantisomd5, iso])
+        finalise_iso(iso, digests = self.iso_digests)
 
     def _stage_final_image(self):
+        image = None
+        done = False
         try:
             makedirs(self.__ensure_isodir() + "/LiveOS")
 
             self._resparse()
 
-            if not self.skip_minimize:
-                create_image_minimizer(self.__isodir + "/LiveOS/osmin.img",
-                                       self._image, self.compress_type,
-                                       tmpdir = self.tmpdir)
-
+            liveos = self.__isodir + "/LiveOS"
             if self.skip_compression:
-                shutil.move(self._image, self.__isodir + "/LiveOS/ext3fs.img")
-                if os.stat(self.__isodir + "/LiveOS/ext3fs.img").st_size >= 4*1024*1024*1024:
-                    self._isofstype = "udf"
-                    logging.warn("Switching to UDF due to size of LiveOS/ext3fs.img")
+                image = liveos + "/ext3fs.img"
+                staged = image
             else:
-                makedirs(os.path.join(os.path.dirname(self._image), "LiveOS"))
-                shutil.move(self._image,
-                            os.path.join(os.path.dirname(self._image),
-                                         "LiveOS", "ext3fs.img"))
-                mksquashfs(os.path.dirname(self._image),
-                           self.__isodir + "/LiveOS/squashfs.img",
-                           self.compress_type)
-                if os.stat(self.__isodir + "/LiveOS/squashfs.img").st_size >= 4*1024*1024*1024:
-                    self._isofstype = "udf"
-                    logging.warn("Switching to UDF due to size of LiveOS/squashfs.img")
+                image = os.path.join(os.path.dirname(self._image),
+                                     "LiveOS", "ext3fs.img")
+                staged = liveos + "/squashfs.img"
+
+            def move_image():
+                makedirs(os.path.dirname(image))
+                shutil.move(self._image, image)
 
+            def minimize():
+                create_image_minimizer(liveos + "/osmin.img", image,
+                                       self.compress_type,
+                                       tmpdir = self.tmpdir)
+
+            def compress():
+                mksquashfs(os.path.dirname(image), staged,
+                           self.compress_type)
 
-            self.__create_iso(self.__isodir)
+            def create_iso():
+                if os.stat(staged).st_size >= 4*1024*1024*1024:
+                    self._isofstype = "udf"
+                    logging.warn("Switching to UDF due to size of LiveOS/%s" %
+                                 os.path.basename(staged))
+                self.__create_iso(self.__isodir)
+
+            # the image is moved first, so that the minimizer and mksquashfs
+            # can read it at the same time
+            graph = TaskGraph("stage")
+            graph.add("move image", move_image,
+                      inputs = [self._image], outputs = [self._image, image])
+            if self.loopless:
+                # born with next to no spare space, nothing to minimize
+                pass
+            elif not self.skip_minimize:
+                graph.add("minimizer", minimize,
+                          inputs = [image], outputs = [liveos + "/osmin.img"],
+                          io = 1)
+            if not self.skip_compression:
+                graph.add("mksquashfs", compress,
+                          inputs = [os.path.dirname(image)], outputs = [staged],
+                          cpu = max(1, graph.cpu_budget - 1), io = 1)
+            graph.add("iso", create_iso,
+                      inputs = [staged, liveos, "isodir", "instroot"],
+                      outputs = [self._outdir])
+            graph.run()
+            done = True
         finally:
-            shutil.rmtree(self.__isodir, ignore_errors = True)
+            if not done and self.phase_done("configure"):
+                self._unstage_image(image, self.__isodir + "/LiveOS")
+            else:
+                shutil.rmtree(self.__isodir, ignore_errors = True)
             self.__isodir = None
 
 class x86LiveImageCreator(LiveImageCreatorBase):
@@ -400,9 +560,13 @@ class x86LiveImageCreator(LiveImageCreatorBase):
                 raise CreatorError("syslinux not installed : "
                                    "%s not found" % path)
 
-            shutil.copy(path, isodir + "/isolinux/")
+            if f == "isolinux.bin":
+                # mkisofs writes the boot info table into it
+                shutil.copy(path, isodir + "/isolinux/")
+            else:
+                self._graft(isodir, path, "isolinux/" + f)
 
-    def __copy_syslinux_background(self, isodest):
+    def __copy_syslinux_background(self, isodir, isopath):
         background_path = self._instroot + \
                           "/usr/share/anaconda/boot/syslinux-vesa-splash.jpg"
 
@@ -414,31 +578,31 @@ class x86LiveImageCreator(LiveImageCreatorBase):
             if not os.path.exists(background_path):
                 return False
 
-        shutil.copyfile(background_path, isodest)
+        self._graft(isodir, background_path, isopath)
 
         return True
 
     def __copy_kernel_and_initramfs(self, isodir, version, index):
         bootdir = self._instroot + "/boot"
 
-        shutil.copyfile(bootdir + "/vmlinuz-" + version,
-                        isodir + "/isolinux/vmlinuz" + index)
+        self._graft(isodir, bootdir + "/vmlinuz-" + version,
+                    "isolinux/vmlinuz" + index)
 
         isDracut = False
         if os.path.exists(bootdir + "/initramfs-" + version + ".img"):
-            shutil.copyfile(bootdir + "/initramfs-" + version + ".img",
-                            isodir + "/isolinux/initrd" + index + ".img")
+            self._graft(isodir, bootdir + "/initramfs-" + version + ".img",
+                        "isolinux/initrd" + index + ".img")
             isDracut = True
         elif os.path.exists(bootdir + "/initrd-" + version + ".img"):
-            shutil.copyfile(bootdir + "/initrd-" + version + ".img",
-                            isodir + "/isolinux/initrd" + index + ".img")
+            self._graft(isodir, bootdir + "/initrd-" + version + ".img",
+                        "isolinux/initrd" + index + ".img")
         elif not self.base_on:
             logging.error("No initrd or initramfs found for %s" % (version,))
 
         is_xen = False
         if os.path.exists(bootdir + "/xen.gz-" + version[:-3]):
-            shutil.copyfile(bootdir + "/xen.gz-" + version[:-3],
-                            isodir + "/isolinux/xen" + index + ".gz")
+            self._graft(isodir, bootdir + "/xen.gz-" + version[:-3],
+                        "isolinux/xen" + index + ".gz")
             is_xen = True
 
         return (is_xen, isDracut)
@@ -596,7 +760,7 @@ menu separator
         if not memtest:
             return ""
 
-        shutil.copyfile(memtest[0], isodir + "/isolinux/memtest")
+        self._graft(isodir, memtest[0], "isolinux/memtest")
 
         return """label memtest
   menu label Run a ^memory test.
@@ -624,7 +788,7 @@ menu separator
                                    self.__find_syslinux_mboot())
 
         background = ""
-        if self.__copy_syslinux_background(isodir + "/isolinux/splash.jpg"):
+        if self.__copy_syslinux_background(isodir, "isolinux/splash.jpg"):
             background = "splash.jpg"
 
         cfg = self.__get_basic_syslinux_config(menu = menu,
@@ -706,7 +870,7 @@ hiddenmenu
 
         for index in range(0, 9):
             # we don't support xen kernels
-            if os.path.exists("%s/EFI/boot/xen%d.gz" %(isodir, index)):
+            if self._iso_exists(isodir, "EFI/boot/xen%d.gz" % index):
                 continue
             cfg += self.__get_efi_image_stanza(fslabel = self.fslabel,
                                                isofstype = "auto",
@@ -735,6 +899,7 @@ hiddenmenu
         for f in os.listdir(isodir + "/isolinux"):
             os.link("%s/isolinux/%s" %(isodir, f),
                     "%s/EFI/boot/%s" %(isodir, f))
+        self._link_grafts(isodir, "isolinux", "EFI/boot")
 
 
         cfg = self.__get_basic_efi_config(name = self.name,
@@ -746,13 +911,13 @@ hiddenmenu
         cfgf.close()
 
         # first gen mactel machines get the bootloader name wrong apparently
-        if rpmUtils.arch.getBaseArch() == "i386":
+        if get_base_arch() == "i386":
             os.link(isodir + "/EFI/boot/grub.efi", isodir + "/EFI/boot/boot.efi")
             os.link(isodir + "/EFI/boot/grub.conf", isodir + "/EFI/boot/boot.conf")
 
         # for most things, we want them named boot$efiarch
         efiarch = {"i386": "ia32", "x86_64": "x64"}
-        efiname = efiarch[rpmUtils.arch.getBaseArch()]
+        efiname = efiarch[get_base_arch()]
         os.rename(isodir + "/EFI/boot/grub.efi", isodir + "/EFI/boot/boot%s.efi" %(efiname,))
         os.link(isodir + "/EFI/boot/grub.conf", isodir + "/EFI/boot/boot%s.conf" %(efiname,))
 
@@ -956,7 +1121,7 @@ class ppc64LiveImageCreator(ppcLiveImageCreator):
         return ["kernel.ppc"] + \
                ppcLiveImageCreator._get_excluded_packages(self)
 
-arch = rpmUtils.arch.getBaseArch()
+arch = get_base_arch()
 if arch in ("i386", "x86_64"):
     LiveImageCreator = x86LiveImageCreator
 elif arch in ("ppc",):
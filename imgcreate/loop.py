@@ -0,0 +1,426 @@
+#
+# loop.py : Loop device management
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import os.path
+import re
+import glob
+import errno
+import fcntl
+import struct
+import logging
+import threading
+import subprocess
+
+from imgcreate.errors import *
+from imgcreate.util import call
+
+# ioctls from <linux/loop.h>
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_SET_DIRECT_IO = 0x4C08
+LOOP_SET_BLOCK_SIZE = 0x4C09
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+LO_FLAGS_DIRECT_IO = 16
+
+LO_NAME_SIZE = 64
+
+BUILD_DIR_PREFIX = "imgcreate-"
+"""The prefix of every build directory; a loop device whose backing file
+lives below such a directory belongs to that build."""
+
+BUILD_DIR_LOCK = ".imgcreate.lock"
+"""The lock file held by the process owning a build directory."""
+
+def lock_build_dir(builddir):
+    """Mark builddir as owned by the calling process.
+
+    An exclusive flock() is taken on a lock file in builddir and held for as
+    long as the returned file descriptor is open, i.e. at the latest until
+    the process dies. This is how loop devices left behind by dead builds
+    are told apart from the ones used by running builds.
+
+    """
+    fd = os.open(os.path.join(builddir, BUILD_DIR_LOCK),
+                 os.O_RDWR | os.O_CREAT, 0600)
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            raise CreatorError("Build directory %s is in use by another "
+                               "process" % builddir)
+        raise
+    os.ftruncate(fd, 0)
+    os.write(fd, "%d\n" % os.getpid())
+    return fd
+
+def unlock_build_dir(fd):
+    """Release a lock taken with lock_build_dir()."""
+    os.close(fd)
+
+def _build_dir_of(path):
+    """Return the build directory containing path, or None."""
+    while path and path != "/":
+        if os.path.basename(path).startswith(BUILD_DIR_PREFIX):
+            return path
+        path = os.path.dirname(path)
+    return None
+
+def _build_dir_is_dead(builddir):
+    """Return whether nobody holds the lock of builddir.
+
+    Build directories without a lock file are not considered dead, as we
+    can't know who they belong to.
+
+    """
+    try:
+        fd = os.open(os.path.join(builddir, BUILD_DIR_LOCK), os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        return True
+    finally:
+        os.close(fd)
+
+def _pack_loop_info64(lofile, flags):
+    """Pack a struct loop_info64 naming lofile."""
+    return struct.pack("<5Q4I%ds%ds32s2Q" % (LO_NAME_SIZE, LO_NAME_SIZE),
+                       0, 0, 0, 0, 0,      # device, inode, rdevice, offset, sizelimit
+                       0, 0, 0, flags,     # number, encrypt type/key size, flags
+                       lofile[-(LO_NAME_SIZE - 1):], "", "",
+                       0, 0)
+
+def _pack_loop_config(fd, block_size, info):
+    """Pack a struct loop_config for LOOP_CONFIGURE."""
+    return struct.pack("<2I", fd, block_size) + info + "\0" * 64
+
+class LoopManager(object):
+    """Attaches loop devices to image files, atomically.
+
+    Allocating a loop device with 'losetup -f' and then attaching it with
+    'losetup <dev> <file>' is racy: two builds may be handed the same free
+    device. Instead, the kernel is asked for a free device and the file is
+    attached in one go through /dev/loop-control; if another process got
+    there first, the attach fails with EBUSY and we simply try again. Where
+    /dev/loop-control is unavailable, 'losetup --find --show' is used, which
+    does the same thing.
+
+    Devices may be attached with direct I/O, so that the data written to the
+    image doesn't go through the page cache twice, once for the loop device
+    and once for the image file. Not every filesystem supports it (e.g.
+    tmpfs doesn't), in which case the device is attached without.
+
+    The manager also reclaims loop devices left behind by builds which died
+    without cleaning up, and keeps usage statistics for the timing report.
+
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__attached = {}
+        self.__reclaimed = False
+
+        self.attaches = 0
+        """The number of devices attached by this process."""
+        self.races = 0
+        """The number of times another process grabbed a free device first."""
+        self.peak = 0
+        """The largest number of devices this process had attached at once."""
+        self.orphans = 0
+        """The number of devices reclaimed from dead builds."""
+        self.dio_fallbacks = 0
+        """The number of devices attached without the direct I/O asked for."""
+
+    def __configure(self, fd, backing, lofile, flags, block_size):
+        attempts = [flags]
+        if flags & LO_FLAGS_DIRECT_IO:
+            # the image's filesystem may not support direct I/O
+            attempts.append(flags & ~LO_FLAGS_DIRECT_IO)
+        for attempt in attempts:
+            try:
+                fcntl.ioctl(fd, LOOP_CONFIGURE,
+                            _pack_loop_config(backing, block_size,
+                                              _pack_loop_info64(lofile,
+                                                                attempt)))
+                return
+            except IOError, e:
+                if e.errno not in (errno.EINVAL, errno.ENOTTY):
+                    raise
+
+        # kernels before 5.8 need several steps; EBUSY still tells us if we
+        # lost the race
+        fcntl.ioctl(fd, LOOP_SET_FD, backing)
+        try:
+            fcntl.ioctl(fd, LOOP_SET_STATUS64,
+                        _pack_loop_info64(lofile,
+                                          flags & ~LO_FLAGS_DIRECT_IO))
+        except IOError:
+            fcntl.ioctl(fd, LOOP_CLR_FD, 0)
+            raise
+        for (request, arg) in ((LOOP_SET_BLOCK_SIZE, block_size),
+                               (LOOP_SET_DIRECT_IO,
+                                int(flags & LO_FLAGS_DIRECT_IO != 0))):
+            if not arg:
+                continue
+            try:
+                fcntl.ioctl(fd, request, arg)
+            except IOError, e:
+                logging.debug("Loop ioctl %#x failed: %s" %
+                              (request, e.strerror))
+
+    def __ioctl_attach(self, lofile, readonly, direct_io, block_size):
+        try:
+            ctl = os.open("/dev/loop-control", os.O_RDWR)
+        except OSError:
+            return None
+
+        if readonly:
+            mode = os.O_RDONLY
+            flags = LO_FLAGS_READ_ONLY
+        else:
+            mode = os.O_RDWR
+            flags = 0
+        if direct_io:
+            flags |= LO_FLAGS_DIRECT_IO
+
+        try:
+            backing = os.open(lofile, mode)
+            try:
+                for attempt in range(64):
+                    number = fcntl.ioctl(ctl, LOOP_CTL_GET_FREE)
+                    device = "/dev/loop%d" % number
+                    try:
+                        fd = os.open(device, mode)
+                    except OSError:
+                        return None
+                    try:
+                        self.__configure(fd, backing, lofile, flags,
+                                         block_size)
+                        return device
+                    except IOError, e:
+                        if e.errno != errno.EBUSY:
+                            raise MountError("Failed to attach %s to %s: %s"
+                                             % (lofile, device, e.strerror))
+                        self.races += 1
+                    finally:
+                        os.close(fd)
+            finally:
+                os.close(backing)
+        finally:
+            os.close(ctl)
+
+        raise MountError("Failed to allocate loop device for '%s'" % lofile)
+
+    def __losetup_attach(self, lofile, readonly, direct_io, block_size):
+        args = ["/sbin/losetup", "--find", "--show"]
+        if readonly:
+            args.append("--read-only")
+        if block_size:
+            args.append("--sector-size=%d" % block_size)
+        if direct_io:
+            args.append("--direct-io=on")
+        args.append(lofile)
+
+        p = subprocess.Popen(args, stdout = subprocess.PIPE,
+                             stderr = subprocess.PIPE)
+        (out, err) = p.communicate()
+        if p.returncode != 0 and direct_io:
+            return self.__losetup_attach(lofile, readonly, False, block_size)
+        if p.returncode != 0 or not out.strip():
+            raise MountError("Failed to allocate loop device for '%s': %s" %
+                             (lofile, err.strip()))
+        return out.split()[0]
+
+    def attach(self, lofile, readonly = False, direct_io = False,
+               block_size = 0):
+        """Attach lofile to a free loop device and return the device path.
+
+        readonly -- whether to attach the device read-only.
+        direct_io -- whether to bypass the page cache when accessing lofile;
+                     this is silently dropped if lofile doesn't support it.
+        block_size -- the logical block size of the device, or 0 to use the
+                      kernel's default of 512 bytes.
+
+        """
+        self.reclaim_orphans()
+
+        device = self.__ioctl_attach(lofile, readonly, direct_io, block_size)
+        if device is None:
+            device = self.__losetup_attach(lofile, readonly, direct_io,
+                                           block_size)
+
+        logging.info("Losetup add %s mapping to %s"  % (device, lofile))
+        if direct_io and not uses_direct_io(device):
+            logging.info("Direct I/O is not supported for %s" % lofile)
+            self.dio_fallbacks += 1
+
+        self.__lock.acquire()
+        try:
+            self.__attached[device] = lofile
+            self.attaches += 1
+            self.peak = max(self.peak, len(self.__attached))
+        finally:
+            self.__lock.release()
+        return device
+
+    def detach(self, device):
+        """Detach the loop device device.
+
+        If the device is still in use, e.g. by a device-mapper table, the
+        kernel detaches it automatically once it is released.
+
+        """
+        logging.info("Losetup remove %s" % device)
+
+        self.__lock.acquire()
+        try:
+            self.__attached.pop(device, None)
+        finally:
+            self.__lock.release()
+
+        try:
+            fd = os.open(device, os.O_RDONLY)
+        except OSError:
+            return call(["/sbin/losetup", "-d", device])
+        try:
+            try:
+                fcntl.ioctl(fd, LOOP_CLR_FD, 0)
+            except IOError, e:
+                if e.errno == errno.ENXIO:
+                    return 0
+                logging.warn("Failed to detach %s: %s" % (device, e.strerror))
+                return 1
+        finally:
+            os.close(fd)
+        return 0
+
+    def __list_devices(self):
+        """Yield a (device, backing file, deleted) tuple for each attached
+        loop device on the host."""
+        for backing_file in glob.glob("/sys/block/loop*/loop/backing_file"):
+            try:
+                f = open(backing_file)
+                try:
+                    path = f.read().rstrip("\n")
+                finally:
+                    f.close()
+            except IOError:
+                continue
+            deleted = path.endswith(" (deleted)")
+            if deleted:
+                path = path[:-len(" (deleted)")]
+            device = "/dev/" + backing_file.split("/")[3]
+            yield (device, path, deleted)
+
+    def reclaim_orphans(self):
+        """Detach loop devices and snapshots left behind by dead builds.
+
+        A loop device belongs to a build if its backing file lives below a
+        build directory; it is an orphan if the backing file was deleted or
+        if no process holds the lock of the build directory any longer.
+
+        This is done once per process, before the first device is attached.
+
+        """
+        self.__lock.acquire()
+        try:
+            if self.__reclaimed:
+                return
+            self.__reclaimed = True
+        finally:
+            self.__lock.release()
+
+        # device-mapper snapshots are named imgcreate-<pid>-<n> and keep
+        # their loop devices busy, so they have to go first
+        dm = glob.glob("/dev/mapper/" + BUILD_DIR_PREFIX + "*")
+        for path in dm:
+            m = re.match(BUILD_DIR_PREFIX + r"(\d+)-\d+$",
+                         os.path.basename(path))
+            if not m or _pid_is_alive(int(m.group(1))):
+                continue
+            logging.info("Removing snapshot %s left by a dead build" % path)
+            call(["/sbin/dmsetup", "remove", os.path.basename(path)])
+
+        for (device, path, deleted) in self.__list_devices():
+            builddir = _build_dir_of(path)
+            if builddir is None:
+                continue
+            if not deleted and not _build_dir_is_dead(builddir):
+                continue
+            logging.info("Reclaiming %s (%s) left by a dead build" %
+                         (device, path))
+            if self.detach(device) == 0:
+                self.orphans += 1
+
+    def get_stats(self):
+        """Return a dict describing the use of loop devices.
+
+        attached, peak, attaches, races, orphans and dio_fallbacks describe
+        this process, host_devices and host_in_use the whole host.
+
+        """
+        host_devices = len(glob.glob("/sys/block/loop*"))
+        host_in_use = len(glob.glob("/sys/block/loop*/loop/backing_file"))
+
+        self.__lock.acquire()
+        try:
+            return { "attached"     : len(self.__attached),
+                     "peak"         : self.peak,
+                     "attaches"     : self.attaches,
+                     "races"        : self.races,
+                     "orphans"      : self.orphans,
+                     "dio_fallbacks": self.dio_fallbacks,
+                     "host_devices" : host_devices,
+                     "host_in_use"  : host_in_use }
+        finally:
+            self.__lock.release()
+
+def uses_direct_io(device):
+    """Return whether the loop device device bypasses the page cache."""
+    try:
+        f = open("/sys/block/%s/loop/dio" % os.path.basename(device))
+        try:
+            return f.read().strip() == "1"
+        finally:
+            f.close()
+    except IOError:
+        return False
+
+def _pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+_loop_manager = LoopManager()
+
+def get_loop_manager():
+    """Return the loop manager shared by everything run in this process."""
+    return _loop_manager
@@ -0,0 +1,258 @@
+#
+# mirrors.py : Ranking mirrors and spreading downloads over them
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import threading
+import urllib2
+
+from imgcreate.errors import *
+from imgcreate.timing import *
+
+MIRROR_TTL = 60 * 60
+"""The seconds for which a ranking of mirrors is reused."""
+
+MIRROR_PROBE_SIZE = 64 * 1024
+"""The number of bytes fetched from each mirror to rank it."""
+
+MIRROR_PROBE_TIMEOUT = 5
+"""The seconds a mirror is given to answer a probe."""
+
+MIRROR_SCORE_SIZE = 512 * 1024
+"""The size of a typical download, for which mirrors are ranked by the time
+they would take to deliver it."""
+
+MIRROR_TOP = 3
+"""The number of the best mirrors downloads are spread over."""
+
+MIRROR_STALL_TIMEOUT = 30
+"""The seconds without data after which a download fails over to another
+mirror."""
+
+def _join(mirror, path):
+    return mirror.rstrip("/") + "/" + path.lstrip("/")
+
+def read_mirrorlist(url):
+    """Return the mirrors listed at url, one URL per line."""
+    try:
+        f = urllib2.urlopen(url, timeout = MIRROR_STALL_TIMEOUT)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except (urllib2.URLError, IOError, ValueError), e:
+        raise CreatorError("Failed to read mirror list %s : %s" % (url, e))
+    mirrors = []
+    for line in data.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            mirrors.append(line)
+    return mirrors
+
+def probe_mirror(mirror, path, size = MIRROR_PROBE_SIZE,
+                 timeout = MIRROR_PROBE_TIMEOUT):
+    """Return the (latency, throughput) of fetching path from mirror.
+
+    Only the first size bytes are asked for. None is returned if the mirror
+    fails to deliver them in time.
+
+    """
+    request = urllib2.Request(_join(mirror, path),
+                              headers = { "Range" : "bytes=0-%d" % (size - 1) })
+    try:
+        start = time.time()
+        f = urllib2.urlopen(request, timeout = timeout)
+        try:
+            latency = time.time() - start
+            # a server ignoring the range sends all of it; stop at size
+            got = 0
+            while got < size:
+                data = f.read(min(65536, size - got))
+                if not data:
+                    break
+                got += len(data)
+                if time.time() - start > timeout:
+                    return None
+        finally:
+            f.close()
+    except (urllib2.URLError, IOError, ValueError, socket.timeout), e:
+        logging.debug("Probing %s failed : %s" % (mirror, e))
+        return None
+    seconds = max(time.time() - start - latency, 0.001)
+    return (latency, got / seconds)
+
+def get_mirror_score(latency, throughput):
+    """Return the seconds a mirror would take to deliver a typical file."""
+    return latency + MIRROR_SCORE_SIZE / max(throughput, 1.0)
+
+class MirrorSelector(object):
+    """Ranks mirrors by probing them all at the same time.
+
+    Rankings are kept in cachefile, if given, and reused for ttl seconds.
+
+    """
+    def __init__(self, cachefile = None, ttl = MIRROR_TTL, top = MIRROR_TOP,
+                 timeout = MIRROR_PROBE_TIMEOUT):
+        self.cachefile = cachefile
+        self.ttl = ttl
+        self.top = top
+        """The number of mirrors select() returns."""
+        self.timeout = timeout
+        """The seconds each mirror is given to answer its probe."""
+
+    def __load(self):
+        if not self.cachefile or not os.path.exists(self.cachefile):
+            return {}
+        try:
+            f = open(self.cachefile)
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+
+    def __save(self, key, ranking):
+        if not self.cachefile:
+            return
+        cache = self.__load()
+        now = time.time()
+        for k in cache.keys():
+            if now - cache[k]["time"] > self.ttl:
+                del cache[k]
+        cache[key] = { "time" : now, "ranking" : ranking }
+        tmp = "%s.%d.tmp" % (self.cachefile, os.getpid())
+        f = open(tmp, "w")
+        try:
+            json.dump(cache, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.cachefile)
+
+    def rank(self, mirrors, path):
+        """Return mirrors ordered from the fastest to the slowest.
+
+        path -- a file every mirror has, e.g. the repository metadata, which
+                is fetched from each of them.
+
+        Mirrors which fail to answer are left out, unless all of them do.
+
+        """
+        key = hashlib.sha1(json.dumps([sorted(mirrors), path])).hexdigest()
+        entry = self.__load().get(key)
+        if entry and time.time() - entry["time"] <= self.ttl:
+            return entry["ranking"]
+
+        results = {}
+        def probe(mirror):
+            results[mirror] = probe_mirror(mirror, path,
+                                           timeout = self.timeout)
+        threads = [threading.Thread(target = probe, args = (m,))
+                   for m in mirrors]
+        with get_timing_report().timed("probe mirrors"):
+            for t in threads:
+                t.setDaemon(True)
+                t.start()
+            for t in threads:
+                t.join(self.timeout + 1)
+
+        scored = []
+        for mirror in mirrors:
+            result = results.get(mirror)
+            if result is None:
+                logging.info("Mirror %s did not answer in time" % mirror)
+                continue
+            (latency, throughput) = result
+            logging.info("Mirror %s: %dms latency, %d KB/s" %
+                         (mirror, latency * 1000, throughput / 1024))
+            scored.append((get_mirror_score(latency, throughput), mirror))
+        if not scored:
+            logging.warn("No mirror answered, using them in the order listed")
+            return list(mirrors)
+
+        scored.sort()
+        ranking = [mirror for (score, mirror) in scored]
+        self.__save(key, ranking)
+        return ranking
+
+    def select(self, mirrors, path):
+        """Return the top fastest of mirrors."""
+        return self.rank(mirrors, path)[:self.top]
+
+class MirrorSet(object):
+    """Spreads downloads over mirrors, failing over when one stalls.
+
+    Successive downloads start at successive mirrors; a mirror which fails
+    or stalls is moved to the end of the set.
+
+    """
+    def __init__(self, mirrors, timeout = MIRROR_STALL_TIMEOUT):
+        self.mirrors = list(mirrors)
+        """The mirrors, best first."""
+        self.timeout = timeout
+        """The seconds without data after which a download fails over."""
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def __fetch(self, url, dest, size):
+        f = urllib2.urlopen(url, timeout = self.timeout)
+        try:
+            out = open(dest, "wb")
+            try:
+                got = 0
+                while True:
+                    data = f.read(65536)
+                    if not data:
+                        break
+                    out.write(data)
+                    got += len(data)
+            finally:
+                out.close()
+        finally:
+            f.close()
+        if size is not None and got != size:
+            raise IOError("got %d of %d bytes" % (got, size))
+
+    def fetch(self, path, dest, size = None):
+        """Download path, relative to the mirrors, to dest."""
+        with self.__lock:
+            mirrors = list(self.mirrors)
+            start = self.__next % len(mirrors)
+            self.__next += 1
+        mirrors = mirrors[start:] + mirrors[:start]
+
+        tmp = dest + ".part"
+        for mirror in mirrors:
+            try:
+                self.__fetch(_join(mirror, path), tmp, size)
+                os.rename(tmp, dest)
+                return
+            except (urllib2.URLError, IOError, socket.timeout), e:
+                logging.warn("Failed to fetch %s from %s : %s" %
+                             (path, mirror, e))
+                with self.__lock:
+                    if mirror in self.mirrors and len(self.mirrors) > 1:
+                        self.mirrors.remove(mirror)
+                        self.mirrors.append(mirror)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise CreatorError("Failed to fetch %s from any mirror" % path)
@@ -0,0 +1,253 @@
+#
+# phasecache.py : Caching the outputs of build phases for incremental rebuilds
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import glob
+import json
+import time
+import fcntl
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+import subprocess
+import urllib2
+
+from imgcreate.errors import *
+from imgcreate.fs import makedirs
+
+PHASE_CACHE_PHASES = ("install", "configure")
+"""The phases whose outputs are cached, in the order they run."""
+
+PHASE_CACHE_KEEP = 3
+"""The number of outputs of every phase kept in a phase cache."""
+
+PHASE_CACHE_META = "phase.json"
+"""The file in a cache entry describing the phase output it holds."""
+
+_PHASE_CACHE_LOCK = ".phase.lock"
+
+def _digest(data):
+    return hashlib.sha1(json.dumps(data, sort_keys = True)).hexdigest()
+
+def get_fingerprint(inputs, parent = None):
+    """Return the fingerprint of a phase run with inputs.
+
+    parent -- the fingerprint of the phase run before, whose output the
+              phase starts from.
+
+    """
+    return _digest([parent, inputs])
+
+def get_url_digest(url):
+    """Return a digest of what is found at url, or None if it can't be read.
+
+    This is used to notice that e.g. the metadata of a repository changed.
+
+    """
+    try:
+        f = urllib2.urlopen(url, timeout = 30)
+        try:
+            return hashlib.sha1(f.read()).hexdigest()
+        finally:
+            f.close()
+    except (urllib2.URLError, IOError, ValueError), e:
+        logging.debug("Failed to read %s : %s" % (url, e))
+        return None
+
+def _lock_entry(entry, shared):
+    fd = os.open(os.path.join(entry, _PHASE_CACHE_LOCK),
+                 os.O_RDWR | os.O_CREAT, 0600)
+    try:
+        if shared:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return fd
+
+def _copy_tree(src, dest, exclude = ()):
+    # reflinks make this nearly free where the filesystem supports them;
+    # holes in the sparse images are kept either way
+    makedirs(dest)
+    for name in os.listdir(src):
+        if name in exclude:
+            continue
+        rc = subprocess.call(["/bin/cp", "-a", "--one-file-system",
+                              "--reflink=auto", os.path.join(src, name),
+                              dest])
+        if rc != 0:
+            raise CreatorError("Failed to copy %s to %s" %
+                               (os.path.join(src, name), dest))
+
+class PhaseCache(object):
+    """Outputs of build phases, by the fingerprint of their inputs.
+
+    An entry is a copy of a build directory taken right after a phase
+    completed, along with the phases completed and the directories created
+    in it, as recorded in a CheckpointJournal. A build whose inputs match
+    an entry starts from a copy of it, as if resuming a checkpoint.
+
+    """
+    def __init__(self, cachedir, keep = PHASE_CACHE_KEEP):
+        self.cachedir = os.path.abspath(cachedir)
+        """The directory the entries are kept in."""
+        self.keep = keep
+        """The number of entries kept of every phase."""
+        makedirs(self.cachedir)
+
+    def __get_entry(self, phase, fingerprint):
+        return os.path.join(self.cachedir, "%s-%s" % (phase, fingerprint))
+
+    def __load(self, entry):
+        try:
+            f = open(os.path.join(entry, PHASE_CACHE_META))
+            try:
+                meta = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+        meta["entry"] = entry
+        return meta
+
+    def lookup(self, phase, fingerprint):
+        """Return the entry of phase with fingerprint, or None."""
+        return self.__load(self.__get_entry(phase, fingerprint))
+
+    def get_entries(self, phase):
+        """Return the entries of phase, newest first."""
+        entries = []
+        for entry in glob.glob(self.__get_entry(phase, "*")):
+            meta = self.__load(entry)
+            if meta:
+                entries.append(meta)
+        entries.sort(key = lambda m: m["created"], reverse = True)
+        return entries
+
+    def get_changes(self, phase, inputs, parent = None):
+        """Return what changed since phase was last cached, or None.
+
+        The names of the inputs which differ from the newest entry of phase
+        are returned; the phase which ran before it is named if its output
+        differed.
+
+        """
+        entries = self.get_entries(phase)
+        if not entries:
+            return None
+        last = entries[0]
+        changes = []
+        if last["parent"] != parent:
+            changes.append(last["parent_phase"] or "parent")
+        hashes = dict([(k, _digest(v)) for (k, v) in inputs.items()])
+        for key in sorted(set(hashes.keys() + last["inputs"].keys())):
+            if hashes.get(key) != last["inputs"].get(key):
+                changes.append(key)
+        return changes
+
+    def store(self, builddir, journal, phase, fingerprint, inputs,
+              parent = None, parent_phase = None, seconds = None,
+              exclude = ()):
+        """Copy builddir into the cache as the output of phase.
+
+        journal -- the CheckpointJournal of the build.
+        inputs -- the inputs of the phase; only their digests are kept, as
+                  they may include e.g. the root password.
+        seconds -- the time the phase took, noted as saved when the entry is
+                   used.
+        exclude -- names in builddir which are not part of the output.
+
+        """
+        if self.lookup(phase, fingerprint):
+            return
+
+        tmp = tempfile.mkdtemp(dir = self.cachedir, prefix = ".tmp-")
+        try:
+            _copy_tree(builddir, tmp, exclude)
+            meta = { "name" : journal.name, "phase" : phase,
+                     "fingerprint" : fingerprint, "parent" : parent,
+                     "parent_phase" : parent_phase,
+                     "inputs" : dict([(k, _digest(v))
+                                      for (k, v) in inputs.items()]),
+                     "phases" : journal.phases, "dirs" : journal.dirs,
+                     "builddir" : builddir, "created" : time.time(),
+                     "seconds" : seconds }
+            f = open(os.path.join(tmp, PHASE_CACHE_META), "w")
+            try:
+                json.dump(meta, f)
+            finally:
+                f.close()
+            try:
+                os.rename(tmp, self.__get_entry(phase, fingerprint))
+            except OSError:
+                # another build stored the same output meanwhile
+                pass
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp, ignore_errors = True)
+
+        self.prune(phase)
+
+    def restore(self, meta, builddir, journal):
+        """Copy the entry meta into builddir.
+
+        The phases completed and the directories created are set in journal,
+        the directories being moved into builddir. False is returned if the
+        entry is being removed.
+
+        """
+        lock = _lock_entry(meta["entry"], True)
+        if lock is None:
+            return False
+        try:
+            if not os.path.exists(os.path.join(meta["entry"],
+                                               PHASE_CACHE_META)):
+                return False
+            _copy_tree(meta["entry"], builddir,
+                       (PHASE_CACHE_META, _PHASE_CACHE_LOCK))
+        finally:
+            os.close(lock)
+
+        journal.phases = list(meta["phases"])
+        journal.dirs = {}
+        for (prefix, paths) in meta["dirs"].items():
+            journal.dirs[prefix] = [
+                os.path.join(builddir, os.path.relpath(p, meta["builddir"]))
+                for p in paths]
+        journal.save()
+        return True
+
+    def prune(self, phase):
+        """Remove all but the newest keep entries of phase."""
+        for meta in self.get_entries(phase)[self.keep:]:
+            lock = _lock_entry(meta["entry"], False)
+            if lock is None:
+                continue
+            try:
+                logging.info("Removing cached %s output %s" %
+                             (phase, meta["fingerprint"][:12]))
+                os.unlink(os.path.join(meta["entry"], PHASE_CACHE_META))
+                shutil.rmtree(meta["entry"], ignore_errors = True)
+            finally:
+                os.close(lock)
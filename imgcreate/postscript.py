@@ -0,0 +1,273 @@
+#
+# postscript.py : Running kickstart %post scripts
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import time
+import errno
+import signal
+import logging
+import threading
+import subprocess
+
+from imgcreate.errors import *
+from imgcreate.timing import *
+
+POST_DIRECTIVE = "#imgcreate:"
+"""Starts a comment line in a %post script setting options for running it,
+e.g. "#imgcreate: timeout=600 independent"."""
+
+POST_KILL_GRACE = 10
+"""The seconds a timed out script is given to exit before it is killed."""
+
+POST_LOG_TAIL = 20
+"""The number of lines of its log quoted when a script fails."""
+
+POST_SLOWEST = 3
+"""The number of the slowest scripts noted in the timing report."""
+
+POST_OUTPUT_WAIT = 1
+"""The seconds the output of an exited script is waited for; something it
+left running in the background may hold on to its output."""
+
+def parse_post_directives(script):
+    """Return the (timeout, independent) options set in script.
+
+    A timeout of None means the script may run for as long as the default
+    timeout allows. An independent script may run at the same time as the
+    independent scripts next to it.
+
+    """
+    timeout = None
+    independent = False
+    for line in script.splitlines():
+        if not line.startswith(POST_DIRECTIVE):
+            continue
+        for option in line[len(POST_DIRECTIVE):].split():
+            if option == "independent":
+                independent = True
+            elif option.startswith("timeout="):
+                try:
+                    timeout = int(option[len("timeout="):])
+                except ValueError:
+                    raise CreatorError("Invalid %%post timeout '%s'" % option)
+            else:
+                raise CreatorError("Unknown %%post option '%s'" % option)
+    return (timeout, independent)
+
+def _read_tail(path, lines = POST_LOG_TAIL):
+    try:
+        f = open(path)
+        try:
+            return "".join(f.readlines()[-lines:])
+        finally:
+            f.close()
+    except IOError:
+        return ""
+
+class PostScript(object):
+    """A %post script, and how it went once it ran."""
+    def __init__(self, index, argv, log, in_chroot = True,
+                 error_on_fail = False, timeout = None, independent = False):
+        self.index = index
+        """The position of the script in the kickstart, from 1."""
+        self.argv = argv
+        """The command running the script."""
+        self.log = log
+        """The file the output of the script is written to; it is logged at
+        INFO as well, line by line."""
+        self.in_chroot = in_chroot
+        self.error_on_fail = error_on_fail
+        self.timeout = timeout
+        """The seconds after which the script is killed, or None."""
+        self.independent = independent
+
+        self.returncode = None
+        self.timed_out = False
+        self.seconds = None
+        self.rusage = None
+        """The resource usage of the script and everything it waited for."""
+
+        self.__pid = None
+        self.__started = None
+        self.__killed = None
+        self.__output = None
+
+    def __str__(self):
+        return "%%post #%d" % self.index
+
+    def start(self, preexec, env):
+        logfile = os.fdopen(os.open(self.log, os.O_WRONLY | os.O_CREAT |
+                                    os.O_APPEND, 0600), "a")
+        def setup():
+            # a session of its own, so that a timeout kills all of it
+            os.setsid()
+            if preexec:
+                preexec()
+        try:
+            p = subprocess.Popen(self.argv, preexec_fn = setup, env = env,
+                                 stdin = open(os.devnull),
+                                 stdout = subprocess.PIPE,
+                                 stderr = subprocess.STDOUT,
+                                 close_fds = True)
+        except OSError, e:
+            logfile.close()
+            raise CreatorError("Failed to execute %s with '%s' : %s" %
+                               (self, self.argv[0], e.strerror))
+        self.__output = threading.Thread(target = self.__copy_output,
+                                         args = (p.stdout, logfile))
+        self.__output.setDaemon(True)
+        self.__output.start()
+        self.__pid = p.pid
+        # the script is reaped with wait4() below, for its resource usage
+        p.returncode = 0
+        self.__started = time.time()
+
+    def poll(self):
+        """Return whether the script exited, killing it if it timed out."""
+        if self.returncode is not None:
+            return True
+        (pid, status, rusage) = os.wait4(self.__pid, os.WNOHANG)
+        if pid == self.__pid:
+            self.seconds = time.time() - self.__started
+            self.rusage = rusage
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+            self.__output.join(POST_OUTPUT_WAIT)
+            return True
+
+        now = time.time()
+        if self.timeout and now - self.__started > self.timeout:
+            if self.__killed is None:
+                logging.warn("%s timed out after %ds, terminating it" %
+                             (self, self.timeout))
+                self.timed_out = True
+                self.__killed = now
+                self.__kill(signal.SIGTERM)
+            elif now - self.__killed > POST_KILL_GRACE:
+                self.__kill(signal.SIGKILL)
+        return False
+
+    def __copy_output(self, pipe, logfile):
+        try:
+            for line in iter(pipe.readline, ""):
+                logfile.write(line)
+                logfile.flush()
+                logging.info("%s: %s" % (self, line.rstrip("\n")))
+        finally:
+            pipe.close()
+            logfile.close()
+
+    def __kill(self, sig):
+        try:
+            os.killpg(self.__pid, sig)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def check(self):
+        """Raise CreatorError if the script failed and must not fail."""
+        if self.returncode == 0 and not self.timed_out:
+            return
+        if self.timed_out:
+            msg = "%s timed out after %ds" % (self, self.timeout)
+        else:
+            msg = "%s failed with code %d" % (self, self.returncode)
+        tail = _read_tail(self.log)
+        if self.error_on_fail:
+            raise CreatorError("%s, see %s :\n%s" % (msg, self.log, tail))
+        logging.warning("ignoring %s, see %s :\n%s" % (msg, self.log, tail))
+
+    def describe(self):
+        """Return a summary of the resources the script used."""
+        s = "%.1fs" % self.seconds
+        if self.rusage:
+            s += ", %.1fs CPU, %d MB read, %d MB written" % \
+                 (self.rusage.ru_utime + self.rusage.ru_stime,
+                  self.rusage.ru_inblock * 512 / (1024 * 1024),
+                  self.rusage.ru_oublock * 512 / (1024 * 1024))
+        return s
+
+class PostScriptRunner(object):
+    """Runs %post scripts in order, with each one logged and timed.
+
+    Independent scripts next to each other run at the same time, up to
+    max_jobs of them.
+
+    """
+    def __init__(self, preexec = None, max_jobs = None):
+        self.preexec = preexec
+        """Called in a script's process before running it, unless it is
+        run outside the chroot."""
+        self.max_jobs = max_jobs or os.sysconf("SC_NPROCESSORS_ONLN")
+        """The number of independent scripts run at the same time."""
+        self.scripts = []
+        """The scripts run so far."""
+
+    def __get_batches(self, scripts):
+        batches = []
+        for s in scripts:
+            if s.independent and batches and batches[-1][0].independent:
+                batches[-1].append(s)
+            else:
+                batches.append([s])
+        return batches
+
+    def run(self, scripts, get_env):
+        """Run scripts, raising CreatorError if one of them fails.
+
+        get_env -- called with the script to return its environment.
+
+        """
+        try:
+            for batch in self.__get_batches(scripts):
+                self.__run_batch(batch, get_env)
+        finally:
+            self.__report()
+
+    def __run_batch(self, batch, get_env):
+        pending = list(batch)
+        running = []
+        try:
+            while pending or running:
+                while pending and len(running) < self.max_jobs:
+                    s = pending.pop(0)
+                    logging.info("Running %s, logging to %s" % (s, s.log))
+                    s.start(s.in_chroot and self.preexec or None, get_env(s))
+                    self.scripts.append(s)
+                    running.append(s)
+                for s in [r for r in running if r.poll()]:
+                    running.remove(s)
+                if running:
+                    time.sleep(0.1)
+        finally:
+            # e.g. interrupted; don't leave scripts running in the image
+            for s in running:
+                s.timeout = 1
+                while not s.poll():
+                    time.sleep(0.1)
+
+        for s in batch:
+            s.check()
+
+    def __report(self):
+        done = [s for s in self.scripts if s.seconds is not None]
+        done.sort(key = lambda s: s.seconds, reverse = True)
+        for s in done[:POST_SLOWEST]:
+            get_timing_report().note("slow " + str(s), s.describe())
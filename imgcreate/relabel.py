@@ -0,0 +1,203 @@
+#
+# relabel.py : Incremental SELinux relabeling of an install root
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import glob
+import hashlib
+import logging
+import cPickle
+import multiprocessing
+
+from imgcreate.errors import *
+from imgcreate.timing import *
+
+RELABEL_EXCLUDE = ("/proc", "/sys", "/dev", "/var/cache/yum")
+"""The directories of an install root which are not relabeled, as they are
+mounted from the host while building."""
+
+RELABEL_CHUNK = 1024
+"""The number of files a worker labels at a time; fewer files than this are
+labeled without starting workers."""
+
+_root = None
+
+def _relabel_chunk(chunk):
+    # runs in the workers, which inherit the contexts loaded by the parent;
+    # they don't log, as they may be forked while another thread of the
+    # parent holds a logging lock, but return the failures to the parent
+    import selinux
+    labels = []
+    failures = []
+    for (path, mode) in chunk:
+        try:
+            (rc, context) = selinux.matchpathcon(path, mode)
+            if rc < 0:
+                context = None
+        except OSError:
+            # no context is defined for path
+            context = None
+
+        if context is not None:
+            try:
+                (rc, current) = selinux.lgetfilecon(_root + path)
+            except OSError:
+                current = None
+            if current != context:
+                try:
+                    selinux.lsetfilecon(_root + path, context)
+                except OSError, e:
+                    failures.append((path, str(e)))
+        labels.append((path, context))
+    return (labels, failures)
+
+def _get_policy_id(file_contexts):
+    digest = hashlib.sha1()
+    for path in sorted(glob.glob(file_contexts + "*")):
+        try:
+            f = open(path)
+            try:
+                digest.update(os.path.basename(path) + "\0" + f.read())
+            finally:
+                f.close()
+        except IOError:
+            pass
+    return digest.hexdigest()
+
+class Relabeler(object):
+    """Labels the files of an install root which changed since last time.
+
+    A manifest of (inode, mtime, label) by path is kept from the previous
+    pass; only files which are new or changed since are looked up in the
+    file contexts, which are loaded once and shared with the worker
+    processes labeling them. A change to the file contexts themselves
+    relabels everything.
+
+    """
+    def __init__(self, root, file_contexts, manifest = None,
+                 exclude = RELABEL_EXCLUDE, jobs = None):
+        self.root = root.rstrip("/")
+        """The install root to label."""
+        self.file_contexts = file_contexts
+        """The file contexts configuration to label with, as a host path."""
+        self.manifest = manifest
+        """The file the manifest is kept in, or None to label everything."""
+        self.exclude = exclude
+        """The directories of root which are left alone."""
+        self.jobs = jobs or os.sysconf("SC_NPROCESSORS_ONLN")
+        """The number of worker processes labeling files."""
+
+    def __load_manifest(self, policy_id):
+        if not self.manifest or not os.path.exists(self.manifest):
+            return {}
+        try:
+            f = open(self.manifest, "rb")
+            try:
+                (manifest_policy, entries) = cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError), e:
+            logging.warn("Ignoring relabel manifest %s : %s" %
+                         (self.manifest, e))
+            return {}
+        if manifest_policy != policy_id:
+            logging.info("File contexts changed, relabeling all files")
+            return {}
+        return entries
+
+    def __save_manifest(self, policy_id, entries):
+        if not self.manifest:
+            return
+        tmp = self.manifest + ".tmp"
+        f = open(tmp, "wb")
+        try:
+            cPickle.dump((policy_id, entries), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, self.manifest)
+
+    def __walk(self, old):
+        # returns the files to label, and the entries of those unchanged
+        todo = []
+        entries = {}
+        for (dirpath, dirnames, filenames) in os.walk(self.root):
+            path = dirpath[len(self.root):] or "/"
+            dirnames[:] = [d for d in dirnames
+                           if not os.path.join(path, d) in self.exclude]
+            names = [path]
+            names.extend([os.path.join(path, n)
+                          for n in dirnames + filenames])
+            if path != "/":
+                # dirpath was stat()ed as one of its parent's dirnames
+                names.pop(0)
+            for name in names:
+                try:
+                    st = os.lstat(self.root + name)
+                except OSError:
+                    continue
+                entry = old.get(name)
+                if entry and entry[0] == st.st_ino and entry[1] == st.st_mtime:
+                    entries[name] = entry
+                else:
+                    entries[name] = (st.st_ino, st.st_mtime, None)
+                    todo.append((name, st.st_mode))
+        return (todo, entries)
+
+    def relabel(self):
+        """Label the new and changed files, and update the manifest."""
+        import selinux
+        global _root
+
+        policy_id = _get_policy_id(self.file_contexts)
+        (todo, entries) = self.__walk(self.__load_manifest(policy_id))
+        logging.info("Relabeling %d of %d files in %s" %
+                     (len(todo), len(entries), self.root))
+
+        chunks = [todo[i:i + RELABEL_CHUNK]
+                  for i in range(0, len(todo), RELABEL_CHUNK)]
+        jobs = min(self.jobs, len(chunks)) or 1
+        if chunks:
+            try:
+                selinux.matchpathcon_init(self.file_contexts)
+            except OSError, e:
+                raise CreatorError("Failed to load file contexts %s : %s" %
+                                   (self.file_contexts, e))
+            _root = self.root
+            try:
+                if jobs == 1:
+                    results = map(_relabel_chunk, chunks)
+                else:
+                    pool = multiprocessing.Pool(jobs)
+                    try:
+                        results = pool.map(_relabel_chunk, chunks)
+                    finally:
+                        pool.terminate()
+                        pool.join()
+            finally:
+                _root = None
+                selinux.matchpathcon_fini()
+
+            for (labels, failures) in results:
+                for (path, context) in labels:
+                    (ino, mtime, label) = entries[path]
+                    entries[path] = (ino, mtime, context)
+                for (path, error) in failures:
+                    logging.debug("Failed to label %s : %s" % (path, error))
+
+        self.__save_manifest(policy_id, entries)
+        get_timing_report().note("relabel", "%d of %d files, %d jobs" %
+                                 (len(todo), len(entries), jobs))
@@ -0,0 +1,220 @@
+#
+# taskgraph.py : Running the steps of a build as a dependency graph
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import time
+import threading
+
+from imgcreate.errors import *
+from imgcreate.timing import *
+
+def _conflicts(a, b):
+    """Return whether the resources a and b overlap.
+
+    Resources are named by strings; "instroot:/etc" is a part of "instroot",
+    so it overlaps with it, but not with "instroot:/boot".
+
+    """
+    if a == b:
+        return True
+    if len(a) > len(b):
+        (a, b) = (b, a)
+    return b.startswith(a) and b[len(a)] in ":/"
+
+def _any_conflict(names, others):
+    for a in names:
+        for b in others:
+            if _conflicts(a, b):
+                return True
+    return False
+
+class Task(object):
+    """A step of a build, as run by a TaskGraph."""
+    def __init__(self, name, func, inputs, outputs, cpu, io):
+        self.name = name
+        """A name for the task, as shown in the timing report."""
+        self.func = func
+        """The callable doing the work."""
+        self.inputs = list(inputs)
+        """The names of the resources the task reads."""
+        self.outputs = list(outputs)
+        """The names of the resources the task writes."""
+        self.cpu = cpu
+        """The share of the CPU budget the task uses."""
+        self.io = io
+        """The share of the I/O budget the task uses."""
+
+        self.depends = []
+        """The tasks which must finish before this one starts."""
+        self.started = None
+        self.finished = None
+
+    def __get_duration(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+    duration = property(__get_duration)
+
+class TaskGraph(object):
+    """Runs the steps of a build concurrently, where that is safe.
+
+    Tasks are added in the order they would run one after the other. Each
+    task declares the resources (e.g. "instroot", "isodir" or a file) it
+    reads and writes, and a task is only started once every earlier task it
+    shares a written resource with has finished; so the result is the same as
+    running the tasks in order.
+
+    Tasks run in threads, which is fine for tasks spending their time in
+    other processes or in I/O. How many run at once is limited by a CPU and
+    an I/O budget; a task larger than the budget runs on its own.
+
+    When done, the critical path through the graph, i.e. the chain of
+    dependent tasks which determined how long the graph took, is noted in
+    the timing report.
+
+    """
+    def __init__(self, name, cpu_budget = None, io_budget = 2):
+        self.name = name
+        """A name for the graph, as shown in the timing report."""
+        if cpu_budget is None:
+            cpu_budget = os.sysconf("SC_NPROCESSORS_ONLN")
+        self.cpu_budget = cpu_budget
+        """The number of CPUs the tasks may use at once."""
+        self.io_budget = io_budget
+        """The number of I/O heavy tasks which may run at once."""
+
+        self.__tasks = []
+        self.__cond = threading.Condition()
+
+    def add(self, name, func, inputs = [], outputs = [], cpu = 1, io = 0):
+        """Add a task calling func, after the tasks added so far."""
+        task = Task(name, func, inputs, outputs, cpu, io)
+        for other in self.__tasks:
+            if _any_conflict(other.outputs, task.inputs + task.outputs) or \
+               _any_conflict(other.inputs, task.outputs):
+                task.depends.append(other)
+        self.__tasks.append(task)
+        return task
+
+    def __fits(self, task, running):
+        if not running:
+            return True
+        cpu = sum([t.cpu for t in running]) + task.cpu
+        io = sum([t.io for t in running]) + task.io
+        return cpu <= self.cpu_budget and io <= self.io_budget
+
+    def __run_task(self, task, depth, errors):
+        report = get_timing_report()
+        report._set_depth(depth)
+        try:
+            try:
+                with report.timed(task.name):
+                    task.func()
+            except:
+                errors.append((task, sys.exc_info()))
+        finally:
+            self.__cond.acquire()
+            try:
+                task.finished = time.time()
+                self.__cond.notifyAll()
+            finally:
+                self.__cond.release()
+
+    def run(self):
+        """Run all the tasks, raising the first failure of any of them.
+
+        Once a task failed, no more tasks are started; the ones running are
+        waited for.
+
+        """
+        depth = get_timing_report()._get_depth()
+        pending = list(self.__tasks)
+        running = []
+        errors = []
+
+        self.__cond.acquire()
+        try:
+            while pending or running:
+                for task in running[:]:
+                    if task.finished is not None:
+                        running.remove(task)
+
+                started = False
+                if not errors:
+                    for task in pending[:]:
+                        if [t for t in task.depends if t.finished is None]:
+                            continue
+                        if not self.__fits(task, running):
+                            continue
+                        pending.remove(task)
+                        running.append(task)
+                        task.started = time.time()
+                        t = threading.Thread(target = self.__run_task,
+                                             args = (task, depth, errors))
+                        t.setDaemon(True)
+                        t.start()
+                        started = True
+                elif not running:
+                    break
+
+                if running and not started:
+                    # wake up now and then, so ^C is noticed
+                    self.__cond.wait(1.0)
+        finally:
+            self.__cond.release()
+
+        if errors:
+            (task, (exc_type, exc_value, tb)) = errors[0]
+            raise exc_type, exc_value, tb
+
+        self.__note_critical_path()
+
+    def get_critical_path(self):
+        """Return the tasks on the critical path, in order."""
+        length = {}
+        previous = {}
+        for task in self.__tasks:
+            length[task] = task.duration
+            previous[task] = None
+            for dep in task.depends:
+                if length[dep] + task.duration > length[task]:
+                    length[task] = length[dep] + task.duration
+                    previous[task] = dep
+
+        if not self.__tasks:
+            return []
+        task = max(self.__tasks, key = lambda t: length[t])
+        path = []
+        while task is not None:
+            path.insert(0, task)
+            task = previous[task]
+        return path
+
+    def __note_critical_path(self):
+        path = self.get_critical_path()
+        if len(self.__tasks) < 2 or not path:
+            return
+        wall = max([t.finished for t in self.__tasks]) - \
+               min([t.started for t in self.__tasks])
+        busy = sum([t.duration for t in self.__tasks])
+        get_timing_report().note("%s critical path" % self.name,
+                                 "%s (%.1fs of %.1fs tasks in %.1fs)" %
+                                 (" > ".join([t.name for t in path]),
+                                  sum([t.duration for t in path]),
+                                  busy, wall))
@@ -0,0 +1,171 @@
+#
+# timing.py : Timing report for image builds
+#
+# Copyright 2010, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import time
+import threading
+
+def _get_used_bytes(path):
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+class _TimedStep(object):
+    """Context manager recording the wall clock time of a single step."""
+    def __init__(self, report, name, path = None):
+        self.report = report
+        self.name = name
+        self.path = path
+        self.__entry = None
+        self.__start = None
+        self.__used = None
+
+    def __enter__(self):
+        if self.path:
+            self.__used = _get_used_bytes(self.path)
+        self.__entry = self.report._begin(self.name)
+        self.__start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = time.time() - self.__start
+        self.report._end(self.__entry, seconds)
+        if self.path and exc_type is None:
+            written = _get_used_bytes(self.path) - self.__used
+            self.report.note("%s throughput" % self.name,
+                             "%.1f MB/s (%d MB in %.1fs)" %
+                             (written / (1024.0 * 1024) / max(seconds, 0.01),
+                              written / (1024 * 1024), seconds))
+        return False
+
+class TimingReport(object):
+    """Collects the wall clock time spent in the steps of an image build.
+
+    Steps are recorded in the order they were started and may be nested, e.g.
+    the filesystem checks run while packaging an image show up below the
+    package step. Steps may be recorded from several threads at once; each
+    thread keeps track of its own nesting.
+
+    Steps which were found to be unnecessary and skipped may be recorded
+    along with an estimate of the time they would have taken, so that the
+    report shows both where the time went and how much of it was saved.
+
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        self.__steps = []
+        self.__saved = {}
+        self.__notes = []
+        self.__local = threading.local()
+
+    def _get_depth(self):
+        return getattr(self.__local, "depth", 0)
+
+    def _set_depth(self, depth):
+        self.__local.depth = depth
+
+    def _begin(self, name):
+        depth = self._get_depth()
+        entry = [name, depth, None]
+        self.__steps.append(entry)
+        self._set_depth(depth + 1)
+        return entry
+
+    def _end(self, entry, seconds):
+        entry[2] = seconds
+        self._set_depth(entry[1])
+
+    def timed(self, name, path = None):
+        """Return a context manager which records the time spent in its body
+        as the step called name, e.g.
+
+          with get_timing_report().timed("e2fsck"):
+              ...
+
+        path -- if given, the growth of the filesystem containing path is
+                measured as well and noted as the throughput of the step.
+
+        """
+        return _TimedStep(self, name, path)
+
+    def record(self, name, seconds):
+        """Record a step which was timed by the caller."""
+        self.__steps.append([name, self._get_depth(), seconds])
+
+    def record_saved(self, name, seconds = None):
+        """Record that the step called name was skipped.
+
+        seconds -- an estimate of the time the step would have taken, or None
+                   if no estimate is available.
+
+        """
+        (count, total, estimated) = self.__saved.get(name, (0, 0.0, 0))
+        if seconds is not None:
+            total += seconds
+            estimated += 1
+        self.__saved[name] = (count + 1, total, estimated)
+
+    def note(self, name, value):
+        """Record a free form measurement, e.g. a throughput figure."""
+        self.__notes.append((name, value))
+
+    def get_total(self, name):
+        """Return the total time spent in all the steps called name."""
+        total = 0.0
+        for (step, depth, seconds) in self.__steps:
+            if step == name and seconds is not None:
+                total += seconds
+        return total
+
+    def get_saved(self, name):
+        """Return a (skipped, seconds) tuple for the step called name."""
+        (count, total, estimated) = self.__saved.get(name, (0, 0.0, 0))
+        return (count, total)
+
+    def format(self):
+        """Return the report as a human readable string."""
+        lines = ["Timing report:"]
+        for (name, depth, seconds) in self.__steps:
+            if seconds is None:
+                duration = "(running)"
+            else:
+                duration = "%9.2fs" % seconds
+            lines.append("  %-40s %s" % ("  " * depth + name, duration))
+
+        names = self.__saved.keys()
+        names.sort()
+        for name in names:
+            (count, total, estimated) = self.__saved[name]
+            if estimated:
+                lines.append("  %-40s %9.2fs saved (%d skipped)" %
+                             (name, total, count))
+            else:
+                lines.append("  %-40s %d skipped" % (name, count))
+
+        for (name, value) in self.__notes:
+            lines.append("  %-40s %s" % (name, value))
+
+        return "\n".join(lines)
+
+_timing_report = TimingReport()
+
+def get_timing_report():
+    """Return the timing report shared by everything run in this process."""
+    return _timing_report
@@ -16,6 +16,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+import os
+import re
 import subprocess
 import logging
 
@@ -37,3 +39,17 @@ def call(*popenargs, **kwargs):
         logging.debug("%s", buf)
 
     return rc
+
+def get_base_arch():
+    """Return the base architecture of the host, as rpm names it.
+
+    This is what rpmUtils.arch.getBaseArch() returns, without importing rpm.
+
+    """
+    arch = os.uname()[4]
+    if re.match("i.86$", arch) or arch == "athlon":
+        return "i386"
+    for base in ("ppc", "sparc", "arm"):
+        if arch.startswith(base):
+            return base
+    return arch
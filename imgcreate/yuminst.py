@@ -19,13 +19,47 @@
 import glob
 import os
 import sys
+import time
+import bisect
+import fnmatch
 import logging
+import multiprocessing
 
 import yum
 import rpmUtils
 import pykickstart.parser
 
 from imgcreate.errors import *
+from imgcreate.timing import *
+from imgcreate.mirrors import *
+from imgcreate.depcache import *
+
+REPO_SETUP_JOBS = 8
+"""The number of repositories whose metadata is fetched at the same time."""
+
+REPO_METADATA = (("metadata", "primary"), ("filelists", "filelists"))
+"""The (sack, repomd) types of metadata fetched and parsed for each repo."""
+
+_setup_repos = []
+
+def _setup_repo(index):
+    # runs in a worker process; what it fetches and parses ends up in the
+    # repo's cache directory, where the parent picks it up
+    repo = _setup_repos[index]
+    try:
+        start = time.time()
+        repo.setup(0)
+        types = repo.repoXML.fileTypes()
+        for (sacktype, mdtype) in REPO_METADATA:
+            if mdtype + "_db" in types:
+                mdtype += "_db"
+            repo.retrieveMD(mdtype)
+        fetched = time.time()
+        for (sacktype, mdtype) in REPO_METADATA:
+            repo.getPackageSack().populate(repo, sacktype, None, 0)
+        return (fetched - start, time.time() - fetched, None)
+    except Exception, e:
+        return (None, None, str(e))
 
 class TextProgress(object):
     logger = logging.getLogger()
@@ -44,6 +78,50 @@ class TextProgress(object):
     def end(self, *args):
         self.emit(logging.INFO, "...OK\n")
 
+class PackageIndex(object):
+    """An index of packages by the names yum matches patterns against.
+
+    Every package is indexed as name, name.arch, name-version,
+    name-version-release, name-version-release.arch,
+    name-epoch:version-release.arch and epoch:name-version-release.arch, so
+    that a pattern is looked up rather than matched against every package.
+    Globs are only matched against the names starting with their literal
+    prefix.
+
+    """
+    def __init__(self, pkgs):
+        self.__names = {}
+        for po in pkgs:
+            for name in self.__get_names(po):
+                self.__names.setdefault(name, []).append(po)
+        self.__sorted = sorted(self.__names.keys())
+
+    def __get_names(self, po):
+        (n, a, e, v, r) = po.pkgtup
+        return set([n, "%s.%s" % (n, a), "%s-%s" % (n, v),
+                    "%s-%s-%s" % (n, v, r), "%s-%s-%s.%s" % (n, v, r, a),
+                    "%s-%s:%s-%s.%s" % (n, e, v, r, a),
+                    "%s:%s-%s-%s.%s" % (e, n, v, r, a)])
+
+    def match(self, pattern):
+        """Return the packages matching pattern."""
+        wildcard = min([i for i in [pattern.find(c) for c in "*?["]
+                        if i >= 0] or [-1])
+        if wildcard < 0:
+            return list(self.__names.get(pattern, []))
+
+        prefix = pattern[:wildcard]
+        matches = {}
+        i = bisect.bisect_left(self.__sorted, prefix)
+        while i < len(self.__sorted) and \
+              self.__sorted[i].startswith(prefix):
+            name = self.__sorted[i]
+            if fnmatch.fnmatchcase(name, pattern):
+                for po in self.__names[name]:
+                    matches[po.pkgtup] = po
+            i += 1
+        return matches.values()
+
 class LiveCDYum(yum.YumBase):
     def __init__(self, releasever=None):
         """
@@ -51,6 +129,12 @@ class LiveCDYum(yum.YumBase):
         """
         yum.YumBase.__init__(self)
         self.releasever = releasever
+        self.mirror_selector = None
+        self.depsolve_cache = None
+        """A DepsolveCache the resolved transaction is kept in, or None."""
+        self.__index = None
+        self.__selection = { "packages" : set(), "groups" : set(),
+                             "excluded" : set() }
 
     def doFileLogSetup(self, uid, logfile):
         # don't do the file log for the livecd as it can lead to open fds
@@ -98,34 +182,77 @@ class LiveCDYum(yum.YumBase):
         self.doRepoSetup()
         self.doSackSetup()
 
+    def __getIndex(self):
+        # the sack doesn't change once the repos are set up
+        if self.__index is None:
+            self.__index = PackageIndex(self.pkgSack.returnPackages())
+        return self.__index
+
     def selectPackage(self, pkg):
         """Select a given package.  Can be specified with name.arch or name*"""
+        self.__selection["packages"].add(pkg)
         return self.install(pattern = pkg)
-        
+
+    def selectPackages(self, pkgs):
+        """Select the given packages, as selectPackage() would.
+
+        The patterns are looked up in a PackageIndex of the sack; those not
+        found there, e.g. provides, are left to selectPackage(). A list of
+        (pattern, error) tuples is returned for those not found at all.
+
+        """
+        index = self.__getIndex()
+        missing = []
+        self.__selection["packages"].update(pkgs)
+        for pkg in pkgs:
+            matches = index.match(pkg)
+            if not matches:
+                try:
+                    self.selectPackage(pkg)
+                except yum.Errors.InstallError, e:
+                    missing.append((pkg, e))
+                continue
+            newest = yum.packageSack.packagesNewestByNameArch(matches)
+            for po in self.bestPackagesFromList(newest):
+                self.install(po = po)
+        return missing
+
     def deselectPackage(self, pkg):
         """Deselect package.  Can be specified as name.arch or name*"""
-        sp = pkg.rsplit(".", 2)
-        txmbrs = []
-        if len(sp) == 2:
-            txmbrs = self.tsInfo.matchNaevr(name=sp[0], arch=sp[1])
+        self.deselectPackages([pkg])
 
-        if len(txmbrs) == 0:
-            exact, match, unmatch = yum.packages.parsePackages(self.pkgSack.returnPackages(), [pkg], casematch=1)
-            for p in exact + match:
-                txmbrs.append(p)
+    def deselectPackages(self, pkgs):
+        """Deselect the given packages, as deselectPackage() would."""
+        index = self.__getIndex()
+        self.__selection["excluded"].update(pkgs)
+
+        # we also need to remove the packages from the conditionals dict so
+        # that things don't get pulled back in as a result of them.  yes,
+        # this is ugly.  conditionals should die.
+        conditionals = {}
+        for (req, cpkgs) in self.tsInfo.conditionals.iteritems():
+            for p in cpkgs:
+                conditionals.setdefault(p.pkgtup, []).append(req)
+
+        for pkg in pkgs:
+            sp = pkg.rsplit(".", 2)
+            txmbrs = []
+            if len(sp) == 2:
+                txmbrs = self.tsInfo.matchNaevr(name=sp[0], arch=sp[1])
+
+            if len(txmbrs) == 0:
+                txmbrs = index.match(pkg)
+
+            if len(txmbrs) == 0:
+                logging.warn("No such package %s to remove" %(pkg,))
+                continue
 
-        if len(txmbrs) > 0:
             for x in txmbrs:
                 self.tsInfo.remove(x.pkgtup)
-                # we also need to remove from the conditionals
-                # dict so that things don't get pulled back in as a result
-                # of them.  yes, this is ugly.  conditionals should die.
-                for req, pkgs in self.tsInfo.conditionals.iteritems():
-                    if x in pkgs:
-                        pkgs.remove(x)
-                        self.tsInfo.conditionals[req] = pkgs
-        else:
-            logging.warn("No such package %s to remove" %(pkg,))
+                for req in conditionals.pop(x.pkgtup, []):
+                    self.tsInfo.conditionals[req] = \
+                        [p for p in self.tsInfo.conditionals[req]
+                         if p.pkgtup != x.pkgtup]
 
     def selectGroup(self, grp, include = pykickstart.parser.GROUP_DEFAULT):
         # default to getting mandatory and default packages from a group
@@ -135,6 +262,7 @@ class LiveCDYum(yum.YumBase):
             package_types.remove('default')
         elif include == pykickstart.parser.GROUP_ALL:
             package_types.append('optional')
+        self.__selection["groups"].add("%s:%s" % (grp, include))
         yum.YumBase.selectGroup(self, grp, group_package_types=package_types)
 
     def addRepository(self, name, url = None, mirrorlist = None):
@@ -157,7 +285,17 @@ class LiveCDYum(yum.YumBase):
         repo = yum.yumRepo.YumRepository(name)
         if url:
             repo.baseurl.append(_varSubstitute(url))
-        if mirrorlist:
+        mirrors = None
+        if mirrorlist and self.mirror_selector:
+            mirrors = read_mirrorlist(_varSubstitute(mirrorlist))
+            if not mirrors or [m for m in mirrors if not "://" in m]:
+                # e.g. a metalink, which yum knows best how to handle
+                mirrors = None
+        if mirrors:
+            mirrors = self.mirror_selector.select(mirrors,
+                                                  "repodata/repomd.xml")
+            repo.baseurl.extend(mirrors)
+        elif mirrorlist:
             repo.mirrorlist = _varSubstitute(mirrorlist)
         conf = yum.config.RepoConf()
         for k, v in conf.iteritems():
@@ -165,17 +303,58 @@ class LiveCDYum(yum.YumBase):
                 repo.setAttribute(k, v)
         repo.basecachedir = self.conf.cachedir
         repo.failovermethod = "priority"
+        if mirrors:
+            # spread the repos over the best mirrors; a stalled one times
+            # out and fails over to the next
+            repo.failovermethod = "roundrobin"
+            repo.timeout = MIRROR_STALL_TIMEOUT
         repo.metadata_expire = 0
         repo.mirrorlist_expire = 0
         repo.timestamp_check = 0
         # disable gpg check???
         repo.gpgcheck = 0
         repo.enable()
-        repo.setup(0)
-        repo.setCallback(TextProgress())
         self.repos.add(repo)
         return repo
 
+    def setupRepositories(self):
+        """Fetch and parse the metadata of the repos added.
+
+        This is done for all repos at the same time, each in a process of its
+        own; the repos are then set up from the metadata cached, after their
+        options were set by the caller of addRepository().
+
+        """
+        global _setup_repos
+        repos = self.repos.listEnabled()
+        if len(repos) > 1:
+            _setup_repos = repos
+            pool = multiprocessing.Pool(min(len(repos), REPO_SETUP_JOBS))
+            try:
+                results = pool.map(_setup_repo, range(len(repos)))
+            finally:
+                pool.terminate()
+                pool.join()
+                _setup_repos = []
+
+            for (repo, (fetch, parse, error)) in zip(repos, results):
+                if error:
+                    # setting it up below raises the error properly
+                    logging.warn("Failed to fetch metadata of repo %s : %s" %
+                                 (repo.id, error))
+                    continue
+                logging.info("Repo %s: metadata fetched in %.1fs, parsed in "
+                             "%.1fs" % (repo.id, fetch, parse))
+                get_timing_report().note("repo " + repo.id,
+                                         "fetched %.1fs, parsed %.1fs" %
+                                         (fetch, parse))
+                # don't fetch the repomd.xml just fetched again
+                repo.metadata_expire = 60 * 60
+
+        for repo in repos:
+            repo.setup(0)
+            repo.setCallback(TextProgress())
+
     def installHasFile(self, file):
         provides_pkg = self.whatProvides(file, None, None)
         dlpkgs = map(lambda x: x.po, filter(lambda txmbr: txmbr.ts_state in ("i", "u"), self.tsInfo.getMembers()))
@@ -186,19 +365,77 @@ class LiveCDYum(yum.YumBase):
         return False
 
             
+    def __getDepsolveKey(self):
+        # the transaction depends on the metadata of the repos, what was
+        # selected from them and what is installed already
+        metadata = []
+        repos = []
+        for repo in self.repos.listEnabled():
+            digest = get_file_digest(os.path.join(repo.cachedir,
+                                                  "repomd.xml"))
+            if digest is None:
+                return None
+            metadata.append(digest)
+            repos.append((repo.id, repo.includepkgs, repo.exclude))
+        selection = dict(self.__selection)
+        selection["repos"] = repos
+        selection["arch"] = rpmUtils.arch.getCanonArch()
+        selection["installed"] = [tuple(t) for t in self.rpmdb.simplePkgList()]
+        return get_depsolve_key(metadata, selection)
+
+    def __loadTransaction(self, key):
+        result = self.depsolve_cache.get(key)
+        if result is None:
+            return False
+        pos = []
+        for (repoid, n, a, e, v, r) in result["packages"]:
+            found = [po for po in self.pkgSack.searchPkgTuple((n, a, e, v, r))
+                     if po.repoid == repoid]
+            if not found:
+                logging.info("Cached transaction lacks %s-%s-%s.%s, "
+                             "resolving it again" % (n, v, r, a))
+                return False
+            pos.append(found[0])
+
+        for txmbr in self.tsInfo.getMembers():
+            self.tsInfo.remove(txmbr.pkgtup)
+        for po in pos:
+            self.tsInfo.addInstall(po)
+        get_timing_report().record_saved("depsolve", result["seconds"])
+        get_timing_report().note("depsolve", "%d packages from cache" %
+                                 len(pos))
+        return True
+
+    def __storeTransaction(self, key, seconds):
+        txmbrs = self.tsInfo.getMembers()
+        # only transactions installing packages afresh are replayed
+        if [t for t in txmbrs if t.output_state != yum.constants.TS_INSTALL]:
+            return
+        packages = [[t.po.repoid] + list(t.pkgtup) for t in txmbrs]
+        self.depsolve_cache.put(key, { "packages" : packages,
+                                       "seconds" : seconds })
+
     def runInstall(self):
         os.environ["HOME"] = "/"
-        try:
-            (res, resmsg) = self.buildTransaction()
-        except yum.Errors.RepoError, e:
-            raise CreatorError("Unable to download from repo : %s" %(e,))
-        # Empty transactions are generally fine, we might be rebuilding an
-        # existing image with no packages added
-        if resmsg and resmsg[0].endswith(" - empty transaction"):
-            return res
-        if res != 2:
-            raise CreatorError("Failed to build transaction : %s" % str.join("\n", resmsg))
-        
+        key = None
+        if self.depsolve_cache:
+            key = self.__getDepsolveKey()
+        if not (key and self.__loadTransaction(key)):
+            start = time.time()
+            try:
+                with get_timing_report().timed("depsolve"):
+                    (res, resmsg) = self.buildTransaction()
+            except yum.Errors.RepoError, e:
+                raise CreatorError("Unable to download from repo : %s" %(e,))
+            # Empty transactions are generally fine, we might be rebuilding
+            # an existing image with no packages added
+            if resmsg and resmsg[0].endswith(" - empty transaction"):
+                return res
+            if res != 2:
+                raise CreatorError("Failed to build transaction : %s" % str.join("\n", resmsg))
+            if key:
+                self.__storeTransaction(key, time.time() - start)
+
         dlpkgs = map(lambda x: x.po, filter(lambda txmbr: txmbr.ts_state in ("i", "u"), self.tsInfo.getMembers()))
         self.downloadPkgs(dlpkgs)
         # FIXME: sigcheck?
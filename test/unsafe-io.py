@@ -0,0 +1,81 @@
+#! /usr/bin/python
+#
+# Measure what --unsafe-io saves: install a package of many small files
+# with dpkg into DIR, with and without force-unsafe-io, and print the wall
+# times. Run it with DIR on the kind of filesystem images are built on, e.g.
+# a loop mounted ext3 image:
+#
+#   unsafe-io.py /mnt/ext3 [FILES] [RUNS]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+def make_deb(workdir, files):
+    pkgdir = os.path.join(workdir, "pkg")
+    os.makedirs(pkgdir + "/DEBIAN")
+    f = open(pkgdir + "/DEBIAN/control", "w")
+    f.write("Package: imgcreate-unsafe-io\n"
+            "Version: 1.0\n"
+            "Architecture: all\n"
+            "Maintainer: imgcreate\n"
+            "Description: files to install\n")
+    f.close()
+    for i in range(files):
+        d = "%s/usr/share/unsafe-io/%02d" % (pkgdir, i % 100)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        f = open("%s/%d" % (d, i), "w")
+        f.write(os.urandom(4096))
+        f.close()
+    deb = os.path.join(workdir, "unsafe-io.deb")
+    subprocess.check_call(["dpkg-deb", "-Zgzip", "-z1", "--build", pkgdir,
+                           deb], stdout = open(os.devnull, "w"))
+    return deb
+
+def install(target, deb, unsafe):
+    root = tempfile.mkdtemp(dir = target, prefix = "root-")
+    try:
+        for d in ("var/lib/dpkg/updates", "var/lib/dpkg/info"):
+            os.makedirs(os.path.join(root, d))
+        open(root + "/var/lib/dpkg/status", "w").close()
+        args = ["dpkg", "--root", root, "--force-not-root",
+                "--force-script-chrootless", "--log", os.devnull]
+        if unsafe:
+            args.append("--force-unsafe-io")
+        start = time.time()
+        subprocess.check_call(args + ["--install", deb],
+                              stdout = open(os.devnull, "w"))
+        return time.time() - start
+    finally:
+        shutil.rmtree(root)
+
+def main():
+    if len(sys.argv) < 2:
+        print >> sys.stderr, "usage: %s DIR [FILES] [RUNS]" % sys.argv[0]
+        return 2
+    target = sys.argv[1]
+    files = len(sys.argv) > 2 and int(sys.argv[2]) or 3000
+    runs = len(sys.argv) > 3 and int(sys.argv[3]) or 5
+
+    workdir = tempfile.mkdtemp(prefix = "unsafe-io-")
+    try:
+        deb = make_deb(workdir, files)
+        times = { False : [], True : [] }
+        # alternate, so that both see the same state of the host
+        for i in range(runs):
+            for unsafe in (False, True):
+                times[unsafe].append(install(target, deb, unsafe))
+        for unsafe in (False, True):
+            t = sorted(times[unsafe])
+            print "%-16s median %6.2fs  min %6.2fs  max %6.2fs" % \
+                  (unsafe and "force-unsafe-io" or "default", t[len(t) / 2],
+                   t[0], t[-1])
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    sys.exit(main())